@@ -0,0 +1,189 @@
+"""
+Helpers for evaluating many scenarios at once.
+
+In batch mode a cell that depends on the varied inputs holds a Scenarios vector, one value per scenario, instead
+of a single value. Operators broadcast over these vectors with numpy. Excel functions are called once per
+scenario unless none of their arguments vary.
+"""
+import numpy as np
+from collections import namedtuple
+from ranges import to_array
+from excellib import as_tuples, xsum, xmin, xmax, average, count
+
+
+Sensitivity = namedtuple('Sensitivity', 'input_low input_high output_low output_high baseline')
+Sensitivity.__doc__ = '''
+One input/output pair of a sensitivity analysis
+@input_low, input_high: input bumped down and up
+@output_low, output_high: output with the input bumped down and up
+@baseline: output with no bump
+'''
+
+
+class Scenarios(np.ndarray):
+    """
+    1-D array of per scenario values of a cell. A subclass of ndarray so that it survives numpy arithmetic and
+    can be told apart from 2-D range values
+    """
+    pass
+
+
+def scenarios(values):
+    '''
+    Packs per scenario values into a Scenarios vector
+    @param values: sequence with one value per scenario
+    @return: Scenarios, numeric if every value is a number, object otherwise
+    '''
+    try:
+        array = np.asarray(values)
+    except ValueError:
+        # ragged, e.g. some scenarios returned arrays
+        array = None
+    if array is None or array.ndim != 1 or array.dtype.kind not in 'biuf':
+        array = np.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            array[i] = value.item() if isinstance(value, np.generic) else value
+    return array.view(Scenarios)
+
+
+def scenario_count(value):
+    '''
+    Number of scenarios carried by a value
+    @return: length of the Scenarios vector in the value, or None if the value is the same in every scenario
+    '''
+    if isinstance(value, Scenarios):
+        return len(value)
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        for item in value.flat:
+            if isinstance(item, Scenarios):
+                return len(item)
+    return None
+
+
+def pick(value, index):
+    '''
+    Value of one scenario
+    @param value: scalar, Scenarios vector, or 2-D range array which may hold Scenarios vectors
+    @param index: scenario number
+    @return: value as seen by that scenario
+    '''
+    if isinstance(value, Scenarios):
+        item = value[index]
+        return item.item() if isinstance(item, np.generic) else item
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        if any(isinstance(item, Scenarios) for item in value.flat):
+            return to_array([[pick(item, index) for item in row] for row in value.tolist()])
+    return value
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _split_numeric(args):
+    '''
+    Splits aggregate arguments into numbers that are the same in every scenario and numeric Scenarios vectors.
+    Non numeric cells inside ranges are skipped, as SUM and friends do
+    @return: (array of fixed numbers, list of vectors), or None if some argument needs the per scenario path
+    '''
+    fixed = []
+    vectors = []
+    for arg in args:
+        if isinstance(arg, Scenarios):
+            if arg.dtype.kind not in 'iuf':
+                return None
+            vectors.append(arg.view(np.ndarray).astype(np.float64))
+        elif isinstance(arg, np.ndarray):
+            if arg.dtype == np.float64:
+                fixed.append(arg.ravel())
+                continue
+            for item in arg.flat:
+                if isinstance(item, Scenarios):
+                    if item.dtype.kind not in 'iuf':
+                        return None
+                    vectors.append(item.view(np.ndarray).astype(np.float64))
+                elif _is_number(item):
+                    fixed.append(np.array([item], dtype=np.float64))
+                elif isinstance(item, str) and item.startswith('#'):
+                    # errors propagate, leave them to the per scenario path
+                    return None
+        elif _is_number(arg):
+            fixed.append(np.array([arg], dtype=np.float64))
+        else:
+            return None
+    return (np.concatenate(fixed) if fixed else np.empty(0)), vectors
+
+
+def _batched_sum(fixed, vectors):
+    return scenarios(fixed.sum() + np.sum(vectors, axis=0))
+
+
+def _batched_count(fixed, vectors):
+    return len(fixed) + len(vectors)
+
+
+def _batched_average(fixed, vectors):
+    return scenarios((fixed.sum() + np.sum(vectors, axis=0)) / (len(fixed) + len(vectors)))
+
+
+def _batched_min(fixed, vectors):
+    result = np.min(vectors, axis=0)
+    return scenarios(np.minimum(result, fixed.min()) if len(fixed) else result)
+
+
+def _batched_max(fixed, vectors):
+    result = np.max(vectors, axis=0)
+    return scenarios(np.maximum(result, fixed.max()) if len(fixed) else result)
+
+
+# Aggregates over ranges holding Scenarios are computed across all scenarios in one go
+BATCHED_AGGREGATES = {
+    xsum: _batched_sum,
+    count: _batched_count,
+    average: _batched_average,
+    xmin: _batched_min,
+    xmax: _batched_max,
+}
+
+
+def call_batched(func, args, array_args):
+    '''
+    Calls an excel function with arguments that may vary by scenario. Used as the CALL hook of the stack machine
+    @return: plain result if no argument varies, else a Scenarios vector of per scenario results
+    '''
+    size = None
+    for arg in args:
+        size = scenario_count(arg)
+        if size is not None:
+            break
+
+    if size is None:
+        if not array_args:
+            args = [as_tuples(a) for a in args]
+        return func(*args)
+
+    aggregate = BATCHED_AGGREGATES.get(func)
+    if aggregate is not None:
+        split = _split_numeric(args)
+        if split is not None:
+            return aggregate(*split)
+
+    results = []
+    for index in range(size):
+        scenario_args = [pick(a, index) for a in args]
+        if not array_args:
+            scenario_args = [as_tuples(a) for a in scenario_args]
+        results.append(func(*scenario_args))
+    return scenarios(results)
+
+
+def broadcast(value, size):
+    '''
+    Output vector of a cell
+    @param value: Scenarios vector, or a single value shared by all scenarios
+    @param size: number of scenarios
+    @return: plain 1-D numpy array with one value per scenario
+    '''
+    if isinstance(value, Scenarios):
+        return value.view(np.ndarray)
+    return scenarios([value] * size).view(np.ndarray)
@@ -0,0 +1,569 @@
+"""
+Benchmarks for the Saturn calculation engine.
+
+Each benchmark builds a synthetic workbook with openpyxl in a temporary folder, loads it with the Loader and
+times the engine on it. Run from the Saturn folder, e.g.:
+
+    python benchmark.py vm --rows 5000
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+from openpyxl import Workbook
+from pycel.excelutil import handle_ifs
+from loader import Loader
+from flat import FLAT_SUFFIX
+from ranges import RangeRef
+from rpnnode import OperatorNode, FunctionNode, RangeNode, CellNode
+from excellib import *
+
+
+def timed(func, *args, repeat=3):
+    '''
+    Best wall clock time of several runs
+    @return: (seconds, result of the last run)
+    '''
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def make_workbook(folder, rows):
+    '''
+    Writes a workbook with one input column and a few columns of arithmetic and function formulas
+    @return: path of the xlsx file
+    '''
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Sheet1'
+    for r in range(1, rows + 1):
+        ws.cell(r, 1, r)
+        ws.cell(r, 2, '=A{0}*2+1'.format(r))
+        ws.cell(r, 3, '=B{0}/(A{0}+1)-B{0}^2'.format(r))
+        ws.cell(r, 4, '=SUM(A{0}:C{0})'.format(r))
+        ws.cell(r, 5, '=MAX(B{0},C{0},D{0})-MIN(A{0},1)'.format(r))
+    path = os.path.join(folder, 'bench_{}.xlsx'.format(rows))
+    wb.save(path)
+    return path
+
+
+def formula_cells(loader):
+    return [cell for cell in loader.cells.values() if cell.program is not None]
+
+
+def reset(cells):
+    for cell in cells:
+        cell.needs_calc = True
+
+
+def legacy_getvalue(loader, address):
+    cell = loader.getCell(address)
+    if cell is None:
+        return None
+    if cell.needs_calc:
+        return legacy_calculate(loader, cell)
+    return cell.value
+
+
+def legacy_calculate(loader, cell):
+    '''
+    The string eval evaluation that the stack machine replaced, kept here as the baseline
+    '''
+    stack = []
+    for node in cell.rpn:
+        if isinstance(node, OperatorNode):
+            if node.token.type == node.token.OP_IN:
+                arg2 = stack.pop()
+                arg1 = stack.pop()
+                stack.append(eval('''{}{}{}'''.format(arg1, OP_MAP.get(node.token.value), arg2)))
+            else:
+                arg1 = stack.pop()
+                stack.append(eval('''{}{}'''.format(OP_MAP.get(node.token.value), arg1)))
+        elif isinstance(node, FunctionNode):
+            args = stack[-node.num_args:]
+            del stack[-node.num_args:]
+            func = FUNC_MAP.get(node.token.value.strip('('))
+            stack.append(eval('{}{}'.format(func, '{}'.format(tuple(args)))))
+        elif isinstance(node, RangeNode):
+            stack.append(tuple(tuple(legacy_getvalue(loader, add) for add in adds) for adds in node.ref.rows()))
+        elif isinstance(node, CellNode):
+            stack.append(legacy_getvalue(loader, node.rangeadds))
+        else:
+            stack.append(node.token.value)
+
+    cell.value = stack.pop()
+    cell.needs_calc = False
+    return cell.value
+
+
+def run_legacy(loader, cells):
+    reset(cells)
+    return [legacy_getvalue(loader, cell.address) for cell in cells]
+
+
+def run_vm(loader, cells):
+    reset(cells)
+    return [loader.getvalue(cell.address) for cell in cells]
+
+
+def bench_vm(folder, rows):
+    '''
+    Compares the stack machine against string eval over every formula cell of the workbook
+    '''
+    loader = Loader(make_workbook(folder, rows))
+    cells = formula_cells(loader)
+
+    legacy_time, legacy = timed(run_legacy, loader, cells)
+    vm_time, vm = timed(run_vm, loader, cells)
+
+    assert all(a == b or abs(a - b) < 1e-9 for a, b in zip(legacy, vm)), 'Results differ between engines'
+
+    print("{} formula cells".format(len(cells)))
+    print("eval : {:.3f}s ({:.1f} us/cell)".format(legacy_time, 1e6 * legacy_time / len(cells)))
+    print("vm   : {:.3f}s ({:.1f} us/cell)".format(vm_time, 1e6 * vm_time / len(cells)))
+    print("speedup x{:.1f}".format(legacy_time / vm_time))
+
+
+def make_lookup_workbook(folder, rows):
+    '''
+    Writes a workbook with a table of `rows` rows and a tenth as many exact and approximate lookups into it
+    @return: path of the xlsx file
+    '''
+    wb = Workbook()
+    table = wb.active
+    table.title = 'Table'
+    for r in range(1, rows + 1):
+        table.cell(r, 1, r * 2)
+        table.cell(r, 2, 'Key{}'.format(r))
+        table.cell(r, 3, r * 0.5)
+    ws = wb.create_sheet('Lookups')
+    for r in range(1, rows // 10 + 1):
+        ws.cell(r, 1, (r * 7919) % (2 * rows))
+        ws.cell(r, 2, 'key{}'.format((r * 7919) % rows))
+        ws.cell(r, 3, '=VLOOKUP(A{0},Table!$A$1:$C${1},3,FALSE)'.format(r, rows))
+        ws.cell(r, 4, '=VLOOKUP(A{0},Table!$A$1:$C${1},3,TRUE)'.format(r, rows))
+        ws.cell(r, 5, '=MATCH(B{0},Table!$B$1:$B${1},0)'.format(r, rows))
+    path = os.path.join(folder, 'lookup_{}.xlsx'.format(rows))
+    wb.save(path)
+    return path
+
+
+def bench_lookup(folder, rows):
+    '''
+    Compares lookups into a shared table with and without the cached range arrays and their lookup indexes
+    '''
+    loader = Loader(make_lookup_workbook(folder, rows))
+    cells = formula_cells(loader)
+
+    def uncached():
+        # Every formula gets a fresh array, as if no range was shared
+        users = loader.rangeIndex.users
+        loader.rangeIndex.users = lambda ref: 0
+        try:
+            return run_vm(loader, cells)
+        finally:
+            loader.rangeIndex.users = users
+
+    plain_time, plain = timed(uncached, repeat=1)
+    cached_time, cached = timed(run_vm, loader, cells)
+
+    assert plain == cached, 'Results differ with cached lookups'
+
+    print("{} lookups into {} rows".format(len(cells), rows))
+    print("uncached : {:.3f}s ({:.1f} us/cell)".format(plain_time, 1e6 * plain_time / len(cells)))
+    print("cached   : {:.3f}s ({:.1f} us/cell)".format(cached_time, 1e6 * cached_time / len(cells)))
+    print("speedup x{:.1f}".format(plain_time / cached_time))
+
+
+REGIONS = ('north', 'south', 'east', 'west', 'north-east', 'south-west')
+
+
+def make_criteria_workbook(folder, rows):
+    '''
+    Writes a workbook with a data table of `rows` rows and conditional aggregates over it, several per
+    criteria column
+    @return: path of the xlsx file
+    '''
+    wb = Workbook()
+    data = wb.active
+    data.title = 'Data'
+    for r in range(1, rows + 1):
+        data.cell(r, 1, REGIONS[r % len(REGIONS)])
+        data.cell(r, 2, (r * 37) % 1000)
+        data.cell(r, 3, (r * 11) % 100)
+    ws = wb.create_sheet('Report')
+    ranges = {'A': 'Data!$A$1:$A${}'.format(rows), 'B': 'Data!$B$1:$B${}'.format(rows),
+              'C': 'Data!$C$1:$C${}'.format(rows)}
+    for i, region in enumerate(REGIONS, 1):
+        ws.cell(i, 1, '=SUMIFS({B},{A},"{0}",{C},">=50")'.format(region, **ranges))
+        ws.cell(i, 2, '=COUNTIFS({A},"{0}",{C},">=50")'.format(region, **ranges))
+        ws.cell(i, 3, '=AVERAGEIF({A},"{0}",{B})'.format(region, **ranges))
+        ws.cell(i, 4, '=SUMIF({A},"{0}*",{C})'.format(region[:3], **ranges))
+    path = os.path.join(folder, 'criteria_{}.xlsx'.format(rows))
+    wb.save(path)
+    return path
+
+
+def legacy_criteria(a, b, c):
+    '''
+    The same aggregates with pycel's criteria parsing and per cell tests, on ranges given as tuples
+    '''
+    results = []
+    for region in REGIONS:
+        both = handle_ifs((a, region, c, '>=50'))
+        results.append(sum(b[r][k] for r, k in both))
+        results.append(len(both))
+        coords = handle_ifs((a, region))
+        results.append(sum(b[r][k] for r, k in coords) / len(coords))
+        results.append(sum(c[r][k] for r, k in handle_ifs((a, region[:3] + '*'))))
+    return results
+
+
+def bench_criteria(folder, rows):
+    '''
+    Compares compiled and cached criteria against pycel's per call criteria parsing on conditional aggregates
+    '''
+    loader = Loader(make_criteria_workbook(folder, rows))
+    cells = ['Report!{}{}'.format(col, row) for row in range(1, len(REGIONS) + 1) for col in 'ABCD']
+    columns = [as_tuples(loader.getrange(RangeRef('Data', 1, col, rows, col))) for col in (1, 2, 3)]
+
+    legacy_time, legacy = timed(legacy_criteria, *columns, repeat=1)
+    cold_time, cold = timed(lambda: [loader.getvalue(address) for address in cells], repeat=1)
+
+    def recalc():
+        # A change in the summed column leaves the criteria columns and their masks as they are
+        loader.setvalue(loader.getvalue('Data!B1') + 1, 'Data!B1')
+        return [loader.getvalue(address) for address in cells]
+
+    warm_time, warm = timed(recalc)
+
+    assert all(abs(a - b) < 1e-6 for a, b in zip(legacy, cold)), 'Results differ from pycel criteria'
+
+    print("{} conditional aggregates over {} rows".format(len(cells), rows))
+    print("pycel criteria   : {:.3f}s".format(legacy_time))
+    print("compiled, cold   : {:.3f}s (includes reading the ranges)".format(cold_time))
+    print("compiled, recalc : {:.3f}s (after a change in the summed column)".format(warm_time))
+
+
+def bench_codegen(folder, rows):
+    '''
+    Compares a compiled model module against the Loader on changing every input of the vm workbook
+    '''
+    loader = Loader(make_workbook(folder, rows))
+    inputs = ['Sheet1!A{}'.format(r) for r in range(1, rows + 1)]
+    outputs = ['Sheet1!E{}'.format(r) for r in range(1, rows + 1)]
+
+    compile_time, model = timed(loader.compile_module, inputs, outputs, folder, repeat=1)
+    values = {address: loader.getvalue(address) + 1 for address in inputs}
+
+    def interpret():
+        for address, value in values.items():
+            loader.setvalue(value, address)
+        return loader.getvalues(outputs)
+
+    arguments = {model.INPUTS[address]: value for address, value in values.items()}
+    loader_time, expected = timed(interpret)
+    module_time, result = timed(lambda: model.calculate(**arguments))
+
+    assert all(abs(result[address] - expected[address]) < 1e-9 for address in outputs), 'Results differ'
+
+    print("{} inputs, {} outputs, {} cells in between".format(len(inputs), len(outputs), 4 * rows))
+    print("compile : {:.3f}s".format(compile_time))
+    print("loader  : {:.3f}s".format(loader_time))
+    print("module  : {:.3f}s".format(module_time))
+    print("speedup x{:.1f}".format(loader_time / module_time))
+
+
+def bench_templates(folder, rows):
+    '''
+    Compares recalculating the copied-down formulas of the vm workbook cell by cell and by group over column
+    vectors, after a change in every input
+    '''
+    loader = Loader(make_workbook(folder, rows))
+    inputs = ['Sheet1!A{}'.format(r) for r in range(1, rows + 1)]
+    outputs = [cell.address for cell in formula_cells(loader)]
+    groups = len(set(map(id, loader.formulaGroups().values())))
+
+    def recalc():
+        # Best of three, with the inputs changed before each timed run
+        best = None
+        for _ in range(3):
+            for address in inputs:
+                loader.setvalue(loader.getvalue(address) + 1, address)
+            elapsed, result = timed(loader.getvalues, outputs, repeat=1)
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    grouped_time, grouped = recalc()
+
+    # An empty index leaves every formula to be calculated by itself
+    loader.groupIndex = {}
+    for address in inputs:
+        loader.setvalue(loader.getvalue(address) - 3, address)
+    single_time, single = recalc()
+
+    assert all(abs(single[address] - grouped[address]) < 1e-9 for address in outputs), 'Results differ'
+
+    print("{} formula cells in {} groups".format(len(outputs), groups))
+    print("cell by cell : {:.3f}s ({:.1f} us/cell)".format(single_time, 1e6 * single_time / len(outputs)))
+    print("grouped      : {:.3f}s ({:.1f} us/cell)".format(grouped_time, 1e6 * grouped_time / len(outputs)))
+    print("speedup x{:.1f}".format(single_time / grouped_time))
+
+
+def make_sheets_workbook(folder, rows, sheets):
+    '''
+    Writes a workbook with several sheets holding independent copies of the vm workbook's formulas, each with
+    a total row
+    @return: path of the xlsx file
+    '''
+    wb = Workbook()
+    wb.remove(wb.active)
+    for s in range(1, sheets + 1):
+        ws = wb.create_sheet('Sheet{}'.format(s))
+        for r in range(1, rows + 1):
+            ws.cell(r, 1, r * s)
+            ws.cell(r, 2, '=A{0}*2+1'.format(r))
+            ws.cell(r, 3, '=B{0}/(A{0}+1)-B{0}^2'.format(r))
+            ws.cell(r, 4, '=ABS(C{0})+SUM(A{0}:C{0})'.format(r))
+            ws.cell(r, 5, '=MAX(B{0},C{0},D{0})-MIN(A{0},1)'.format(r))
+        ws.cell(rows + 1, 5, '=SUM(E1:E{})'.format(rows))
+    path = os.path.join(folder, 'bench_sheets_{}_{}.xlsx'.format(sheets, rows))
+    wb.save(path)
+    return path
+
+
+def bench_parallel(folder, rows, sheets=8):
+    '''
+    Recalculates independent sheets after a change in every input, in this process and across 2, 4 and 8 worker
+    processes and one per CPU, to show how the speedup scales. It is bounded by the CPUs there are: past them the
+    workers share CPUs, and the extra processes only add their start up and the exchange of results
+    '''
+    loader = Loader(make_sheets_workbook(folder, rows, sheets))
+    inputs = ['Sheet{}!A{}'.format(s, r) for s in range(1, sheets + 1) for r in range(1, rows + 1)]
+    outputs = ['Sheet{}!E{}'.format(s, rows + 1) for s in range(1, sheets + 1)]
+    cpus = os.cpu_count()
+
+    # Recalculated in this process at the same inputs, to check the results against
+    fresh = Loader(loader.file)
+
+    def recalc(workers):
+        # Best of three, with the inputs changed before each timed run
+        best = None
+        for _ in range(3):
+            for address in inputs:
+                loader.setvalue(loader.getvalue(address) + 1, address)
+            elapsed, result = timed(loader.getvalues, outputs, workers, repeat=1)
+            best = elapsed if best is None else min(best, elapsed)
+
+        for address in inputs:
+            fresh.setvalue(loader.getvalue(address), address)
+        serial = fresh.getvalues(outputs)
+        assert all(abs(result[address] - serial[address]) <= 1e-9 * abs(serial[address]) for address in outputs), \
+            'Results differ with {} processes'.format(workers)
+        return best
+
+    times = {workers: recalc(workers) for workers in sorted({1, 2, 4, 8, cpus})}
+
+    print("{} sheets, {} formula cells, {} CPUs".format(sheets, len(formula_cells(loader)), cpus))
+    for workers, elapsed in times.items():
+        speedup = times[1] / elapsed
+        print("{:>2} processes : {:.3f}s  speedup x{:.1f}  efficiency {:.0%}{}".format(
+            workers, elapsed, speedup, speedup / min(workers, cpus), '' if workers <= cpus else '  (more processes than CPUs)'))
+
+
+def private_memory():
+    '''
+    @return: memory of this process not shared with others, in MB. Peak resident memory where that is not known
+    '''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def serve_loader(path, inputs, outputs):
+    '''
+    Worker holding its own Loader. Run in a fresh process
+    @return: (seconds to load, seconds to recalculate, private memory in MB)
+    '''
+    start = time.perf_counter()
+    loader = Loader(path)
+    loader.getvalues(outputs)
+    loaded = time.perf_counter() - start
+    start = time.perf_counter()
+    for address in inputs:
+        loader.setvalue(loader.getvalue(address) + 1, address)
+    loader.getvalues(outputs)
+    return loaded, time.perf_counter() - start, private_memory()
+
+
+def serve_shared(name, inputs, outputs):
+    '''
+    Worker mapping a shared model, with its changes in a Session. Run in a fresh process
+    @return: (seconds to attach, seconds to recalculate, private memory in MB)
+    '''
+    from sharedmodel import attach
+    start = time.perf_counter()
+    model = attach(name)
+    session = model.session()
+    loaded = time.perf_counter() - start
+    start = time.perf_counter()
+    for address, value in session.getvalues(inputs).items():
+        session.setvalue(value + 1, address)
+    session.getvalues(outputs)
+    return loaded, time.perf_counter() - start, private_memory()
+
+
+def bench_shared(folder, rows):
+    '''
+    Compares a worker process holding its own Loader with one mapping a model shared by this process, on a
+    change in a tenth of the inputs of the vm workbook
+    '''
+    import multiprocessing
+    path = make_workbook(folder, rows)
+    loader = Loader(path)
+    inputs = ['Sheet1!A{}'.format(r) for r in range(1, rows + 1, 10)]
+    outputs = ['Sheet1!E{}'.format(r) for r in range(1, rows + 1)]
+
+    with loader.share_model() as shared:
+        # Fresh processes, so that neither starts with pages of this one
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            own = pool.apply(serve_loader, (path, inputs, outputs))
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            mapped = pool.apply(serve_shared, (shared.name, inputs, outputs))
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            baseline = pool.apply(private_memory)
+
+    print("{} cells, shared segment of {:.1f} MB".format(len(loader.cells), shared.size / 2 ** 20))
+    print("                load     recalc   private memory (MB, {:.0f} of it the interpreter)".format(baseline))
+    print("own Loader    : {:.3f}s   {:.3f}s   {:.0f}".format(*own))
+    print("shared model  : {:.3f}s   {:.3f}s   {:.0f}".format(*mapped))
+
+
+def open_workbook(path, outputs, cache):
+    '''
+    Cold start from a workbook, parsed or read back from the compiled model cache. Run in a fresh process
+    @return: (seconds to first values, private memory in MB)
+    '''
+    start = time.perf_counter()
+    Loader(path, cache=cache).getvalues(outputs)
+    return time.perf_counter() - start, private_memory()
+
+
+def open_flat(path, outputs):
+    '''
+    Cold start from a flat model file. Run in a fresh process
+    @return: (seconds to first values, private memory in MB)
+    '''
+    from flat import load_model
+    start = time.perf_counter()
+    load_model(path).session().getvalues(outputs)
+    return time.perf_counter() - start, private_memory()
+
+
+def bench_flatfile(folder, rows):
+    '''
+    Compares cold starts of the vm workbook from the xlsx, from the compiled model cache and from a flat model file
+    '''
+    import multiprocessing
+    path = make_workbook(folder, rows)
+    outputs = ['Sheet1!E{}'.format(r) for r in range(1, rows + 1)]
+    loader = Loader(path, cache=True)
+    flat_path = os.path.join(folder, 'model' + FLAT_SUFFIX)
+    size = loader.save_flat(flat_path)
+
+    runs = [('xlsx', open_workbook, (path, outputs, None)),
+            ('cache', open_workbook, (path, outputs, True)),
+            ('flat file', open_flat, (flat_path, outputs))]
+    print("{} cells, flat file of {:.1f} MB".format(len(loader.cells), size / 2 ** 20))
+    print("              first values   private memory (MB)")
+    for name, run, args in runs:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            print("{:<12}: {:.3f}s        {:.0f}".format(name, *pool.apply(run, args)))
+
+
+def make_capped_workbook(folder, rows):
+    '''
+    Writes a workbook whose inputs go through a cap, MIN(A, 1), before a few columns of formulas and a total, so
+    that changes to inputs at or above the cap change nothing past it
+    @return: path of the xlsx file
+    '''
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Sheet1'
+    for r in range(1, rows + 1):
+        ws.cell(r, 1, r)
+        ws.cell(r, 2, '=MIN(A{0},1)'.format(r))
+        ws.cell(r, 3, '=B{0}*2+1'.format(r))
+        ws.cell(r, 4, '=SUM(B{0}:C{0})/(C{0}+1)'.format(r))
+        ws.cell(r, 5, '=MAX(B{0},C{0},D{0})-C{0}^2'.format(r))
+    ws.cell(1, 6, '=SUM(E1:E{})'.format(rows))
+    path = os.path.join(folder, 'bench_capped_{}.xlsx'.format(rows))
+    wb.save(path)
+    return path
+
+
+def bench_cutoff(folder, rows):
+    '''
+    Change cut-off on a change to a tenth of the inputs of the capped workbook, which leaves the capped values as
+    they were, against the same recalculation with the cut-off turned off
+    '''
+    path = make_capped_workbook(folder, rows)
+    inputs = ['Sheet1!A{}'.format(r) for r in range(1, rows + 1, 10)]
+    outputs = ['Sheet1!E{}'.format(r) for r in range(1, rows + 1)] + ['Sheet1!F1']
+    results = []
+    for cutoff in (False, True):
+        loader = Loader(path)
+        if not cutoff:
+            loader.unchanged = lambda address: False
+        loader.getvalues(outputs)
+        for address in inputs:
+            loader.setvalue(loader.getvalue(address) + 1, address)
+        start = time.perf_counter()
+        changes = loader.getchanges(outputs)
+        results.append((time.perf_counter() - start, loader.last_recalc, loader.keep_count, len(changes)))
+
+    print("{} inputs changed, {} formula cells".format(len(inputs), 4 * rows + 1))
+    print("                time      calculated   kept   changed")
+    for name, result in zip(('no cut-off', 'cut-off'), results):
+        print("{:<12}: {:.3f}s   {:<10}   {:<6} {}".format(name, *result))
+
+
+BENCHMARKS = {
+    'vm': bench_vm,
+    'lookup': bench_lookup,
+    'criteria': bench_criteria,
+    'codegen': bench_codegen,
+    'templates': bench_templates,
+    'parallel': bench_parallel,
+    'shared': bench_shared,
+    'flatfile': bench_flatfile,
+    'cutoff': bench_cutoff,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=2000)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as folder:
+        BENCHMARKS[args.benchmark](folder, args.rows)
+
+
+if __name__ == '__main__':
+    main()
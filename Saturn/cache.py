@@ -0,0 +1,83 @@
+"""
+On-disk cache of a Loader's parsed state.
+
+A cache file holds two pickles back to back: a small header with the format version and the SHA-256 of the
+workbook it was built from, then the state itself (cells with their RPN programs, precedent and dependent maps,
+cached values). The header is checked before the state is read, so a stale cache costs one small read.
+"""
+import os
+import pickle
+import hashlib
+import logging
+
+# Bump whenever the layout of the cached state changes
+CACHE_VERSION = 6
+CACHE_SUFFIX = '.saturn'
+
+
+def file_digest(file, chunk_size=1 << 20):
+    '''
+    SHA-256 of a workbook's content
+    @param file: path or binary file object
+    @return: hex digest
+    '''
+    sha = hashlib.sha256()
+    if hasattr(file, 'read'):
+        position = file.tell()
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+        file.seek(position)
+    else:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_path(file, digest, cache):
+    '''
+    Where the cache of a workbook lives
+    @param file: path or binary file object of the workbook
+    @param digest: SHA-256 of the workbook
+    @param cache: True to keep the cache alongside the workbook, or a folder to keep it in
+    @return: path of the cache file, or None if there is nowhere to put it
+    '''
+    if isinstance(cache, (str, os.PathLike)):
+        os.makedirs(cache, exist_ok=True)
+        return os.path.join(cache, digest + CACHE_SUFFIX)
+    if isinstance(file, (str, os.PathLike)):
+        return os.fspath(file) + CACHE_SUFFIX
+    return None
+
+
+def load_state(path, digest):
+    '''
+    Reads a cached state if it was built from the same workbook content with the same format version
+    @return: state dictionary, or None if there is no usable cache
+    '''
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('version') != CACHE_VERSION or header.get('sha256') != digest:
+                logging.info("Cache {} is stale".format(path))
+                return None
+            return pickle.load(f)
+    except Exception as ex:
+        logging.info("Ignoring unreadable cache {}: {}".format(path, ex))
+        return None
+
+
+def save_state(path, digest, state):
+    '''
+    Writes a state to the cache. The file is replaced atomically so readers never see half a cache
+    '''
+    if path is None:
+        return
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': CACHE_VERSION, 'sha256': digest}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    logging.info("Saved compiled model to {}".format(path))
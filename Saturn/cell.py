@@ -5,6 +5,8 @@ logger = logging.getLogger(__name__)
 from rpnnode import RPNNode, OperatorNode, RangeNode, OperandNode, FunctionNode, CellNode
 from networkx.classes.digraph import DiGraph
 from tokenizer import Tokenizer, Token
+from vm import compile_rpn
+from templates import reference, template
 
 class Cell:
     """
@@ -21,7 +23,9 @@ class Cell:
         self.value = None
         self.prec = []
         self._formula = None
-        self.rpn = []
+        self._rpn = []
+        self.program = None
+        self.template = None
         self.tree = None
         self.needs_calc = True
 
@@ -30,6 +34,32 @@ class Cell:
         cell_str = 'A:{}, V:{}, F:{}'.format(self.address ,self.value ,self.formula)
         return cell_str
 
+    def __getstate__(self):
+        '''
+        RPN nodes are left out when pickling. The compiled program is kept and rpn is rebuilt from the formula
+        if it is asked for again
+        '''
+        state = self.__dict__.copy()
+        state['_rpn'] = None
+        return state
+
+    @property
+    def rpn(self):
+        if self._rpn is None:
+            self._rpn = self.make_rpn(self._formula) if self.is_formula(self._formula) else self.hardcode_rpn()
+        return self._rpn
+
+    @rpn.setter
+    def rpn(self, rpn):
+        self._rpn = rpn
+
+    @staticmethod
+    def is_formula(excel_formula):
+        return str(excel_formula).startswith(('=','+'))
+
+    def hardcode_rpn(self):
+        return [OperandNode(Token(self.address, Token.OPERAND, "TEXT"))]
+
     @property
     def formula(self):
         return self._formula
@@ -42,11 +72,22 @@ class Cell:
         @return: rpn formula
         '''
         self._formula = excel_formula
+        self.rpn = []
+        self.program = None
+        self.template = None
+        self.prec = []
         logging.debug("Processing RPN for formula {} at cell {}".format(excel_formula,self))
 
         #First check if formula starts with correct operator
-        if str(excel_formula).startswith(('=','+')):
+        if self.is_formula(excel_formula):
            self.rpn = self.make_rpn(excel_formula)
+           self.needs_calc = True
+
+           # lower rpn once into a program for the stack machine
+           self.program = compile_rpn(self.rpn)
+
+           # R1C1 form of the formula, shared by copies of it down a column
+           self.template = template(self.rpn)
 
            # creates list of precedents (who do I depend on)
            self.createPrec()
@@ -55,8 +96,7 @@ class Cell:
         else:
             logging.debug("Formula does not start with = or +. Creating a hardcode cell")
             if isinstance(fast_real(self.address),str):
-                tok = Token(self.address,Token.OPERAND,"TEXT")
-                self.rpn.append(OperandNode(tok))
+                self.rpn = self.hardcode_rpn()
                 self.needs_calc = False
             else:
                 tok = Token(self.address, Token.OPERAND, "NUMBER")
@@ -67,7 +107,8 @@ class Cell:
     def createPrec(self):
         for node in self.rpn:
             if isinstance(node,RangeNode):
-                self.prec.extend(node.prec_in_range)
+                # Ranges are kept as a single RangeRef precedent, not one entry per cell
+                self.prec.append(node.prec_in_range)
             elif isinstance(node,CellNode):
                 self.prec.append(node.prec_in_range)
 
@@ -76,10 +117,18 @@ class Cell:
         #Extract sheet name
         sheet = self.address.split('!')[0]
 
+        # References are kept in R1C1 form too, while the $ signs are still there
+        r1c1 = None
+        if token.type == Token.OPERAND and token.subtype == Token.RANGE:
+            r1c1 = reference(token.value, self.address)
+
         #Remove absolute reference $
         token.value = token.value.replace('$','')
 
-        return RPNNode.create(token, sheet)
+        node = RPNNode.create(token, sheet)
+        if r1c1 is not None:
+            node.r1c1 = r1c1
+        return node
 
 
     def make_rpn(self, expression):
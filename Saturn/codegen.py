@@ -0,0 +1,365 @@
+"""
+Ahead of time compilation of a model to a python module.
+
+Given the input cells that may change and the output cells wanted, the cells in between are written out as
+straight line python: one local variable per cell, assigned in evaluation order, with operators and excel
+functions called directly. Everything that does not depend on the inputs is frozen into literals and constant
+arrays. The module has a function per output, taking the inputs it depends on as keyword arguments, and a
+calculate function taking all of them and returning every output at once:
+
+    model = loader.compile_module(['Inputs!B2', 'Inputs!B3'], ['Outputs!B10'])
+    model.Outputs_B10(Inputs_B2=0.05, Inputs_B3=12)
+    model.calculate(Inputs_B2=0.05)['Outputs!B10']
+
+Generated modules are cached alongside the workbook, keyed by the SHA-256 of the workbook and the chosen inputs
+and outputs. They reflect the workbook as loaded: compile before editing cells with setvalue or setformula, or
+pass cache=False.
+"""
+import os
+import re
+import math
+import keyword
+import hashlib
+import logging
+import importlib
+import importlib.util
+import types
+import numpy as np
+from vm import CONST, CELL, RANGE, BINARY, UNARY, CALL, SHARED, WINDOW, CompileError
+from cache import file_digest
+from ranges import RangeRef, split_address
+
+# Bump whenever the generated code changes
+CODEGEN_VERSION = 1
+
+HEADER = '# saturn-model {}\n'
+
+# Module level names of a generated module
+RESERVED = {'operator', 'excellib', 'as_tuples', 'to_array', 'calculate', 'INPUTS', 'OUTPUTS', '_frozen'}
+
+
+def identifier(address, taken):
+    '''
+    Python name for a cell, e.g. 'Sheet 1!A1' becomes Sheet_1_A1
+    @param taken: names already in use, updated with the new name
+    @return: unique valid identifier
+    '''
+    name = re.sub(r'\W', '_', address)
+    if not name.isidentifier() or keyword.iskeyword(name):
+        name = 'c_' + name
+    base, count = name, 1
+    while name in taken:
+        count += 1
+        name = '{}_{}'.format(base, count)
+    taken.add(name)
+    return name
+
+
+def literal(value):
+    '''
+    @return: python source of a constant cell value
+    '''
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return "float('{}')".format(value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    raise CompileError("Cannot write {!r} as a constant".format(value))
+
+
+class ModuleWriter:
+    """Accumulates the source of a generated module"""
+
+    def __init__(self, loader, inputs, outputs):
+        self.loader = loader
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.names = {}
+        self.taken = set(RESERVED)
+        self.functions = {}
+        self.constants = []
+        self.ranges = {}
+
+        for address in self.inputs:
+            self.names[address] = identifier(address, self.taken)
+
+        # Cells between inputs and outputs, each with its precedents among them
+        dependents = loader.dependentCone(self.inputs).difference(self.inputs)
+        self.precedents = {}
+        self.order = self.evaluation_order(dependents)
+        cycles = [address for address in self.order if address in loader.cycles]
+        if cycles:
+            raise CompileError("Circular references cannot be compiled: {}".format(cycles[:5]))
+        self.cone = set(self.order)
+        self.position = {address: index for index, address in enumerate(self.order)}
+        self.varying = self.cone | set(self.inputs)
+        self.lines = {}
+
+    def evaluation_order(self, dependents):
+        '''
+        Orders the dependents of the inputs the outputs need, precedents first. Precedents kept per cell include
+        the inputs. Like Loader.batchOrder, but a
+        range precedent is matched against the dependents when it is the larger of the two, so lookup tables
+        are not expanded cell by cell
+        @param dependents: addresses depending on the inputs
+        @return: list of addresses
+        '''
+        inputs = set(self.inputs)
+        known = dependents | inputs
+        positions = {}
+        for address in known:
+            sheet, row, col = split_address(address)
+            positions.setdefault(sheet, []).append((row, col, address))
+
+        def precedents(address):
+            found = []
+            for prec in self.loader.precMap.get(address, ()):
+                if not isinstance(prec, RangeRef):
+                    if prec in known:
+                        found.append(prec)
+                    continue
+                members = positions.get(prec.sheet, ())
+                max_row, max_col = self.loader.sheetExtent(prec.sheet)
+                min_row, min_col, last_row, last_col = prec.bounds(max_row, max_col)
+                if len(members) < (last_row - min_row + 1) * (last_col - min_col + 1):
+                    found.extend(add for row, col, add in members if prec.contains(prec.sheet, row, col))
+                else:
+                    found.extend(add for add in prec.addresses(max_row, max_col) if add in known)
+            return found
+
+        order = []
+        for root in self.outputs:
+            if root not in dependents or root in self.precedents:
+                continue
+            self.precedents[root] = precedents(root)
+            stack = [(root, iter(self.precedents[root]))]
+            while stack:
+                address, precs = stack[-1]
+                for prec in precs:
+                    if prec not in inputs and prec not in self.precedents:
+                        self.precedents[prec] = precedents(prec)
+                        stack.append((prec, iter(self.precedents[prec])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(address)
+        return order
+
+    def name(self, address):
+        if address not in self.names:
+            self.names[address] = identifier(address, self.taken)
+        return self.names[address]
+
+    def function(self, func):
+        '''
+        @return: module level alias of an operator or excel function
+        '''
+        if func not in self.functions:
+            module = 'operator' if func.__module__ == '_operator' else func.__module__
+            if getattr(importlib.import_module(module), func.__name__, None) is not func:
+                raise CompileError("Cannot import {} from {}".format(func.__name__, module))
+            self.functions[func] = ('{}.{}'.format(module, func.__name__), identifier(func.__name__, self.taken))
+        return self.functions[func][1]
+
+    def range_expression(self, ref):
+        if ref not in self.ranges:
+            max_row, max_col = self.loader.sheetExtent(ref.sheet)
+            rows = [[self.name(address) if address in self.varying else literal(self.loader.getvalue(address))
+                     for address in row] for row in ref.rows(max_row, max_col)]
+            source = '[{}]'.format(', '.join('[{}]'.format(', '.join(row)) for row in rows))
+            if any(address in self.varying for row in ref.rows(max_row, max_col) for address in row):
+                self.ranges[ref] = 'to_array({})'.format(source)
+            else:
+                # Frozen: read only, so lookups and criteria index it once for the life of the module
+                name = identifier('R{}'.format(len(self.constants)), self.taken)
+                self.constants.append('{} = _frozen({})  # {}'.format(name, source, ref))
+                self.ranges[ref] = name
+        return self.ranges[ref]
+
+    def expression(self, program):
+        '''
+        Turns a program into one python expression by running it on a stack of source strings
+        '''
+        stack = []
+        for opcode, arg in program:
+            if opcode == CONST:
+                stack.append((literal(arg), False))
+            elif opcode == CELL:
+                source = self.name(arg) if arg in self.varying else literal(self.loader.getvalue(arg))
+                stack.append((source, False))
+            elif opcode == RANGE:
+                stack.append((self.range_expression(arg), True))
+            elif opcode == BINARY:
+                right, _ = stack.pop()
+                left, _ = stack.pop()
+                stack.append(('{}({}, {})'.format(self.function(arg), left, right), False))
+            elif opcode == UNARY:
+                operand, _ = stack.pop()
+                stack.append(('{}({})'.format(self.function(arg), operand), False))
+            elif opcode == SHARED:
+                stack.append((self.expression(arg[1]), False))
+            elif opcode == WINDOW:
+                func, ref = arg
+                stack.append(('{}(as_tuples({}))'.format(self.function(func), self.range_expression(ref)), False))
+            else:
+                func, num_args, array_args = arg
+                args = stack[len(stack) - num_args:]
+                del stack[len(stack) - num_args:]
+                sources = [source if array_args or not is_range else 'as_tuples({})'.format(source)
+                           for source, is_range in args]
+                stack.append(('{}({})'.format(self.function(func), ', '.join(sources)), False))
+        assert len(stack) == 1, 'More than 1 remaining value in stack. Recheck the stack algorithm'
+        return stack[0][0]
+
+    def upstream(self, address):
+        '''
+        @return: the inputs and the cells of the evaluation order a given output depends on, itself included
+        '''
+        cells = {address}
+        stack = [address]
+        while stack:
+            for prec in self.precedents.get(stack.pop(), ()):
+                if prec not in cells:
+                    cells.add(prec)
+                    stack.append(prec)
+        return cells
+
+    def body(self, cells=None):
+        '''
+        @param cells: cells to assign, all of the evaluation order if None
+        @return: list of source lines assigning the cells, in evaluation order
+        '''
+        order = self.order if cells is None else sorted(cells & self.cone, key=self.position.get)
+        lines = []
+        for address in order:
+            if address not in self.lines:
+                cell = self.loader.getCell(address)
+                program = cell.program if cell is not None else None
+                self.lines[address] = None if program is None else '    {} = {}'.format(
+                    self.name(address), self.expression(program))
+            if self.lines[address] is not None:
+                lines.append(self.lines[address])
+        return lines
+
+    def output(self, address):
+        return self.name(address) if address in self.varying else literal(self.loader.getvalue(address))
+
+    def signature(self, inputs):
+        '''
+        @return: keyword only parameters of the given inputs, defaulting to their current values
+        '''
+        if not inputs:
+            return '()'
+        return '(*, {})'.format(', '.join('{}={}'.format(self.names[address], literal(self.loader.getvalue(address)))
+                                          for address in inputs))
+
+    def source(self, key, origin):
+        functions = {}
+        blocks = []
+        for address in self.outputs:
+            cells = self.upstream(address)
+            lines = self.body(cells)
+            name = self.name(address)
+            functions[address] = name
+            blocks.append('def {}{}:\n    """{}"""\n{}    return {}\n'.format(
+                name, self.signature([a for a in self.inputs if a in cells]), address,
+                ''.join(line + '\n' for line in lines), self.output(address)))
+
+        lines = self.body()
+        blocks.append('def calculate{}:\n    """All outputs, as a dictionary by address"""\n{}    return {{{}}}\n'.format(
+            self.signature(self.inputs), ''.join(line + '\n' for line in lines),
+            ', '.join('{!r}: {}'.format(address, self.output(address)) for address in self.outputs)))
+
+        parts = [
+            HEADER.format(key),
+            '"""\nSaturn model generated from {}. Do not edit, it is regenerated when the workbook changes\n"""\n'.format(
+                origin),
+            ''.join('import {}\n'.format(module) for module in sorted(set(
+                target.rsplit('.', 1)[0] for target, alias in self.functions.values()))),
+            'from excellib import as_tuples\nfrom ranges import to_array\n\n',
+            ''.join('{} = {}\n'.format(alias, target) for target, alias in self.functions.values()),
+            '\n\ndef _frozen(rows):\n    array = to_array(rows)\n    array.flags.writeable = False\n'
+            '    return array\n\n\n',
+            ''.join(line + '\n' for line in self.constants) + ('\n' if self.constants else ''),
+            'INPUTS = {{{}}}\n'.format(', '.join('{!r}: {!r}'.format(a, self.names[a]) for a in self.inputs)),
+            'OUTPUTS = {{{}}}\n\n\n'.format(', '.join('{!r}: {!r}'.format(a, functions[a]) for a in self.outputs)),
+            '\n\n'.join(blocks),
+        ]
+        return ''.join(parts)
+
+
+def model_key(loader, inputs, outputs):
+    '''
+    @return: hex digest identifying a workbook's content and a choice of inputs and outputs
+    '''
+    sha = hashlib.sha256()
+    sha.update(file_digest(loader.file).encode())
+    sha.update(repr((CODEGEN_VERSION, list(inputs), list(outputs))).encode())
+    return sha.hexdigest()
+
+
+def generate(loader, inputs, outputs, key=''):
+    '''
+    Writes the python source of a model
+    @param loader: Loader of the model
+    @param inputs: addresses of the cells that become keyword arguments
+    @param outputs: addresses of the cells returned
+    @param key: identifier written in the header, see model_key
+    @return: source code
+    '''
+    origin = os.path.basename(os.fspath(loader.file)) if isinstance(loader.file, (str, os.PathLike)) else 'a workbook'
+    return ModuleWriter(loader, inputs, outputs).source(key, origin)
+
+
+def module_path(file, key, cache):
+    '''
+    Where the generated module of a workbook lives
+    @param cache: True to keep it alongside the workbook, or a folder to keep it in
+    @return: path of the module, or None if there is nowhere to put it
+    '''
+    if isinstance(cache, (str, os.PathLike)):
+        os.makedirs(cache, exist_ok=True)
+        return os.path.join(cache, 'saturn_{}.py'.format(key[:16]))
+    if isinstance(file, (str, os.PathLike)):
+        return '{}.{}.py'.format(os.fspath(file), key[:16])
+    return None
+
+
+def _import(path, key):
+    spec = importlib.util.spec_from_file_location('saturn_model_{}'.format(key[:16]), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def compile_model(loader, inputs, outputs, cache=True):
+    '''
+    Generates, caches and imports the python module of a model
+    @param loader: Loader of the model
+    @param inputs: addresses of the cells that become keyword arguments
+    @param outputs: addresses of the cells returned
+    @param cache: True to keep the module alongside the workbook, a folder to keep it in, or False
+    @return: module
+    '''
+    key = model_key(loader, inputs, outputs)
+    path = module_path(loader.file, key, cache) if cache else None
+
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            if f.readline() == HEADER.format(key):
+                logging.info("Loaded compiled model from {}".format(path))
+                return _import(path, key)
+
+    source = generate(loader, inputs, outputs, key)
+    if path is None:
+        module = types.ModuleType('saturn_model_{}'.format(key[:16]))
+        exec(compile(source, '<saturn model>', 'exec'), module.__dict__)
+        return module
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(source)
+    os.replace(tmp_path, path)
+    logging.info("Saved compiled model to {}".format(path))
+    return _import(path, key)
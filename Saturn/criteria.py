@@ -0,0 +1,203 @@
+"""
+Compiled criteria for the conditional aggregates (SUMIF, SUMIFS, COUNTIF, COUNTIFS, AVERAGEIF, AVERAGEIFS).
+
+A criteria such as 5, ">=100" or "north*" is parsed once into a predicate over whole numpy arrays, following the
+comparison rules of pycel's criteria_parser. A range is first split into a typed view (its numbers, its text in
+lower case, its blanks), so a predicate is a handful of vectorised comparisons rather than a python test per cell.
+
+Views and masks of read only range arrays, i.e. the ranges the Loader caches because several formulas share them,
+are kept for as long as the array lives. *IFS formulas sharing a criteria column then compute its mask once.
+"""
+import operator
+import weakref
+from functools import lru_cache, reduce
+import numpy as np
+from pycel.excelutil import (
+    build_wildcard_re,
+    coerce_to_number,
+    ERROR_CODES,
+    is_number,
+    OPERATORS,
+    OPERATORS_RE,
+    VALUE_ERROR,
+)
+
+
+class RangeView:
+    """
+    Typed columns of a 2-D range array, all of the same shape:
+    numbers: float value of numbers and bools, nan elsewhere
+    numeric: float value of everything pycel's is_number accepts, numeric text included, nan elsewhere
+    text: lower cased text, '' elsewhere
+    plus the masks is_number, is_numeric, is_text, is_blank and is_error
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = shape = array.shape
+        if array.dtype == np.float64:
+            self.numbers = self.numeric = array
+            self.is_number = self.is_numeric = np.ones(shape, dtype=bool)
+            self.is_text = self.is_blank = self.is_error = np.zeros(shape, dtype=bool)
+            self.text = None
+            return
+
+        values = array.ravel().tolist()
+        size = len(values)
+        self.is_blank = np.fromiter((v is None for v in values), bool, size).reshape(shape)
+        self.is_text = np.fromiter((isinstance(v, str) for v in values), bool, size).reshape(shape)
+        self.is_number = np.fromiter((isinstance(v, (int, float)) for v in values), bool, size).reshape(shape)
+        self.is_error = np.fromiter((isinstance(v, str) and v in ERROR_CODES for v in values), bool, size).reshape(shape)
+        self.numbers = np.fromiter((float(v) if isinstance(v, (int, float)) else np.nan for v in values),
+                                   np.float64, size).reshape(shape)
+        self.numeric = np.fromiter((float(v) if is_number(v) else np.nan for v in values),
+                                   np.float64, size).reshape(shape)
+        self.is_numeric = self.is_number | (self.is_text & ~np.isnan(self.numeric))
+        self.text = np.array([v.lower() if isinstance(v, str) else '' for v in values], dtype=object).reshape(shape)
+
+
+def _equals_number(value):
+    def check(view):
+        return view.is_numeric & (view.numeric == value)
+    return check
+
+
+def _compare_number(op, value):
+    # Text and blanks only pass '<>'
+    def check(view):
+        others = ~(view.is_text | view.is_blank)
+        with np.errstate(invalid='ignore'):
+            mask = others & op(view.numbers, value)
+        if op is operator.ne:
+            mask |= ~others
+        return mask
+    return check
+
+
+def _compare_text(op, value):
+    def check(view):
+        mask = np.full(view.shape, op is operator.ne)
+        mask[view.is_blank] = (not value) != (op is operator.ne)
+        if view.is_text.any():
+            mask[view.is_text] = np.asarray(op(view.text[view.is_text], value), dtype=bool)
+        return mask
+    return check
+
+
+def _wildcard(match):
+    def check(view):
+        mask = np.zeros(view.shape, dtype=bool)
+        if view.is_text.any():
+            mask[view.is_text] = [bool(match(text)) for text in view.text[view.is_text]]
+        return mask
+    return check
+
+
+@lru_cache(maxsize=1024)
+def compile_criteria(criteria):
+    '''
+    Parses a criteria into a predicate over range views
+    @param criteria: number or criteria string, e.g. 5, ">=100", "<>", "north*"
+    @return: function taking a RangeView and returning a boolean mask of the cells meeting the criteria
+    '''
+    if is_number(criteria):
+        return _equals_number(coerce_to_number(criteria))
+
+    if not isinstance(criteria, str):
+        raise ValueError("Couldn't parse criteria: {}".format(criteria))
+
+    match = OPERATORS_RE.match(criteria)
+    op = OPERATORS[match.group('oper') or '']
+    value = match.group('value')
+
+    if op is operator.eq:
+        if is_number(value):
+            return _equals_number(coerce_to_number(value))
+        wildcard = build_wildcard_re(value)
+        if wildcard is not None:
+            return _wildcard(wildcard)
+
+    if is_number(value):
+        return _compare_number(op, coerce_to_number(value))
+    return _compare_text(op, value.lower())
+
+
+# Views and masks of read only arrays by id of the array. Entries go when the array is garbage collected
+_VIEWS = {}
+_MASKS = {}
+
+
+def _cached(cache, array, key, build):
+    if array.flags.writeable:
+        return build()
+
+    entry = cache.get(key)
+    if entry is not None and entry[0]() is array:
+        return entry[1]
+
+    def forget(ref):
+        if cache.get(key, (None, ))[0] is ref:
+            del cache[key]
+
+    value = build()
+    cache[key] = (weakref.ref(array, forget), value)
+    return value
+
+
+def view(array):
+    '''
+    @param array: 2-D range array
+    @return: RangeView of the array, cached if the array is read only
+    '''
+    return _cached(_VIEWS, array, id(array), lambda: RangeView(array))
+
+
+def mask(array, criteria):
+    '''
+    Cells of a range meeting a criteria
+    @param array: 2-D range array
+    @param criteria: number or criteria string
+    @return: boolean array of the range's shape, cached if the array is read only
+    '''
+    return _cached(_MASKS, array, (id(array), type(criteria), criteria),
+                   lambda: compile_criteria(criteria)(view(array)))
+
+
+def as_range(value):
+    '''
+    @return: value as a 2-D array, single values becoming a 1x1 range
+    '''
+    if isinstance(value, np.ndarray):
+        return value
+    array = np.empty((1, 1), dtype=object)
+    array[0, 0] = value
+    return array
+
+
+def ifs_mask(args, shape=None):
+    '''
+    Cells meeting every (range, criteria) pair of an *IFS function
+    @param args: criteria_range1, criteria1, criteria_range2, criteria2, ...
+    @param shape: shape the ranges must have, that of the range to aggregate
+    @return: boolean array, or #VALUE! if the ranges differ in shape
+    '''
+    assert len(args) and len(args) % 2 == 0, 'Must have paired criteria and ranges'
+    ranges = [as_range(rng) for rng in args[::2]]
+    shapes = set(rng.shape for rng in ranges)
+    if len(shapes) != 1 or (shape is not None and shape not in shapes):
+        return VALUE_ERROR
+    return reduce(operator.and_, (mask(rng, criteria) for rng, criteria in zip(ranges, args[1::2])))
+
+
+def selected_numbers(array, selection):
+    '''
+    Numbers among the selected cells of a range. Text and blanks are skipped, bools count as numbers
+    @param array: 2-D range array
+    @param selection: boolean mask of the cells to take
+    @return: float array of the numbers, or the first error code found among the selected cells
+    '''
+    range_view = view(array)
+    errors = selection & range_view.is_error
+    if errors.any():
+        return array.ravel()[np.flatnonzero(errors.ravel())[0]]
+    return range_view.numbers[selection & range_view.is_number]
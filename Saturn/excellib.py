@@ -2,10 +2,13 @@
 Python equivalents of various excel functions
 """
 import math
+import weakref
+from functools import lru_cache
 from bisect import bisect_right
 from decimal import Decimal, ROUND_HALF_UP, ROUND_UP
 import operator
 import numpy as np
+import criteria as crit
 
 from pycel.excelutil import (
     build_wildcard_re,
@@ -13,14 +16,13 @@ from pycel.excelutil import (
     DIV0,
     ERROR_CODES,
     ExcelCmp,
-    find_corresponding_index,
     flatten,
-    handle_ifs,
     is_number,
     list_like,
     MAX_COL,
     MAX_ROW,
     NA_ERROR,
+    NAME_ERROR,
     NUM_ERROR,
     REF_ERROR,
     VALUE_ERROR,
@@ -48,9 +50,322 @@ FUNC_MAP = {
     'AVERAGEIF': 'averageif',
     'SUMIF':'sumif',
     'COUNT':'count',
-    'COUNTIF':'countifs'
+    'COUNTIF':'countifs',
+    'ABS': 'x_abs',
+    'ATAN2': 'xatan2',
+    'INT': 'x_int',
+    'ROUND': 'x_round',
 }
 
+
+# Operators read their operands as Excel does. Two numbers take the fast path, anything else goes through
+# _arithmetic or _compare. Arrays of numbers, e.g. Scenarios vectors, are left to numpy and other arrays are
+# worked element by element
+_NUMBERS = (int, float)
+
+
+def _number(value):
+    '''
+    Operand of an arithmetic operator as Excel reads it: blanks are 0, TRUE and FALSE are 1 and 0, and text is
+    the number it spells
+    @return: number, or the error code of an error or of text that is not a number
+    '''
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        if value in ERROR_CODES:
+            return value
+        value = coerce_to_number(value)
+        return VALUE_ERROR if isinstance(value, str) else value
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _error(*values):
+    '''
+    @return: the first of the values that is an error code, None if there is none
+    '''
+    return next((v for v in values if isinstance(v, str) and v in ERROR_CODES), None)
+
+
+def _is_objects(value):
+    return isinstance(value, np.ndarray) and value.dtype == object
+
+
+@lru_cache(maxsize=None)
+def _elementwise(func, nin):
+    return np.frompyfunc(func, nin, 1)
+
+
+def _arithmetic(func, calc, a, b):
+    '''
+    Arithmetic on operands other than two numbers
+    @param func: the operator, applied to the elements of arrays that are not all numbers
+    @param calc: function of two numbers, or of numbers and arrays of numbers, working the result out
+    @return: result, or the first error met
+    '''
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        if _is_objects(a) or _is_objects(b):
+            return _elementwise(func, 2)(a, b)
+        if not isinstance(a, np.ndarray):
+            a = _number(a)
+        if not isinstance(b, np.ndarray):
+            b = _number(b)
+    else:
+        a = _number(a)
+        b = _number(b)
+    error = _error(a, b)
+    if error is not None:
+        return error
+    return calc(a, b)
+
+
+def _add(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a + b
+    return _arithmetic(_add, operator.add, a, b)
+
+
+def _sub(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a - b
+    return _arithmetic(_sub, operator.sub, a, b)
+
+
+def _mul(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a * b
+    return _arithmetic(_mul, operator.mul, a, b)
+
+
+def _divide(a, b):
+    if isinstance(b, np.ndarray):
+        # Element by element, with #DIV/0! where the divisor is zero
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = a / b
+        zero = np.broadcast_to(b == 0, result.shape)
+        if zero.any():
+            result = result.astype(object)
+            result[zero] = DIV0
+        return result
+    if not b:
+        return DIV0
+    return a / b
+
+
+def _div(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a / b if b else DIV0
+    return _arithmetic(_div, _divide, a, b)
+
+
+def _power(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return a ** b
+    if a == 0 and b == 0:
+        return NUM_ERROR
+    try:
+        result = a ** b
+    except ZeroDivisionError:
+        return DIV0
+    except OverflowError:
+        return NUM_ERROR
+    # Fractional powers of negative numbers
+    return NUM_ERROR if isinstance(result, complex) else result
+
+
+def _pow(a, b):
+    return _arithmetic(_pow, _power, a, b)
+
+
+def _unary(func, calc, a):
+    '''
+    Unary operators, as _arithmetic
+    '''
+    if _is_objects(a):
+        return _elementwise(func, 1)(a)
+    if not isinstance(a, np.ndarray):
+        a = _number(a)
+        if isinstance(a, str):
+            return a
+    return calc(a)
+
+
+def _neg(a):
+    if type(a) in _NUMBERS:
+        return -a
+    return _unary(_neg, operator.neg, a)
+
+
+def _pos(a):
+    if type(a) in _NUMBERS:
+        return a
+    return _unary(_pos, operator.pos, a)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    elif isinstance(value, bool):
+        return str(value).upper()
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _concat(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        # Element by element, as text of each value rather than of the whole array
+        return _elementwise(_concat, 2)(a, b)
+    error = _error(a, b)
+    if error is not None:
+        return error
+    return _text(a) + _text(b)
+
+
+def _hundredth(a):
+    return a / 100
+
+
+def _percent(a):
+    if type(a) in _NUMBERS:
+        return a / 100
+    return _unary(_percent, _hundredth, a)
+
+
+def _compare(func, op, a, b):
+    '''
+    Comparison of operands other than two numbers. Errors are passed on, the first one first. Otherwise numbers
+    come before text and text before TRUE and FALSE, text is compared regardless of case, and blanks are taken
+    as 0, '' or FALSE, whichever they are compared with
+    @param func: the operator, applied to the elements of arrays that are not all numbers
+    @param op: python comparison
+    '''
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        if _is_objects(a) or _is_objects(b):
+            return _elementwise(func, 2)(a, b)
+        return op(0 if a is None else a, 0 if b is None else b)
+    error = _error(a, b)
+    if error is not None:
+        return error
+    if isinstance(a, str) and isinstance(b, str):
+        return op(a.lower(), b.lower())
+    right = ExcelCmp(b)
+    left = ExcelCmp(a, empty=right)
+    if b is None:
+        right = ExcelCmp(b, empty=left)
+    return op(left, right)
+
+
+def _eq(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a == b
+    return _compare(_eq, operator.eq, a, b)
+
+
+def _ne(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a != b
+    return _compare(_ne, operator.ne, a, b)
+
+
+def _lt(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a < b
+    return _compare(_lt, operator.lt, a, b)
+
+
+def _gt(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a > b
+    return _compare(_gt, operator.gt, a, b)
+
+
+def _le(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a <= b
+    return _compare(_le, operator.le, a, b)
+
+
+def _ge(a, b):
+    if type(a) in _NUMBERS and type(b) in _NUMBERS:
+        return a >= b
+    return _compare(_ge, operator.ge, a, b)
+
+
+INFIX_OPERATORS = {
+    '+': _add,
+    '-': _sub,
+    '*': _mul,
+    '/': _div,
+    '^': _pow,
+    '&': _concat,
+    '=': _eq,
+    '<>': _ne,
+    '<': _lt,
+    '>': _gt,
+    '<=': _le,
+    '>=': _ge,
+}
+
+PREFIX_OPERATORS = {
+    '-': _neg,
+    '+': _pos,
+}
+
+POSTFIX_OPERATORS = {
+    '%': _percent,
+}
+
+
+def _name_error(*args):
+    return NAME_ERROR
+
+
+def get_function(name):
+    """Resolves an excel function name to its python equivalent in this module"""
+    func = globals().get(FUNC_MAP.get(name, name.lower().replace('.', '_')))
+    if not callable(func):
+        return _name_error
+    return func
+
+def array_args(func):
+    """Marks functions that take ranges as 2-D numpy arrays. Others get them as tuples of row tuples"""
+    func.array_args = True
+    return func
+
+
+def as_tuples(value):
+    """Converts a 2-D numpy range to the nested tuples the pycel derived functions expect"""
+    if isinstance(value, np.ndarray):
+        return tuple(map(tuple, value.tolist()))
+    return value
+
+
+def _float_arrays(args):
+    """
+    Fast path test for vectorised aggregates. Returns the arguments as float64 arrays if every argument is
+    a purely numeric range or a plain number, else None
+    """
+    arrays = []
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            if arg.dtype != np.float64:
+                return None
+            arrays.append(arg)
+        elif isinstance(arg, (int, float)) and not isinstance(arg, bool):
+            arrays.append(np.array([arg], dtype=np.float64))
+        else:
+            return None
+    return arrays
+
+
+def _scalar(value):
+    """Numpy scalars picked out of a range are returned as python values"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
 def _numerics(*args, keep_bools=False):
     # ignore non numeric cells
     args = tuple(flatten(args))
@@ -64,9 +379,15 @@ def _numerics(*args, keep_bools=False):
         return tuple(x for x in args if isinstance(x, (int, float)))
 
 
+@array_args
 def average(*args):
     # Excel reference: https://support.office.com/en-us/article/
     #   average-function-047bac88-d466-426c-a32b-8f33eb960cf6
+    arrays = _float_arrays(args)
+    if arrays is not None:
+        size = sum(a.size for a in arrays)
+        return float(sum(a.sum() for a in arrays)) / size if size else DIV0
+
     data = _numerics(*args)
 
     # A returned string is an error code
@@ -78,6 +399,7 @@ def average(*args):
         return sum(data) / len(data)
 
 
+@array_args
 def averageif(rng, criteria, average_range=None):
     # Excel reference: https://support.office.com/en-us/article/
     #   averageif-function-faec8e2e-0dec-4308-af69-f5576d8ac642
@@ -94,17 +416,16 @@ def averageif(rng, criteria, average_range=None):
     return averageifs(average_range, rng, criteria)
 
 
+@array_args
 def averageifs(average_range, *args):
     # Excel reference: https://support.office.com/en-us/article/
     #   AVERAGEIFS-function-48910C45-1FC0-4389-A028-F7C5C3001690
-    if not list_like(average_range):
-        average_range = ((average_range, ), )
-
-    coords = handle_ifs(args, average_range)
-    data = _numerics((average_range[r][c] for r, c in coords), keep_bools=True)
+    data = _ifs_numbers(average_range, args)
+    if isinstance(data, str):
+        return data
     if len(data) == 0:
         return DIV0
-    return sum(data) / len(data)
+    return float(data.mean())
 
 
 @excel_math_func
@@ -161,9 +482,13 @@ def column(ref):
         return ref.col_idx
 
 
+@array_args
 def count(*args):
     # Excel reference: https://support.office.com/en-us/article/
     #   COUNT-function-a59cd7fc-b623-4d93-87a4-d23bf411294c
+    arrays = _float_arrays(args)
+    if arrays is not None:
+        return sum(a.size for a in arrays)
 
     total = 0
 
@@ -179,13 +504,11 @@ def count(*args):
     return total
 
 
+@array_args
 def countif(rng, criteria):
     # Excel reference: https://support.office.com/en-us/article/
     #   COUNTIF-function-e0de10c6-f885-4e71-abb4-1f464816df34
-    if not list_like(rng):
-        rng = ((rng, ), )
-    valid = find_corresponding_index(rng, criteria)
-    return len(valid)
+    return countifs(rng, criteria)
 
 
 def conditional_format_ids(*args):
@@ -202,10 +525,14 @@ def conditional_format_ids(*args):
     return results
 
 
+@array_args
 def countifs(*args):
     # Excel reference: https://support.office.com/en-us/article/
     #   COUNTIFS-function-dda3dc6e-f74e-4aee-88bc-aa8c2a866842
-    return len(handle_ifs(args))
+    mask = crit.ifs_mask(args)
+    if isinstance(mask, str):
+        return mask
+    return int(np.count_nonzero(mask))
 
 
 @excel_math_func
@@ -277,6 +604,7 @@ def floor_precise(number, significance=1):
     return significance * math.floor(number / significance)
 
 
+@array_args
 @excel_helper(cse_params=0, bool_params=3, number_params=2)
 def hlookup(lookup_value, table_array, row_index_num, range_lookup=True):
     """ Horizontal Lookup
@@ -290,6 +618,17 @@ def hlookup(lookup_value, table_array, row_index_num, range_lookup=True):
     # Excel reference: https://support.office.com/en-us/article/
     #   hlookup-function-a3034eec-b719-4ba3-bb65-e1ad662ed95f
 
+    if isinstance(table_array, np.ndarray):
+        if row_index_num <= 0:
+            return VALUE_ERROR
+        if row_index_num > table_array.shape[0]:
+            return REF_ERROR
+        result_idx = _lookup_position(lookup_value, table_array[0, :], int(bool(range_lookup)),
+                                      _lookup_index(table_array, 'row'))
+        if isinstance(result_idx, int):
+            return _scalar(table_array[int(row_index_num) - 1, result_idx - 1])
+        return result_idx
+
     if not list_like(table_array):
         return NA_ERROR
 
@@ -448,6 +787,7 @@ def log(number, base=10):
     return math.log(number, base)
 
 
+@array_args
 @excel_helper(cse_params=0)
 def lookup(lookup_value, lookup_array, result_range=None):
     """
@@ -466,6 +806,23 @@ def lookup(lookup_value, lookup_array, result_range=None):
     :param result_range: (optional vector form) values are returned from here
     :return: #N/A if not found else value
     """
+    if isinstance(lookup_array, np.ndarray):
+        height, width = lookup_array.shape
+        if width <= height:
+            match_idx = _lookup_position(lookup_value, lookup_array[:, 0], 1, _lookup_index(lookup_array, 'col'))
+            result = lookup_array[:, -1]
+        else:
+            match_idx = _lookup_position(lookup_value, lookup_array[0, :], 1, _lookup_index(lookup_array, 'row'))
+            result = lookup_array[-1, :]
+        if height == 1 or width == 1:
+            if isinstance(result_range, np.ndarray):
+                result = result_range.ravel()
+            elif result_range:
+                return VALUE_ERROR
+        if isinstance(match_idx, int):
+            return _scalar(result[match_idx - 1]) if match_idx <= len(result) else NA_ERROR
+        return match_idx
+
     if not list_like(lookup_array):
         return NA_ERROR
 
@@ -508,19 +865,14 @@ def match(lookup_value, lookup_array, match_type=1):
     return _match(lookup_value, lookup_array, match_type)
 
 
+@array_args
 def maxifs(max_range, *args):
     # Excel reference: https://support.office.com/en-us/article/
     #   maxifs-function-dfd611e6-da2c-488a-919b-9b6376b28883
-    if not list_like(max_range):
-        max_range = ((max_range, ), )
-
-    try:
-        return max(_numerics(
-            (max_range[r][c] for r, c in handle_ifs(args, max_range)),
-            keep_bools=True
-        ))
-    except ValueError:
-        return 0
+    data = _ifs_numbers(max_range, args)
+    if isinstance(data, str):
+        return data
+    return float(data.max()) if len(data) else 0
 
 
 def _match(lookup_value, lookup_array, match_type=1):
@@ -595,19 +947,14 @@ def _match(lookup_value, lookup_array, match_type=1):
     return result[0]
 
 
+@array_args
 def minifs(min_range, *args):
     # Excel reference: https://support.office.com/en-us/article/
     #   minifs-function-6ca1ddaa-079b-4e74-80cc-72eef32e6599
-    if not list_like(min_range):
-        min_range = ((min_range, ), )
-
-    try:
-        return min(_numerics(
-            (min_range[r][c] for r, c in handle_ifs(args, min_range)),
-            keep_bools=True
-        ))
-    except ValueError:
-        return 0
+    data = _ifs_numbers(min_range, args)
+    if isinstance(data, str):
+        return data
+    return float(data.min()) if len(data) else 0
 
 
 @excel_math_func
@@ -680,6 +1027,19 @@ def sign(value):
     return -1 if value < 0 else int(bool(value))
 
 
+def _ifs_numbers(op_range, args):
+    """
+    Numbers of op_range in the cells meeting every (range, criteria) pair of args.
+    Returns an error code if the ranges differ in shape or a selected cell holds an error
+    """
+    op_range = crit.as_range(op_range)
+    mask = crit.ifs_mask(args, op_range.shape)
+    if isinstance(mask, str):
+        return mask
+    return crit.selected_numbers(op_range, mask)
+
+
+@array_args
 def sumif(rng, criteria, sum_range=None):
     # Excel reference: https://support.office.com/en-us/article/
     #   SUMIF-function-169b8c99-c05c-4483-a712-1697a653039b
@@ -697,21 +1057,26 @@ def sumif(rng, criteria, sum_range=None):
     return sumifs(sum_range, rng, criteria)
 
 
+@array_args
 def sumifs(sum_range, *args):
     # Excel reference: https://support.office.com/en-us/article/
     #   SUMIFS-function-C9E748F5-7EA7-455D-9406-611CEBCE642B
-    if not list_like(sum_range):
-        sum_range = ((sum_range, ), )
-
-    return sum(_numerics(
-        (sum_range[r][c] for r, c in handle_ifs(args, sum_range)),
-        keep_bools=True
-    ))
+    data = _ifs_numbers(sum_range, args)
+    if isinstance(data, str):
+        return data
+    return float(data.sum())
 
 
+@array_args
 def sumproduct(*args):
     # Excel reference: https://support.office.com/en-us/article/
     #   SUMPRODUCT-function-16753E75-9F68-4874-94AC-4D2145A2FD2E
+    if all(isinstance(arg, np.ndarray) for arg in args):
+        if len(set(arg.shape for arg in args)) != 1:
+            return VALUE_ERROR
+        if all(arg.dtype == np.float64 for arg in args):
+            return float(np.sum(np.prod(args, axis=0)))
+        args = tuple(as_tuples(arg) for arg in args)
 
     # find any errors
     error = next((i for i in flatten(args) if i in ERROR_CODES), None)
@@ -743,6 +1108,111 @@ def trunc(number, num_digits=0):
     return int(number * factor) / factor
 
 
+class _LookupIndex:
+    """
+    Search structures for the lookup vector of a range: a hash map from value to first position for exact
+    matches, and sorted keys for bisecting approximate matches. Built once per read only range array
+    """
+
+    def __init__(self, vector):
+        self.values = tuple(vector.tolist())
+        self.numbers = vector if vector.dtype == np.float64 else None
+        if self.numbers is not None:
+            self.ascending = not np.any(vector[:-1] > vector[1:])
+            self.descending = not np.any(vector[:-1] < vector[1:])
+            self.negated = -vector
+
+        # Keys compare as in _match: text ignores case, blanks equal zero, errors never match
+        self.positions = {}
+        for i, value in enumerate(self.values, 1):
+            if value not in ERROR_CODES:
+                self.positions.setdefault(tuple(ExcelCmp(value)[:2]), i)
+        self.keys = None
+
+    def position(self, lookup_value, match_type):
+        if match_type == 0:
+            lookup = ExcelCmp(lookup_value)
+            if lookup.cmp_type == 1 and build_wildcard_re(lookup.value) is not None:
+                return _match(lookup_value, self.values, match_type)
+            return self.positions.get(tuple(lookup[:2]), NA_ERROR)
+
+        if (self.numbers is not None and isinstance(lookup_value, (int, float)) and
+                not isinstance(lookup_value, bool)):
+            if match_type == 1:
+                position = int(np.searchsorted(self.numbers, lookup_value, side='right'))
+            else:
+                # descending vector, count of values >= lookup_value
+                position = int(np.searchsorted(self.negated, -lookup_value, side='right'))
+            return position if position else NA_ERROR
+
+        if match_type == 1:
+            if self.keys is None:
+                self.keys = [ExcelCmp(value) for value in self.values]
+            lookup = ExcelCmp(lookup_value)
+            result = bisect_right(self.keys, lookup)
+            while result and lookup.cmp_type != self.keys[result - 1].cmp_type:
+                result -= 1
+            return result if result else NA_ERROR
+
+        return _match(lookup_value, self.values, match_type)
+
+
+# Lookup indexes by (id of range array, axis). Entries go when their array is garbage collected
+_LOOKUP_INDEXES = {}
+
+
+def _lookup_index(array, axis):
+    """
+    Lookup index of a range array, cached for as long as the array lives. Only read only arrays are indexed:
+    the Loader freezes the arrays of ranges it caches and replaces them when one of their cells changes, so the
+    identity of an array stands for one version of the range's values
+    :param axis: 'col' for the first column, 'row' for the first row, 'flat' for the whole range
+    :return: _LookupIndex, or None if the array may still change
+    """
+    if array.flags.writeable:
+        return None
+
+    key = (id(array), axis)
+    entry = _LOOKUP_INDEXES.get(key)
+    if entry is not None and entry[0]() is array:
+        return entry[1]
+
+    def forget(ref):
+        if _LOOKUP_INDEXES.get(key, (None, ))[0] is ref:
+            del _LOOKUP_INDEXES[key]
+
+    vector = array[:, 0] if axis == 'col' else array[0, :] if axis == 'row' else array.ravel()
+    index = _LookupIndex(vector)
+    _LOOKUP_INDEXES[key] = (weakref.ref(array, forget), index)
+    return index
+
+
+def _lookup_position(lookup_value, vector, match_type, index=None):
+    """
+    1-based position of lookup_value in a 1-D numpy vector, with MATCH semantics.
+    Uses the vector's lookup index if given. Otherwise purely numeric vectors are searched with numpy,
+    anything else goes through _match
+    """
+    if index is not None:
+        return index.position(lookup_value, match_type)
+
+    if (vector.dtype == np.float64 and isinstance(lookup_value, (int, float)) and
+            not isinstance(lookup_value, bool)):
+        if match_type == 0:
+            hits = np.flatnonzero(vector == lookup_value)
+            return int(hits[0]) + 1 if len(hits) else NA_ERROR
+        elif match_type == 1:
+            # largest value <= lookup_value, vector assumed ascending as in Excel
+            position = int(np.searchsorted(vector, lookup_value, side='right'))
+        else:
+            # smallest value >= lookup_value, vector assumed descending
+            position = int(np.count_nonzero(vector >= lookup_value))
+        return position if position else NA_ERROR
+
+    return _match(lookup_value, tuple(vector.tolist()), match_type)
+
+
+@array_args
 @excel_helper(cse_params=0, bool_params=3, number_params=2)
 def vlookup(lookup_value, table_array, col_index_num, range_lookup=True):
     """ Vertical Lookup
@@ -756,11 +1226,22 @@ def vlookup(lookup_value, table_array, col_index_num, range_lookup=True):
     # Excel reference: https://support.office.com/en-us/article/
     #   VLOOKUP-function-0BBC8083-26FE-4963-8AB8-93A18AD188A1
 
+    if isinstance(table_array, np.ndarray):
+        if col_index_num <= 0:
+            return VALUE_ERROR
+        if col_index_num > table_array.shape[1]:
+            return REF_ERROR
+        result_idx = _lookup_position(lookup_value, table_array[:, 0], int(bool(range_lookup)),
+                                      _lookup_index(table_array, 'col'))
+        if isinstance(result_idx, int):
+            return _scalar(table_array[result_idx - 1, int(col_index_num) - 1])
+        return result_idx
+
     if not list_like(table_array):
         return NA_ERROR
 
     if col_index_num <= 0:
-        return '#VALUE!'
+        return VALUE_ERROR
 
     if col_index_num > len(table_array[0]):
         return REF_ERROR
@@ -801,7 +1282,12 @@ def x_int(value1):
     return math.floor(value1)
 
 
+@array_args
 def xmax(*args):
+    arrays = _float_arrays(args)
+    if arrays is not None:
+        return max((float(a.max()) for a in arrays if a.size), default=0)
+
     data = _numerics(*args)
 
     # A returned string is an error code
@@ -815,7 +1301,12 @@ def xmax(*args):
         return max(data)
 
 
+@array_args
 def xmin(*args):
+    arrays = _float_arrays(args)
+    if arrays is not None:
+        return min((float(a.min()) for a in arrays if a.size), default=0)
+
     data = _numerics(*args)
 
     # A returned string is an error code
@@ -847,7 +1338,12 @@ def x_round(number, num_digits=0):
         return round(number, num_digits)
 
 
+@array_args
 def xsum(*args):
+    arrays = _float_arrays(args)
+    if arrays is not None:
+        return float(sum(a.sum() for a in arrays))
+
     data = _numerics(*args)
     if isinstance(data, str):
         return data
@@ -855,9 +1351,30 @@ def xsum(*args):
     # if no non numeric cells, return zero (is what excel does)
     return sum(data)
 
+@array_args
 @excel_helper()
 def match(lookup_value, lookup_range, match_type=1): # Excel reference: https://support.office.com/en-us/article/MATCH-function-e8dffd45-c762-47d6-bf89-533f4a37673a
 
+    if isinstance(lookup_range, np.ndarray):
+        vector = lookup_range.ravel()
+        index = _lookup_index(lookup_range, 'flat')
+        if (vector.dtype == np.float64 and isinstance(lookup_value, (int, float)) and
+                not isinstance(lookup_value, bool)):
+            # lookup_range must be sorted ascending for match_type 1 and descending for -1
+            if index is not None:
+                ascending, descending = index.ascending, index.descending
+            else:
+                ascending = match_type != 1 or not np.any(vector[:-1] > vector[1:])
+                descending = match_type != -1 or not np.any(vector[:-1] < vector[1:])
+            if match_type == 1 and not ascending:
+                return VALUE_ERROR
+            if match_type == -1 and not descending:
+                return VALUE_ERROR
+            return _lookup_position(lookup_value, vector, match_type, index)
+        if index is not None and match_type == 0:
+            return index.position(lookup_value, match_type)
+        lookup_range = as_tuples(lookup_range)
+
     if list_like(lookup_range) is False:
         return ExcelError('#VALUE!', 'Lookup_range is not a Range')
 
@@ -927,6 +1444,7 @@ def match(lookup_value, lookup_range, match_type=1): # Excel reference: https://
             return ExcelError('#VALUE!', 'no result in lookup_range for match_type -1')
         return posMin +1 #Excel starts at 1
 
+@array_args
 def choose(index_num, *values): # Excel reference: https://support.office.com/en-us/article/CHOOSE-function-fc5c184f-cb62-4ec7-a46e-38653b98f5bc
 
     index = int(index_num)
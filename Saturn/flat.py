@@ -0,0 +1,889 @@
+"""
+Flat array layout of a loaded model.
+
+A calculated Loader is flattened into a handful of numpy arrays that hold everything needed to recalculate it,
+with no python objects per cell:
+
+    cells        cell ids in (sheet, column, row) order, so the cells of a column are a contiguous run of ids.
+                 cell_keys holds the sorted sheet id << 48 | column << 24 | row of each cell, so an address is
+                 found with one binary search, and the addresses table the address of each id
+    values       value of each cell as a float64 and a kind byte. Values that are not numbers, e.g. text and
+                 errors, are kept in a pickled side table and the float64 holds their index in it
+    programs     opcode and argument streams per cell, indexed by code_ptr, with the arguments pointing into a
+                 constant pool, the cell ids, a range table, a function table, a call table and a window table
+    precedents   CSR lists of the cells and ranges each formula reads
+    dependents   CSR lists of the formulas reading each cell, and each range. Ranges are also listed by bucket,
+                 a column and a block of 2 ** BUCKET_BITS rows, for finding the ranges that cover a cell
+
+The arrays are written one after another into a single buffer behind a small JSON header, see write_layout and
+read_layout, so a model can be put in shared memory, see sharedmodel, or in a file, see save_model and load_model,
+and used from there as it is. The buffer holds:
+
+    MAGIC, then the length of the header as 8 bytes little endian, then the UTF-8 JSON header
+    {"version": FORMAT_VERSION, "settings": {...}, "arrays": {name: [numpy dtype string, shape, offset]}}
+    then the arrays, each at its offset from the first multiple of ALIGN bytes past the header
+
+so it can be read with any numpy, or by hand, without Saturn.
+FlatModel reads a model from such a buffer and never writes to it. Each Session keeps the values it changes and
+recalculates in a private overlay on top of it.
+"""
+import os
+import mmap
+import json
+import pickle
+import logging
+import importlib
+import numpy as np
+from functools import lru_cache
+from ranges import split_address, to_array
+from windows import ColumnSums
+from vm import CONST, CELL, RANGE, BINARY, UNARY, CALL, SHARED, WINDOW, CompileError, execute
+from excellib import as_tuples
+
+
+MAGIC = b'SATURNFLAT\x00\x01'
+FORMAT_VERSION = 2
+FLAT_SUFFIX = '.saturnflat'
+
+# Arrays start at multiples of this, so that every dtype is aligned
+ALIGN = 64
+
+# Bits of the row and of the column in a cell key
+KEY_BITS = 24
+KEY_MASK = (1 << KEY_BITS) - 1
+
+# Rows of the blocks ranges are listed under. A range is listed once per column and block it overlaps
+BUCKET_BITS = 8
+
+# Kinds of values
+EMPTY, FLOAT, INT, BOOL, OBJECT, PENDING = range(6)
+
+# Largest magnitude of an int kept exactly in a float64
+MAX_EXACT_INT = 2 ** 53
+
+# Largest range whose cells are tested against the dirty set one by one. Larger ones test the dirty set against
+# the range, all at once
+SMALL_RANGE = 64
+
+# Decoded programs kept by each FlatModel
+PROGRAM_CACHE = 65536
+
+# Stands for a value missing from an overlay, where None is a value
+_MISSING = object()
+
+
+def encode_value(value, objects):
+    '''
+    @param objects: side table, appended to for values that are not numbers
+    @return: (kind, float64 number)
+    '''
+    if value is None:
+        return EMPTY, 0.0
+    if type(value) is bool:
+        return BOOL, float(value)
+    if isinstance(value, float):
+        return FLOAT, float(value)
+    if type(value) is int and -MAX_EXACT_INT <= value <= MAX_EXACT_INT:
+        return INT, float(value)
+    objects.append(value)
+    return OBJECT, float(len(objects) - 1)
+
+
+def decode_value(kind, number, objects):
+    if kind == FLOAT:
+        return number
+    if kind == INT:
+        return int(number)
+    if kind == BOOL:
+        return bool(number)
+    if kind == OBJECT:
+        return objects[int(number)]
+    return None
+
+
+def cell_key(sheet, row, col):
+    '''
+    @param sheet: sheet id
+    @return: int key of a cell, ordering cells by sheet, column and row
+    '''
+    return (sheet << 2 * KEY_BITS) | (col << KEY_BITS) | row
+
+
+def encode_strings(strings):
+    '''
+    @return: (uint8 array of the utf-8 bytes of the strings one after another, int64 array of n + 1 offsets)
+    '''
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8).copy(), offsets
+
+
+def decode_string(data, offsets, index):
+    return bytes(data[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+
+def csr(lists):
+    '''
+    @param lists: list of lists of ints
+    @return: (int64 array of n + 1 offsets, int32 array of the items one list after another)
+    '''
+    ptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(items) for items in lists], out=ptr[1:])
+    items = np.fromiter((item for items in lists for item in items), dtype=np.int32, count=int(ptr[-1]))
+    return ptr, items
+
+
+def function_name(func):
+    '''
+    @return: 'module:name' a function can be imported back from
+    '''
+    module = 'operator' if func.__module__ == '_operator' else func.__module__
+    if getattr(importlib.import_module(module), func.__name__, None) is not func:
+        raise CompileError("Cannot import {} from {}".format(func.__name__, module))
+    return '{}:{}'.format(module, func.__name__)
+
+
+def import_function(name):
+    module, name = name.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def flatten(loader):
+    '''
+    Flattens a Loader into arrays. Every formula is calculated first, and the values it holds become the baseline
+    of the flat model. Formulas that fail to calculate are kept as PENDING and calculated again by each Session
+    @param loader: Loader
+    @return: (dictionary of numpy arrays by name, dictionary of settings)
+    '''
+    formulas = [address for address, cell in loader.cells.items() if cell.program is not None]
+    loader.getvalues(formulas)
+
+    # Cells read by formulas get ids whether they exist or not, as they do in precMap
+    addresses = set(loader.cells)
+    for address in formulas:
+        addresses.update(prec for prec in loader.precMap.get(address, ()) if isinstance(prec, str))
+    parts = {address: split_address(address) for address in addresses}
+    sheets = sorted(set(sheet for sheet, row, col in parts.values()))
+    sheet_ids = {sheet: index for index, sheet in enumerate(sheets)}
+
+    def key(address):
+        sheet, row, col = parts[address]
+        return cell_key(sheet_ids[sheet], row, col)
+
+    order = sorted(addresses, key=key)
+    ids = {address: index for index, address in enumerate(order)}
+    cell_keys = np.array([key(address) for address in order], dtype=np.int64)
+    col_keys = set((cell_keys >> KEY_BITS).tolist())
+
+    objects = []
+    kinds = np.zeros(len(order), dtype=np.uint8)
+    numbers = np.zeros(len(order), dtype=np.float64)
+    for index, address in enumerate(order):
+        cell = loader.cells.get(address)
+        if cell is None:
+            continue
+        if cell.needs_calc:
+            kinds[index] = PENDING
+        else:
+            kinds[index], numbers[index] = encode_value(cell.value, objects)
+
+    consts, const_index = [], {}
+    ranges, range_index = [], {}
+    functions, function_index = [], {}
+    calls, call_index = [], {}
+    windows, window_index = [], {}
+
+    def lookup(table, index, item):
+        try:
+            if item not in index:
+                index[item] = len(table)
+                table.append(item)
+            return index[item]
+        except TypeError:
+            # Unhashable constant, e.g. an array
+            table.append(item)
+            return len(table) - 1
+
+    def function(func):
+        return lookup(functions, function_index, function_name(func))
+
+    def call(func, num_args, array_args):
+        return lookup(calls, call_index, (function(func), num_args, int(array_args)))
+
+    def bounded(ref):
+        max_row, max_col = loader.sheetExtent(ref.sheet)
+        return lookup(ranges, range_index, (sheet_ids.get(ref.sheet, -1),) + ref.bounds(max_row, max_col))
+
+    def emit(program, code):
+        for opcode, arg in program:
+            if opcode == CONST:
+                code.append((CONST, lookup(consts, const_index, (type(arg), arg))))
+            elif opcode == CELL:
+                code.append((CELL, ids[arg]))
+            elif opcode == RANGE:
+                code.append((RANGE, bounded(arg)))
+            elif opcode in (BINARY, UNARY):
+                code.append((opcode, function(arg)))
+            elif opcode == CALL:
+                code.append((CALL, call(*arg)))
+            elif opcode == WINDOW:
+                code.append((WINDOW, lookup(windows, window_index, (function(arg[0]), bounded(arg[1])))))
+            elif opcode == SHARED:
+                emit(arg[1], code)
+            else:
+                raise CompileError("Unknown opcode {}".format(opcode))
+
+    codes, cell_precs, range_precs = [], [], []
+    for address in order:
+        cell = loader.cells.get(address)
+        code = []
+        if cell is not None and cell.program is not None:
+            emit(cell.program, code)
+        codes.append(code)
+        cell_precs.append(sorted(set(arg for opcode, arg in code if opcode == CELL)))
+        range_precs.append(sorted(set([arg for opcode, arg in code if opcode == RANGE] +
+                                      [windows[arg][1] for opcode, arg in code if opcode == WINDOW])))
+
+    cell_deps = [[] for _ in order]
+    range_deps = [[] for _ in ranges]
+    for index in range(len(order)):
+        for prec in cell_precs[index]:
+            cell_deps[prec].append(index)
+        for prec in range_precs[index]:
+            range_deps[prec].append(index)
+
+    # Ranges by bucket over the columns holding cells, for finding the ranges that cover a cell
+    buckets = {}
+    for index, (sheet, min_row, min_col, max_row, max_col) in enumerate(ranges):
+        if sheet < 0:
+            continue
+        for col in range(min_col, max_col + 1):
+            column = (sheet << KEY_BITS) | col
+            if column not in col_keys:
+                continue
+            for block in range(min_row >> BUCKET_BITS, (max_row >> BUCKET_BITS) + 1):
+                buckets.setdefault((column << KEY_BITS) | block, []).append(index)
+    bucket_keys = sorted(buckets)
+
+    cycles = []
+    cycle_of = np.full(len(order), -1, dtype=np.int32)
+    for members in {frozenset(members): members for members in loader.cycles.values()}.values():
+        for address in members:
+            cycle_of[ids[address]] = len(cycles)
+        cycles.append([ids[address] for address in members])
+
+    const_kinds = np.zeros(len(consts), dtype=np.uint8)
+    const_numbers = np.zeros(len(consts), dtype=np.float64)
+    for index, (kind, value) in enumerate(consts):
+        const_kinds[index], const_numbers[index] = encode_value(value, objects)
+
+    arrays = {}
+    arrays['sheets'], arrays['sheet_ptr'] = encode_strings(sheets)
+    arrays['addresses'], arrays['address_ptr'] = encode_strings(order)
+    arrays['functions'], arrays['function_ptr'] = encode_strings(functions)
+    arrays['cell_keys'] = cell_keys
+    arrays['kinds'], arrays['numbers'] = kinds, numbers
+    arrays['const_kinds'], arrays['const_numbers'] = const_kinds, const_numbers
+    arrays['code_ptr'], code_args = csr([[arg for opcode, arg in code] for code in codes])
+    arrays['code_ops'] = np.fromiter((opcode for code in codes for opcode, arg in code), dtype=np.uint8,
+                                     count=len(code_args))
+    arrays['code_args'] = code_args
+    arrays['ranges'] = np.array(ranges, dtype=np.int32).reshape(len(ranges), 5)
+    arrays['calls'] = np.array(calls, dtype=np.int32).reshape(len(calls), 3)
+    arrays['windows'] = np.array(windows, dtype=np.int32).reshape(len(windows), 2)
+    arrays['prec_ptr'], arrays['precs'] = csr(cell_precs)
+    arrays['prec_range_ptr'], arrays['prec_ranges'] = csr(range_precs)
+    arrays['dep_ptr'], arrays['deps'] = csr(cell_deps)
+    arrays['range_dep_ptr'], arrays['range_deps'] = csr(range_deps)
+    arrays['bucket_keys'] = np.array(bucket_keys, dtype=np.int64)
+    arrays['bucket_ptr'], arrays['bucket_ranges'] = csr([buckets[key] for key in bucket_keys])
+    arrays['cycle_of'] = cycle_of
+    arrays['cycle_ptr'], arrays['cycles'] = csr(cycles)
+    arrays['objects'] = np.frombuffer(pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+
+    settings = {'iterate': loader.iterate, 'max_iterations': loader.max_iterations, 'max_change': loader.max_change}
+    logging.info("Flattened {} cells, {} formulas and {} ranges".format(len(order), len(formulas), len(ranges)))
+    return arrays, settings
+
+
+def plan_layout(arrays, settings):
+    '''
+    Arrays are placed one after another from the first multiple of ALIGN past the header, at offsets the header
+    gives from there
+    @return: (header bytes, {name: offset of the array in the buffer}, size of the buffer in bytes)
+    '''
+    offsets = {}
+    size = 0
+    for name, array in arrays.items():
+        offsets[name] = size
+        size += -(-array.nbytes // ALIGN) * ALIGN
+    header = {'version': FORMAT_VERSION, 'settings': settings,
+              'arrays': {name: [array.dtype.str, list(array.shape), offsets[name]] for name, array in arrays.items()}}
+    header = json.dumps(header).encode('utf-8')
+    start = data_start(len(header))
+    return header, {name: start + offset for name, offset in offsets.items()}, start + size
+
+
+def data_start(header_length):
+    return -(-(len(MAGIC) + 8 + header_length) // ALIGN) * ALIGN
+
+
+def layout_size(arrays, settings):
+    '''
+    @return: number of bytes write_layout needs
+    '''
+    return plan_layout(arrays, settings)[2]
+
+
+def write_layout(buffer, arrays, settings):
+    '''
+    Writes arrays into a buffer behind a header listing their dtypes, shapes and offsets
+    @param buffer: writable buffer of at least layout_size bytes, e.g. a bytearray, mmap or shared memory buffer
+    '''
+    header, offsets, size = plan_layout(arrays, settings)
+    view = memoryview(buffer).cast('B')
+    view[:len(MAGIC)] = MAGIC
+    view[len(MAGIC):len(MAGIC) + 8] = len(header).to_bytes(8, 'little')
+    view[len(MAGIC) + 8:len(MAGIC) + 8 + len(header)] = header
+    for name, array in arrays.items():
+        view[offsets[name]:offsets[name] + array.nbytes] = np.ascontiguousarray(array).view(np.uint8).ravel()
+
+
+def read_layout(buffer):
+    '''
+    Maps the arrays of a buffer written by write_layout. Nothing is copied: the arrays are read only views
+    @return: (dictionary of numpy arrays by name, dictionary of settings)
+    '''
+    view = memoryview(buffer).cast('B')
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a flat Saturn model")
+    length = int.from_bytes(view[len(MAGIC):len(MAGIC) + 8], 'little')
+    header = json.loads(bytes(view[len(MAGIC) + 8:len(MAGIC) + 8 + length]))
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError("Flat model version {} is not {}".format(header['version'], FORMAT_VERSION))
+    start = data_start(length)
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        count = int(np.prod(shape))
+        array = np.frombuffer(view, dtype=np.dtype(dtype), count=count, offset=start + offset).reshape(shape)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays, header['settings']
+
+
+def save_model(loader, path):
+    '''
+    Writes a model to a file that load_model maps. The file is replaced atomically so readers never see half a
+    model
+    @param loader: Loader of the model. Its formulas are calculated first, see flatten
+    @return: size of the file in bytes
+    '''
+    arrays, settings = flatten(loader)
+    size = layout_size(arrays, settings)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w+b') as f:
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as buffer:
+            write_layout(buffer, arrays, settings)
+    os.replace(tmp_path, path)
+    logging.info("Saved flat model {} in {} bytes".format(path, size))
+    return size
+
+
+def load_model(path):
+    '''
+    Maps a file written by save_model. Nothing is parsed but the header: pages are read as they are used, and are
+    shared by all the processes mapping the file
+    @return: FlatModel
+    '''
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return FlatModel(buffer)
+
+
+class FlatModel:
+    """
+    Read only model over a buffer written by write_layout. Values set and recalculated are kept by a Session
+    """
+
+    def __init__(self, buffer):
+        '''
+        @param buffer: buffer holding the layout. It must outlive the model
+        '''
+        self.buffer = buffer
+        arrays, settings = read_layout(buffer)
+        for name, array in arrays.items():
+            if name != 'objects':
+                setattr(self, name, array)
+        self.object_data = arrays['objects']
+        self.iterate = settings['iterate']
+        self.max_iterations = settings['max_iterations']
+        self.max_change = settings['max_change']
+
+        sheets = [decode_string(self.sheets, self.sheet_ptr, index) for index in range(len(self.sheet_ptr) - 1)]
+        self.sheet_ids = {sheet: index for index, sheet in enumerate(sheets)}
+        self.functions = [import_function(decode_string(arrays['functions'], self.function_ptr, index))
+                          for index in range(len(self.function_ptr) - 1)]
+        self._objects = None
+        self.pending = set(np.flatnonzero(self.kinds == PENDING).tolist())
+        self.program = lru_cache(maxsize=PROGRAM_CACHE)(self.program)
+
+    def __len__(self):
+        return len(self.cell_keys)
+
+    @property
+    def objects(self):
+        '''
+        Side table of values that are not numbers, unpickled when first needed
+        '''
+        if self._objects is None:
+            self._objects = pickle.loads(self.object_data.tobytes())
+        return self._objects
+
+    def cell_id(self, address):
+        '''
+        @return: id of the cell at an address, or None if the model does not hold it
+        '''
+        return self.cell_ids([address])[0]
+
+    def cell_ids(self, addresses):
+        '''
+        @return: list of the ids of the cells at some addresses, with None where the model holds no cell
+        '''
+        keys = []
+        for address in addresses:
+            sheet, row, col = split_address(address)
+            sheet = self.sheet_ids.get(sheet)
+            keys.append(-1 if sheet is None else cell_key(sheet, row, col))
+        keys = np.array(keys, dtype=np.int64)
+        ids = self.cell_keys.searchsorted(keys)
+        found = self.cell_keys[np.minimum(ids, len(self.cell_keys) - 1)] == keys if len(self.cell_keys) else keys < 0
+        return [index if hit else None for index, hit in zip(ids.tolist(), found.tolist())]
+
+    def address(self, index):
+        return decode_string(self.addresses, self.address_ptr, index)
+
+    def position(self, index):
+        '''
+        @return: (sheet id, row, column) of a cell
+        '''
+        key = int(self.cell_keys[index])
+        return key >> 2 * KEY_BITS, key & KEY_MASK, (key >> KEY_BITS) & KEY_MASK
+
+    def value(self, index):
+        '''
+        @return: baseline value of a cell
+        '''
+        return decode_value(self.kinds[index], self.numbers[index].item(), self.objects)
+
+    def program(self, index):
+        '''
+        Decodes the program of a formula cell. CELL arguments are cell ids, and RANGE and WINDOW arguments hold
+        range ids
+        @return: program for vm.execute, or None if the cell holds no formula
+        '''
+        start, stop = int(self.code_ptr[index]), int(self.code_ptr[index + 1])
+        if start == stop:
+            return None
+        program = []
+        for opcode, arg in zip(self.code_ops[start:stop].tolist(), self.code_args[start:stop].tolist()):
+            if opcode == CONST:
+                arg = decode_value(self.const_kinds[arg], self.const_numbers[arg].item(), self.objects)
+            elif opcode in (BINARY, UNARY):
+                arg = self.functions[arg]
+            elif opcode == CALL:
+                func, num_args, array_args = self.calls[arg].tolist()
+                arg = (self.functions[func], num_args, bool(array_args))
+            elif opcode == WINDOW:
+                func, ref = self.windows[arg].tolist()
+                arg = (self.functions[func], ref)
+            program.append((opcode, arg))
+        return tuple(program)
+
+    def range_ids(self, index):
+        '''
+        @return: 2-D int array of the ids of the cells of a range, -1 where the model holds no cell
+        '''
+        sheet, min_row, min_col, max_row, max_col = self.ranges[index].tolist()
+        grid = np.full((max(max_row - min_row + 1, 0), max(max_col - min_col + 1, 0)), -1, dtype=np.int64)
+        if grid.size == 0:
+            return grid
+        cols = np.arange(min_col, max_col + 1, dtype=np.int64)
+        starts = self.cell_keys.searchsorted(cell_key(sheet, min_row, cols))
+        stops = self.cell_keys.searchsorted(cell_key(sheet, max_row, cols), side='right')
+        for j, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+            if start < stop:
+                grid[(self.cell_keys[start:stop] & KEY_MASK) - min_row, j] = np.arange(start, stop)
+        return grid
+
+    def in_range(self, index, cells, keys=None):
+        '''
+        @param cells: int array of cell ids
+        @param keys: their cell keys, if known
+        @return: those of the cells a range covers
+        '''
+        sheet, min_row, min_col, max_row, max_col = self.ranges[index].tolist()
+        keys = self.cell_keys[cells] if keys is None else keys
+        rows = keys & KEY_MASK
+        return cells[(keys >= cell_key(sheet, 0, min_col)) & (keys <= cell_key(sheet, KEY_MASK, max_col)) &
+                     (rows >= min_row) & (rows <= max_row)]
+
+    def precedents(self, index):
+        '''
+        @return: (list of ids of the cells a formula reads, list of ids of the ranges it reads)
+        '''
+        return (self.precs[self.prec_ptr[index]:self.prec_ptr[index + 1]].tolist(),
+                self.prec_ranges[self.prec_range_ptr[index]:self.prec_range_ptr[index + 1]].tolist())
+
+    def dependents(self, index):
+        '''
+        @return: list of ids of the formulas reading a cell, directly or through a range
+        '''
+        deps = self.deps[self.dep_ptr[index]:self.dep_ptr[index + 1]].tolist()
+        deps.extend(self.range_dependents(*self.position(index)))
+        return deps
+
+    def range_dependents(self, sheet, row, col):
+        '''
+        Formulas reading a cell through a range, whether the model holds the cell or not. Ranges are listed by
+        bucket over the columns holding cells only, so the ranges over other columns are searched in full
+        @return: list of ids of the formulas
+        '''
+        bucket = (((sheet << KEY_BITS) | col) << KEY_BITS) | (row >> BUCKET_BITS)
+        position = int(self.bucket_keys.searchsorted(bucket))
+        if position < len(self.bucket_keys) and self.bucket_keys[position] == bucket:
+            ranges = self.bucket_ranges[self.bucket_ptr[position]:self.bucket_ptr[position + 1]]
+            bounds = self.ranges[ranges]
+            ranges = ranges[(bounds[:, 1] <= row) & (row <= bounds[:, 3])]
+        else:
+            first = int(self.cell_keys.searchsorted(cell_key(sheet, 0, col)))
+            if first < len(self.cell_keys) and self.cell_keys[first] <= cell_key(sheet, KEY_MASK, col):
+                return []
+            bounds = self.ranges
+            ranges = np.flatnonzero((bounds[:, 0] == sheet) & (bounds[:, 1] <= row) & (row <= bounds[:, 3]) &
+                                    (bounds[:, 2] <= col) & (col <= bounds[:, 4]))
+        deps = []
+        for ref in ranges.tolist():
+            deps.extend(self.range_deps[self.range_dep_ptr[ref]:self.range_dep_ptr[ref + 1]].tolist())
+        return deps
+
+    def cycle(self, index):
+        '''
+        @return: ids of the cells of the circular reference a cell is part of, or None
+        '''
+        cycle = self.cycle_of[index]
+        if cycle < 0:
+            return None
+        return self.cycles[self.cycle_ptr[cycle]:self.cycle_ptr[cycle + 1]].tolist()
+
+    def session(self):
+        return Session(self)
+
+
+class Session:
+    """
+    Private overlay on a FlatModel: the values set in it, and the values recalculated from them. The model itself
+    is never written to, so any number of sessions, in any number of processes, can share one
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.overlay = {}
+        self.extra = {}
+        self.dirty = set(model.pending)
+        # Dirty cells left so by a failed calculation, whose dependents hold values calculated without them. Pending
+        # cells of the model failed when it was flattened
+        self.failed = set(model.pending)
+        self.rangeCache = {}
+        self.columnSums = {}
+        self.calc_count = 0
+        self.last_recalc = 0
+
+        # Ids and keys of the dirty cells as arrays, taken when first needed after cells are marked dirty. Cells only
+        # leave the dirty set until the next mark, so it stays a superset of it until then
+        self.dirtyArray = None
+
+    def reset(self):
+        '''
+        Drops every change, back to the baseline of the model
+        '''
+        self.overlay.clear()
+        self.extra.clear()
+        self.dirty = set(self.model.pending)
+        self.failed = set(self.model.pending)
+        self.dirtyArray = None
+        self.rangeCache.clear()
+        self.columnSums.clear()
+
+    def load_cell(self, index):
+        if index in self.dirty:
+            # Failed to calculate
+            return None
+        value = self.overlay.get(index, _MISSING)
+        return self.model.value(index) if value is _MISSING else value
+
+    def load_range(self, index):
+        '''
+        Values of a range, as Loader.getrange returns them. Ranges holding only numbers are gathered from the
+        baseline column of the model and patched with the overlay
+        '''
+        if index in self.rangeCache:
+            return self.rangeCache[index]
+        model = self.model
+        grid = model.range_ids(index)
+        ids = grid.ravel()
+        array = None
+        if ids.size and ids.min() >= 0:
+            kinds = model.kinds[ids]
+            changes = len(self.overlay) + len(self.dirty)
+            if not changes:
+                changed = np.zeros(ids.size, dtype=bool)
+            elif ids.size <= SMALL_RANGE or ids.size < changes:
+                # Looking each cell up is cheaper than sorting the changed cells
+                overlay, dirty = self.overlay, self.dirty
+                changed = np.array([cell in overlay or cell in dirty for cell in ids.tolist()], dtype=bool)
+            else:
+                changed = np.isin(ids, np.fromiter(self.overlay.keys() | self.dirty, dtype=np.int64))
+            if np.all(changed | (kinds == FLOAT) | (kinds == INT)):
+                array = model.numbers[ids]
+                for position in np.flatnonzero(changed).tolist():
+                    value = self.load_cell(int(ids[position]))
+                    if type(value) not in (int, float):
+                        array = None
+                        break
+                    array[position] = value
+        if array is None:
+            rows = [[None if cell < 0 else self.load_cell(cell) for cell in row] for row in grid.tolist()]
+            if self.extra:
+                # Values set on cells the model does not hold
+                sheet, min_row, min_col, max_row, max_col = model.ranges[index].tolist()
+                for address, value in self.extra.items():
+                    name, row, col = split_address(address)
+                    if (model.sheet_ids.get(name) == sheet and min_row <= row <= max_row and
+                            min_col <= col <= max_col and grid[row - min_row, col - min_col] < 0):
+                        rows[row - min_row][col - min_col] = value
+            array = to_array(rows)
+        else:
+            array = array.reshape(grid.shape)
+        array.flags.writeable = False
+        self.rangeCache[index] = array
+        return array
+
+    def load_window(self, func, index):
+        '''
+        SUM, AVERAGE or COUNT over a single column range, from cumulative sums of the column as Loader.getwindow
+        '''
+        model = self.model
+        sheet, min_row, col, max_row, max_col = model.ranges[index].tolist()
+        sums = self.columnSums.get((sheet, col))
+        if sums is None:
+            name = decode_string(model.sheets, model.sheet_ptr, sheet)
+            sums = self.columnSums[(sheet, col)] = ColumnSums(name, col)
+
+        def ready(address):
+            cell = model.cell_id(address)
+            return cell is None or cell not in self.dirty
+
+        def load(address):
+            cell = model.cell_id(address)
+            return self.extra.get(address) if cell is None else self.load_cell(cell)
+
+        if not sums.extend(max_row, min_row, load, ready):
+            return func(as_tuples(self.load_range(index)))
+        return sums.aggregate(func, min_row, max_row)
+
+    def changed(self, index):
+        '''
+        Drops what was derived from a cell before it changed
+        '''
+        if self.rangeCache:
+            self.rangeCache.clear()
+        if self.columnSums:
+            self.truncateColumn(*self.model.position(index))
+
+    def truncateColumn(self, sheet, row, col):
+        sums = self.columnSums.get((sheet, col))
+        if sums is not None:
+            sums.truncate(row)
+
+    def setvalue(self, newvalue, address):
+        '''
+        Sets value of a cell and marks its transitive dependents dirty
+        @param newvalue: New value to be set
+        @param address: Cell to be set
+        '''
+        index = self.model.cell_id(address)
+        if index is None:
+            # Read by no formula, but maybe by ranges
+            self.extra[address] = newvalue
+            name, row, col = split_address(address)
+            sheet = self.model.sheet_ids.get(name)
+            if sheet is None:
+                return
+            self.rangeCache.clear()
+            if self.columnSums:
+                self.truncateColumn(sheet, row, col)
+            self.markDirty(self.model.range_dependents(sheet, row, col))
+            return
+        self.overlay[index] = newvalue
+        self.dirty.discard(index)
+        self.failed.discard(index)
+        self.changed(index)
+        self.markDirty(self.model.dependents(index))
+
+    def markDirty(self, deps):
+        '''
+        Marks formulas dirty, and their transitive dependents
+        @param deps: ids of the formulas reading a changed cell
+        '''
+        self.dirtyArray = None
+        stack = [deps]
+        while stack:
+            for dep in stack.pop():
+                if dep not in self.dirty:
+                    self.dirty.add(dep)
+                elif dep in self.failed:
+                    # Its dependents are not dirty, as they were calculated when it failed
+                    self.failed.discard(dep)
+                else:
+                    continue
+                self.changed(dep)
+                stack.append(self.model.dependents(dep))
+
+    def getvalue(self, address):
+        '''
+        @return: value of a cell, recalculated first if needed. None if it failed to calculate
+        '''
+        return self.getvalues([address])[address]
+
+    def getvalues(self, addresses):
+        '''
+        Gets values of several cells with one walk over their dirty precedents, as Loader.getvalues does
+        @param addresses: list of addresses
+        @return: dictionary with format {address: value}. self.last_recalc holds the number of cells calculated
+        '''
+        ids = self.model.cell_ids(addresses)
+        self.last_recalc = self.recalculate([index for index in ids if index is not None])
+        values = {}
+        for address, index in zip(addresses, ids):
+            values[address] = self.extra.get(address) if index is None else self.load_cell(index)
+        return values
+
+    def dirtyPrecedents(self, index):
+        '''
+        Precedents of a formula that need calculating. Over all but small ranges, the dirty cells are tested
+        against the range, all at once, rather than the cells of the range against the dirty set
+        @return: generator of ids
+        '''
+        dirty = self.dirty
+        cells, ranges = self.model.precedents(index)
+        for prec in cells:
+            if prec in dirty:
+                yield prec
+        for ref in ranges:
+            if not dirty:
+                return
+            sheet, min_row, min_col, max_row, max_col = self.model.ranges[ref].tolist()
+            if (max_row - min_row + 1) * (max_col - min_col + 1) <= min(len(dirty), SMALL_RANGE):
+                grid = self.model.range_ids(ref)
+                yield from (cell for cell in grid[grid >= 0].tolist() if cell in dirty)
+            else:
+                if self.dirtyArray is None:
+                    ids = np.fromiter(dirty, dtype=np.int64, count=len(dirty))
+                    self.dirtyArray = (ids, self.model.cell_keys[ids])
+                yield from (cell for cell in self.model.in_range(ref, *self.dirtyArray).tolist() if cell in dirty)
+
+    def recalculate(self, roots):
+        '''
+        Calculates dirty cells after their dirty precedents, walked depth first as in Loader.recalculate
+        @param roots: ids of the cells wanted
+        @return: number of cells calculated
+        '''
+        start = self.calc_count
+        seen = set()
+        for root in roots:
+            if root in seen or root not in self.dirty:
+                continue
+            seen.add(root)
+            stack = [(root, self.dirtyPrecedents(root))]
+            while stack:
+                current, precs = stack[-1]
+                for prec in precs:
+                    if prec not in seen:
+                        seen.add(prec)
+                        stack.append((prec, self.dirtyPrecedents(prec)))
+                        break
+                else:
+                    stack.pop()
+                    if current not in self.dirty:
+                        # Calculated with its cycle
+                        continue
+                    try:
+                        cycle = self.model.cycle(current)
+                        if cycle is not None:
+                            self.calculateCycle(cycle)
+                        else:
+                            self.calculate(current)
+                    except Exception as ex:
+                        # Left dirty, and read as None by its dependents
+                        logging.info("Failed to calculate {}: {}".format(self.model.address(current), ex))
+                        self.failed.add(current)
+        return self.calc_count - start
+
+    def calculate(self, index):
+        program = self.model.program(index)
+        self.overlay[index] = execute(program, self.load_cell, self.load_range, load_window=self.load_window)
+        self.dirty.discard(index)
+        if self.failed:
+            self.failed.discard(index)
+        self.calc_count += 1
+
+    def calculateCycle(self, members):
+        '''
+        Calculates the cells of a circular reference by Gauss-Seidel iteration, as Loader.calculateCycle does
+        @param members: ids of the cells of the cycle
+        @return: number of passes
+        '''
+        if not self.model.iterate:
+            raise ValueError("Circular reference through {} with iterative calculation off".format(
+                self.model.address(members[0])))
+
+        # Out of the dirty set while iterating so that they read each other's latest values, and back in it if the
+        # iteration fails
+        previous = {index: self.overlay[index] for index in members if index in self.overlay}
+        for index in members:
+            self.dirty.discard(index)
+        iterations = 0
+        try:
+            while iterations < self.model.max_iterations:
+                iterations += 1
+                change = 0
+                for index in members:
+                    self.rangeCache.clear()
+                    old = self.load_cell(index)
+                    value = self.overlay[index] = execute(self.model.program(index), self.load_cell,
+                                                          self.load_range)
+                    self.calc_count += 1
+                    if type(old) in (int, float) and type(value) in (int, float):
+                        change = max(change, abs(value - old))
+                    elif old != value:
+                        change = float('inf')
+                if change <= self.model.max_change:
+                    break
+        except Exception:
+            for index in members:
+                self.overlay.pop(index, None)
+                self.dirty.add(index)
+                self.failed.add(index)
+                self.changed(index)
+            self.overlay.update(previous)
+            self.dirtyArray = None
+            raise
+        if self.failed:
+            self.failed.difference_update(members)
+
+        # Column sums may have read values of the cycle mid-iteration
+        for index in members:
+            self.changed(index)
+        return iterations
@@ -1,46 +1,193 @@
 import traceback
 import logging
+import numpy as np
+from bisect import bisect_left, bisect_right
 logger = logging.getLogger(__name__)
 from openpyxl import load_workbook, workbook
 from rpnnode import RPNNode, OperatorNode, RangeNode, OperandNode, FunctionNode, CellNode
 from cell import Cell
+from reader import read_cells, read_calc_settings
+from ranges import RangeRef, split_address, to_array
+from rangeindex import RangeIndex
+from vm import execute, share_subexpressions, Memo
+from windows import ColumnSums
+from templates import find_groups, MIN_ROWS
+from batch import Scenarios, Sensitivity, scenarios, call_batched, broadcast
+from cache import file_digest, cache_path, load_state, save_state
+from solver import GoalSeekResult, find_root
+from codegen import compile_model
+from parallel import calculate_parallel
+from sharedmodel import SharedModel
+from flat import save_model
 from tqdm import tqdm
 from excellib import *
 
+def same_value(old, new):
+    '''
+    @return: True if a recalculated value is the same as the previous one. Ints and floats compare as numbers, so 3
+    and 3.0 are the same, while booleans, text and numbers always differ from each other
+    '''
+    if type(old) is not type(new):
+        return type(old) in (int, float) and type(new) in (int, float) and old == new
+    if type(old) is np.ndarray:
+        return old.shape == new.shape and bool(np.all(old == new))
+    return old == new
+
+
 class Loader:
     """
     Class responsible for injecting an xlsx file and converting the file into Cell objects.
     1. Injects an xlsx file
-    2. Uses openpyxl to convert extract formulas and value from each cell
+    2. Extracts formulas and value from each cell, either streaming the sheet xml once or with openpyxl
     3. Instantiates Cell objects for each cell extracted
     """
 
-    def __init__(self, file):
+    # Parsed state written to and read back from the compiled model cache
+    CACHED_STATE = ('cells', 'precMap', 'depMap', 'rangeIndex', 'dirty', 'cycles', 'iterate', 'max_iterations',
+                    'max_change')
+
+    # Functions whose result can change without a change in their precedents. Never folded to constants
+    VOLATILE = ('RAND(', 'RANDBETWEEN(', 'NOW(', 'TODAY(', 'OFFSET(', 'INDIRECT(', 'CELL(', 'INFO(')
+
+    def __init__(self, file, streaming=True, cache=None):
         '''
         Initializes a loader object and sets the self.file param to injected file
         @param file: xlsx file
+        @param streaming: If True, each sheet's xml is read once and cells are made straight from the stream.
+        If False, the workbook is opened twice with openpyxl, once for values and once for formulas
+        @param cache: True to keep a compiled model cache alongside the workbook, or a folder to keep it in.
+        The cache is keyed by the SHA-256 of the workbook, so a changed workbook is parsed again
         '''
         self.file = file
-        logging.info("Loading excel file...")
+        self.cells = {}
+        self.precMap = {}
+        self.depMap = {}
 
-        # Load file in read-only mode for faster execution. Need to read twice to extract formulas separately (Is there a better way?)
-        self.wb_data_only = load_workbook(filename=self.file, data_only=True, read_only=True)
-        logging.info("Values Loaded...")
+        # Range precedents are tracked per range in an interval index, not per covered cell
+        self.rangeIndex = RangeIndex()
+        self.extents = {}
 
-        self.wb_formulas = load_workbook(filename=self.file, data_only=False, read_only=True)
-        logging.info("Formulas Loaded...")
+        # Values of ranges shared by several formulas, as read only arrays. Dropped when a cell in them changes
+        self.rangeCache = {}
 
-        logging.info("Excel file loaded")
+        # Cumulative sums by (sheet, column) for SUM, AVERAGE and COUNT over single column windows. Cut back to
+        # above a cell when it changes
+        self.columnSums = {}
 
-        self.cells = {}
-        self.precMap = {}
-        self.depMap = {}
+        # Set by prune. Ranges of a pruned model mostly cover folded constants, so all of them are cached
+        self.pruned = False
+
+        # Addresses of formula cells waiting to be recalculated, and recalc counters
+        self.dirty = set()
+        self.calc_count = 0
+        self.last_recalc = 0
+        self.last_marked = 0
+
+        # Circular references. Cells of each cycle map to all the cells of the cycle, which are calculated
+        # together by iteration, as in Excel's iterative calculation. Without it, they fail to calculate
+        self.cycles = {}
+        self.iterate = False
+        self.max_iterations = 100
+        self.max_change = 0.001
+        self.last_iterations = 0
+
+        # Change cut-off. Dirty cells keep in verified the revision at which their value was last right. Values
+        # that change are stamped with a new revision, in changedAt by cell and rangeChangedAt by range covering
+        # the cell, so a dirty cell none of whose precedents changed since is kept as it is. See unchanged
+        self.revision = 0
+        self.verified = {}
+        self.changedAt = {}
+        self.rangeChangedAt = {}
+        self.keep_count = 0
+
+        # Calculations failed in the current recalculation. Failed cells are left dirty and not stamped
+        self.failures = 0
+
+        # Cells left dirty by a failed calculation. Their dependents read them as blank and may be clean, so
+        # marking dirty walks past them, see updateDepCells
+        self.failed = set()
+
+        # {address: [old value, new value]} of the cells changed during a getchanges call, None otherwise
+        self.changes = None
+
+        # Formula cells by column, built when needed. See formulaColumns
+        self.formulaIndex = None
+
+        # Copied-down formulas grouped by template, built when needed. See formulaGroups
+        self.groupIndex = None
+        self.recalculating = False
+
+        # Cells a worker process was asked to calculate. Group runs stay within them. See parallel
+        self.scope = None
+
+        # Row by (sheet, column) down to which all formula cells are known to be clean. Lets dirtyPrecedents skip
+        # the top of long ranges such as running totals
+        self.cleanRows = {}
+
+        # Values of sub-expressions shared across formulas, kept until the next change. memo.hits counts the
+        # evaluations saved. See shareExpressions
+        self.memo = Memo()
+
+        if cache:
+            digest = file_digest(self.file)
+            path = cache_path(self.file, digest, cache)
+            state = load_state(path, digest)
+            if state is not None:
+                logging.info("Loaded compiled model from {}".format(path))
+                self.__dict__.update(state)
+                return
+
+        if streaming:
+            logging.info("Streaming excel file...")
+            self.streamCells()
+
+        else:
+            logging.info("Loading excel file...")
+
+            # Load file in read-only mode for faster execution. Need to read twice to extract formulas separately
+            self.wb_data_only = load_workbook(filename=self.file, data_only=True, read_only=True)
+            logging.info("Values Loaded...")
+
+            self.wb_formulas = load_workbook(filename=self.file, data_only=False, read_only=True)
+            logging.info("Formulas Loaded...")
+
+            logging.info("Excel file loaded")
+
+            #Parse cells for value
+            self.parseCells()
+
+            #Make cells with just RPN for now. AST tree has not been compiled yet
+            self.makeCells()
+
+            calculation = self.wb_formulas.calculation
+            self.iterate = bool(calculation.iterate)
+            self.max_iterations = calculation.iterateCount or self.max_iterations
+            self.max_change = calculation.iterateDelta or self.max_change
 
-        #Parse cells for value
-        self.parseCells()
+        self.foldConstants()
+        self.shareExpressions()
+        self.findCycles()
 
-        #Make cells with just RPN for now. AST tree has not been compiled yet
-        self.makeCells()
+        if cache:
+            save_state(path, digest, {name: getattr(self, name) for name in self.CACHED_STATE})
+
+    def streamCells(self):
+        '''
+        Single pass ingestion. Formula and cached value of each cell come from the same read of the sheet xml
+        and are fed to makeCell directly, without intermediate val_dict/form_dict
+        @return: Returns self.cells, a list of Cell objects, created
+        '''
+        for address, value, formula in read_cells(self.file):
+            self.makeCell(address, value, formula)
+        logging.info("--------{} total cell objects created------------".format(len(self.cells)))
+
+        settings = read_calc_settings(self.file)
+        self.iterate = settings['iterate']
+        self.max_iterations = settings['max_iterations']
+        self.max_change = settings['max_change']
+
+        # Now that all cells are created, go ahead and create dependency map
+        self.createDepMap()
 
     def parseCells(self):
         '''
@@ -82,27 +229,36 @@ class Loader:
         Wrapper function that instantiates Cell objects for each extracted cell
         @return: Returns self.cells, a list of Cell objects, created
         '''
-        for (k, v), (k2, f) in zip(self.val_dict.items(), self.form_dict.items()):
-            cell = self.makeCell(k)
+        for k in self.val_dict:
+            cell = self.makeCell(k, self.val_dict.get(k), self.form_dict.get(k))
         logging.info("\n\n\n\n--------{} total cell objects created------------\n\n\n\n".format(len(self.cells)))
 
         # Now that all cells are created, go ahead and create dependency map
         self.createDepMap()
 
-    def makeCell(self, address):
+    def makeCell(self, address, value=None, formula=None):
         '''
         Wrapper function that instantiates 1 Cell object for each extracted cell
+        @param address: address of the cell
+        @param value: cached value of the cell
+        @param formula: excel formula of the cell, or its value if the cell is a hardcode
         @return: Returns the cell object
         '''
         if address not in self.cells:
             cell = Cell(address)
             logging.info("\n\nNot in cellmap, so making cell {}".format(address))
-            cell.value = self.val_dict.get(address)
-            cell.formula = self.form_dict.get(address)
+            cell.value = value
+            cell.formula = formula
             logging.info("1 cell object created for {} with value {}".format(address, cell.value))
 
             #Update master cell dictionary
             self.cells[cell.address] = cell
+            self.extents.clear()
+            if cell.program is not None:
+                self.formulaIndex = None
+                self.groupIndex = None
+            if cell.needs_calc:
+                self.dirty.add(address)
 
             # Update master precedent dictionary
             self.precMap.update({address: cell.prec})
@@ -116,11 +272,45 @@ class Loader:
         '''
         Creates computed list of dependents from the precedent map
         @return: Updates a dictionary of precedents with format {address: [list of dependent addresses]}
+        for single cell precedents, and the range index for range precedents
         '''
         for address, precedents in self.precMap.items():
-            for prec in precedents:
+            self.addDeps(address, precedents)
+
+    def addDeps(self, address, precedents):
+        '''
+        Registers a cell as dependent of each of its precedents
+        @param address: address of the dependent cell
+        @param precedents: list of precedent addresses and RangeRefs
+        '''
+        for prec in precedents:
+            if isinstance(prec, RangeRef):
+                self.rangeIndex.add(prec, address)
+            else:
                 self.depMap.setdefault(prec, []).append(address)
 
+    def removeDeps(self, address, precedents):
+        '''
+        Reverse of addDeps
+        '''
+        for prec in precedents:
+            if isinstance(prec, RangeRef):
+                self.rangeIndex.remove(prec, address)
+            else:
+                deps = self.depMap.get(prec)
+                if deps and address in deps:
+                    deps.remove(address)
+
+    def getDependents(self, address):
+        '''
+        Returns the direct dependents of a cell, through single cell references and through ranges covering it
+        @param address: address of the cell
+        @return: list of dependent addresses
+        '''
+        deps = list(self.depMap.get(address, ()))
+        deps.extend(self.rangeIndex.dependents(address))
+        return deps
+
     def getCell(self, address):
         '''
         Returns a cell object at a specified address
@@ -134,183 +324,1113 @@ class Loader:
 
     def getvalue(self,address):
         '''
-        Gets value of cell
+        Gets value of cell. If the cell is dirty, it and its dirty precedents are recalculated first,
+        precedents before dependents
         @param address: address of desired cell's value
         @return: cell value
         '''
         try:
             cell = self.getCell(address)
-            print(cell.__dict__)
             if cell.needs_calc == True:
                 logging.info("Need to calculate {}".format(cell.address))
-                return self.calculate(cell)
+                self.last_recalc = self.recalculate([address])
+                return None if cell.needs_calc else cell.value
 
             else:
-                logging.info("Using already calculated value of {} for cell {}".format(cell.value,cell.address))
-                return self.getCell(address).value
+                self.last_recalc = 0
+                return cell.value
         except Exception as ex:
             logging.info(ex)
             logging.info("Empty cell found at {}. Setting value to zero".format(address))
             return None
 
+    def getvalues(self, addresses, workers=1):
+        '''
+        Gets values of several cells with one walk over their dirty precedents, so cells shared between
+        them are visited and calculated once. Cells outside their precedents are left alone
+        @param addresses: list of addresses
+        @param workers: number of processes to calculate independent parts of the model in, all CPUs if None.
+        See parallel.calculate_parallel
+        @return: dictionary with format {address: value}. self.last_recalc holds the number of cells calculated
+        '''
+        if workers == 1:
+            evaluated = self.recalculate(addresses)
+        else:
+            evaluated = calculate_parallel(self, addresses, workers)
+        values = {}
+        for address in addresses:
+            cell = self.getCell(address)
+            values[address] = None if cell is None or cell.needs_calc else cell.value
+
+        self.last_recalc = evaluated
+        logging.info("Calculated {} cells for {} outputs".format(evaluated, len(addresses)))
+        return values
+
+    def getchanges(self, addresses, workers=1):
+        '''
+        Gets values of several cells as getvalues does, and reports the cells whose value the recalculation changed.
+        Cells calculated to the same value as before cut the recalculation off, so cells past them are not
+        calculated at all
+        @param addresses: list of addresses
+        @param workers: see getvalues
+        @return: dictionary with format {address: (old value, new value)} of the cells whose value changed, among
+        the cells asked for and the dirty precedents calculated for them
+        '''
+        self.changes = {}
+        try:
+            self.getvalues(addresses, workers)
+            changes = self.changes
+        finally:
+            self.changes = None
+        changed = {address: (old, new) for address, (old, new) in changes.items() if not same_value(old, new)}
+        logging.info("{} of {} cells calculated changed value".format(len(changed), self.last_recalc))
+        return changed
+
     def setvalue(self, newvalue, address):
         '''
-        Sets value of a cell to a specified new value
+        Sets value of a cell to a specified new value and marks its transitive dependents dirty
         @param newvalue: New value to be set
         @param address: Cell to be set
         '''
-        # Set value of cell object to new value
+        # Set value of cell object to new value. Setting an empty cell creates it
         cell = self.getCell(address)
+        old = None if cell is None else cell.value
+        if cell is None:
+            cell = self.makeCell(address, newvalue, newvalue)
         cell.value = newvalue
 
         #Set needs_calc to False
         cell.needs_calc = False
+        self.dirty.discard(address)
+        self.failed.discard(address)
+        self.verified.pop(address, None)
 
-        # Update master cell list with new cell
-        self.cells[address] = cell
         logging.info("Value in cell {} set to {}".format(address, newvalue))
 
-        # Update dependent cells values
-        # self.updateDepCells(address)
+        # Mark dependent cells dirty. They are recalculated on the next getvalue, unless the value is the same
+        self.updateDepCells(address)
+        if not same_value(old, newvalue):
+            self.valueChanged(address, old, newvalue)
 
     def setformula(self, newform, address):
         '''
-        Sets value of a cell to a specified new value
-        @param newvalue: New value to be set
+        Sets formula of a cell to a specified new formula and recalculates it
+        @param newform: New formula to be set
         @param address: Cell to be set
+        @return: Value of the new formula
         '''
-
-        # Set value of cell object to new value
         logging.info("IN SET FORMULA")
         cell = self.getCell(address)
+        if cell is None:
+            cell = self.makeCell(address)
+
+        # Swap the cell's entries in the dependency map for the precedents of the new formula
+        self.removeDeps(address, cell.prec)
+        was_formula = cell.program is not None
         cell.formula = newform
+        if was_formula != (cell.program is not None):
+            self.formulaIndex = None
+        self.groupIndex = None
+        self.precMap[address] = cell.prec
+        self.addDeps(address, cell.prec)
 
-        #Calculate new formula
-        self.calculate(cell)
+        # The new formula may close or break a cycle
+        if address in self.cycles or self.closesCycle(address):
+            self.findCycles()
+
+        if cell.needs_calc:
+            self.dirty.add(address)
+        self.verified.pop(address, None)
+        self.updateDepCells(address)
 
         logging.info("Formula in cell {} set to {}".format(address, newform))
 
+        return self.getvalue(address)
+
     def updateDepCells(self, address):
         '''
-        Update all dependent cells for a given address
+        Marks all transitive dependents of a given address dirty by walking depMap
         @param address: Address of source cell that has been changed
-        @return:
+        @return: Number of cells marked dirty
         '''
+        marked = 0
+        stack = [address]
 
-        dep_addrs = self.depMap.get(address)
+        while stack:
+            changed = stack.pop()
+            self.dropCached((changed,))
+            for dep_addr in self.getDependents(changed):
+                dep = self.getCell(dep_addr)
+                if dep is None:
+                    continue
 
-        # First check if there any dependents. No dependents if cell is an output
-        if dep_addrs:
-            logging.info("Found dependents at {}".format(dep_addrs))
-            for addrs in dep_addrs:
-                dep = self.getCell(addrs)
-
-                #check if cell has already been calculated previously
+                # Dependents of a dirty cell are already dirty, no need to walk past it. Unless it is dirty because
+                # it failed to calculate: its dependents were calculated since, reading it as blank
                 if dep.needs_calc:
-                    logging.info("Checking if need to calculate dependent cell {}".format(dep.address))
-                    self.calculate(dep)
+                    if dep_addr in self.failed:
+                        self.failed.discard(dep_addr)
+                        stack.append(dep_addr)
+                    continue
 
-                else:
-                    logging.info("Already calculated dependent cell {}".format(dep.address))
-        else:
-            logging.info("No more dependent cells found.")
-            # pass
+                dep.needs_calc = True
+                self.dirty.add(dep_addr)
+                self.verified[dep_addr] = self.revision
+                marked += 1
+                stack.append(dep_addr)
+
+        logging.info("Marked {} dependents of {} dirty".format(marked, address))
+        self.last_marked = marked
+        return marked
+
+    def recalculate(self, roots):
+        '''
+        Calculates dirty cells after their dirty precedents. The precedents are walked depth first with an explicit
+        stack and calculated as the walk leaves them, so chains of any length are calculated without nested
+        getvalue calls: by the time a cell is calculated, everything it reads is clean. Cells shared by several
+        roots are visited once. Dirty cells of a group of copied-down formulas are visited and calculated together,
+        see calculateGroup. Cells none of whose precedents changed value are kept as they are, see unchanged
+        @param roots: addresses of the cells wanted
+        @return: number of cells calculated
+        '''
+        start = self.calc_count
+        seen = set()
+
+        # Groups of copied-down formulas are worth a vector run only with many dirty cells, and are left out of
+        # recalculations nested in a calculation, which happen when a precedent failed to calculate
+        nested = self.recalculating
+        groups = self.formulaGroups() if len(self.dirty) >= MIN_ROWS and not nested else {}
+        tried = set()
+        self.recalculating = True
+        if not nested:
+            self.failures = 0
+
+        def visit(address):
+            group = groups.get(address)
+            if group is not None and group not in tried:
+                tried.add(group)
+                indexes = self.dirtyIndexes(group)
+                if indexes is not None:
+                    seen.update(group.addresses[index] for index in indexes)
+                    return (group, indexes), self.groupPrecedents(group, indexes)
+            return address, self.dirtyPrecedents(address)
+
+        try:
+            for root in roots:
+                cell = self.cells.get(root)
+                if root in seen or cell is None or not cell.needs_calc:
+                    continue
+                seen.add(root)
+                stack = [visit(root)]
+                while stack:
+                    current, precs = stack[-1]
+                    for prec in precs:
+                        if prec not in seen:
+                            seen.add(prec)
+                            stack.append(visit(prec))
+                            break
+                    else:
+                        stack.pop()
+                        if isinstance(current, tuple):
+                            self.calculateGroup(*current)
+                            continue
+                        cell = self.cells[current]
+                        if not cell.needs_calc:
+                            # Calculated with its cycle
+                            continue
+                        try:
+                            if current in self.cycles:
+                                self.calculateCycle(self.cycles[current])
+                            elif self.unchanged(current):
+                                self.keep(cell)
+                            else:
+                                self.calculate(cell)
+                        except Exception as ex:
+                            # Left dirty. getvalue returns None for it, and so do its dependents' reads
+                            self.failures += 1
+                            self.markFailed(current)
+                            logging.info("Failed to calculate {}: {}".format(current, ex))
+        finally:
+            self.recalculating = nested
+
+        return self.calc_count - start
+
+    def dirtyPrecedents(self, address):
+        '''
+        Precedents of a formula that need calculating. Only formula cells can be dirty, so ranges are searched
+        through the formula cells they cover rather than cell by cell
+        @param address: address of the formula cell
+        @return: generator of addresses
+        '''
+        cells = self.cells
+        for prec in self.precMap.get(address, ()):
+            if isinstance(prec, RangeRef):
+                yield from self.dirtyFormulas(prec)
+            else:
+                cell = cells.get(prec)
+                if cell is not None and cell.needs_calc:
+                    yield prec
+
+    def groupPrecedents(self, group, indexes):
+        '''
+        Precedents of some cells of a group of copied-down formulas that need calculating, found column by column
+        rather than cell by cell
+        @param group: FormulaGroup
+        @param indexes: ascending indexes of the cells in the group
+        @return: generator of addresses
+        '''
+        cells = self.cells
+        for prec in group.precedents(indexes):
+            if isinstance(prec, RangeRef):
+                yield from self.dirtyFormulas(prec)
+            else:
+                cell = cells.get(prec)
+                if cell is not None and cell.needs_calc:
+                    yield prec
+
+    def dirtyFormulas(self, ref):
+        '''
+        Formula cells of a range that need calculating. Each column is scanned from the row down to which it is
+        known to be clean, and a scan that finds more clean cells right below that row moves it down
+        @param ref: RangeRef of the range
+        @return: generator of addresses
+        '''
+        cells = self.cells
+        columns = self.formulaColumns()
+        max_row, max_col = self.sheetExtent(ref.sheet)
+        min_row, min_col, last_row, last_col = ref.bounds(max_row, max_col)
+        for col in range(min_col, last_col + 1):
+            key = (ref.sheet, col)
+            rows, addresses = columns.get(key, ((), ()))
+            if not rows:
+                continue
+            known = bisect_right(rows, self.cleanRows.get(key, 0))
+            start = bisect_left(rows, min_row)
+            extending = start <= known
+            for index in range(max(start, known), bisect_right(rows, last_row)):
+                add = addresses[index]
+                if cells[add].needs_calc:
+                    # Calculated before the scan resumes, but it may fail, so the clean run stops here
+                    extending = False
+                    yield add
+                elif extending:
+                    self.cleanRows[key] = rows[index]
 
     def calculate(self, cell):
         '''
-        Calculates the formula in a cell using post order traversal of RPN
+        Calculates the formula in a cell by running its compiled RPN program on the stack machine
         @param cell: Cell to be calculated
         @return: Value of calculation
         '''
 
-        logging.info("\n\n******** Calculating cell {} with RPN {}".format(cell.address, cell.rpn))
+        logging.info("Calculating cell {}".format(cell.address))
+
+        result = execute(cell.program, self.getvalue, self.getrange, memo=self.memo, load_window=self.getwindow)
+
+        #Set cell value to new calculated value. Dependents are already dirty, so no need to mark them again
+        self.storeValue(cell, result)
+        self.calc_count += 1
+
+        return result
 
-        tree = cell.rpn
+    def storeValue(self, cell, value):
+        '''
+        Sets the calculated value of a cell and marks it clean, recording the change if the value is not the same
+        @param cell: Cell calculated
+        @param value: its new value
+        '''
+        old = cell.value
+        cell.value = value
+        cell.needs_calc = False
+        self.dirty.discard(cell.address)
+        if self.failed:
+            self.failed.discard(cell.address)
+        if self.verified:
+            self.verified.pop(cell.address, None)
+        if (self.verified or self.changes is not None) and not same_value(old, value):
+            self.valueChanged(cell.address, old, value)
+
+    def valueChanged(self, address, old, new):
+        '''
+        Stamps a cell, and the ranges covering it, with a new revision for the dirty cells that read it to compare
+        against, see unchanged. Without dirty cells kept for cut-off there is nothing to compare, so nothing is
+        stamped. Also records the change for getchanges
+        @param address: address of the cell whose value changed
+        @param old: previous value
+        @param new: new value
+        '''
+        if self.verified:
+            self.revision += 1
+            self.changedAt[address] = self.revision
+            for ref, dep in self.rangeIndex.query(*split_address(address)):
+                self.rangeChangedAt[ref] = self.revision
+        if self.changes is not None:
+            self.changes.setdefault(address, [old, new])[1] = new
+
+    def unchanged(self, address):
+        '''
+        Change cut-off. A dirty cell whose precedents are all clean needs no calculation if none of their values
+        changed since it was last right, e.g. when a change upstream was cancelled out. Applies only to cells made
+        dirty by a change upstream, and not once a calculation failed in the recalculation
+        @param address: address of a dirty formula cell whose dirty precedents have been calculated
+        @return: True if the cell's value stands
+        '''
+        verified = self.verified.get(address)
+        if verified is None or self.failures:
+            return False
+        for prec in self.precMap.get(address, ()):
+            if isinstance(prec, RangeRef):
+                if self.rangeChangedAt.get(prec, 0) > verified:
+                    return False
+            elif self.changedAt.get(prec, 0) > verified:
+                return False
+        return True
+
+    def markFailed(self, address):
+        '''
+        Leaves a cell dirty after its calculation failed. It is tried again when next read rather than kept by the
+        change cut-off, and marking dirty walks past it to its dependents, see updateDepCells
+        @param address: address of the cell
+        '''
+        self.failed.add(address)
+        self.verified.pop(address, None)
+
+    def keep(self, cell):
+        '''
+        Marks a dirty cell clean with the value it has, see unchanged
+        @param cell: Cell to keep
+        '''
+        cell.needs_calc = False
+        self.dirty.discard(cell.address)
+        self.verified.pop(cell.address, None)
+        self.keep_count += 1
+
+    def calculateGroup(self, group, indexes):
+        '''
+        Calculates dirty cells of a group of copied-down formulas in one run of the group's program over column
+        vectors, see templates.FormulaGroup. Cells the vector run cannot answer, e.g. a division by zero, and all
+        of them if the run fails, are calculated one by one
+        @param group: FormulaGroup
+        @param indexes: ascending indexes of the cells in the group. Their precedents must be clean
+        '''
+        if self.verified:
+            # Cells of a group do not read each other, so the cut-off is known for each before the run
+            run = []
+            for index in indexes:
+                address = group.addresses[index]
+                if self.unchanged(address):
+                    self.keep(self.cells[address])
+                else:
+                    run.append(index)
+            if not run:
+                return
+            indexes = run
+
+        try:
+            values = group.evaluate(indexes, self.cellValues, self.getrange, self.getwindow)
+        except Exception as ex:
+            logging.info("Calculating {} cell by cell: {}".format(group, ex))
+            values = [None] * len(indexes)
+
+        for index, value in zip(indexes, values):
+            address = group.addresses[index]
+            cell = self.cells[address]
+            if not cell.needs_calc:
+                continue
+            if value is None:
+                try:
+                    self.calculate(cell)
+                    group.failed.discard(address)
+                except Exception as ex:
+                    # Left dirty, and out of later vector runs until it calculates
+                    group.failed.add(address)
+                    self.markFailed(address)
+                    self.failures += 1
+                    logging.info("Failed to calculate {}: {}".format(address, ex))
+                continue
+            self.storeValue(cell, value)
+            self.calc_count += 1
+
+        logging.info("Calculated {} cells of {}".format(len(indexes), group))
+
+    def cellValues(self, addresses):
+        '''
+        Values of cells whose precedents are calculated, without the checks of getvalue
+        @param addresses: list of addresses
+        @return: list of values, with None for cells that do not exist or failed to calculate
+        '''
+        return [None if cell is None or cell.needs_calc else cell.value for cell in map(self.cells.get, addresses)]
+
+    def calculateCycle(self, members):
+        '''
+        Calculates the cells of a circular reference by Gauss-Seidel iteration: the cells are calculated in turn,
+        each using the latest values of the others, until no value moves by more than max_change or
+        max_iterations passes are done. Values left by the previous calculation are the starting point. As in Excel,
+        circular references are errors unless iterative calculation is on in the workbook
+        @param members: addresses of the cells of the cycle
+        @return: number of passes
+        '''
+        if not self.iterate:
+            raise ValueError("Circular reference through {} with iterative calculation off".format(members[0]))
+        cells = [self.cells[address] for address in members]
+        previous = [cell.value for cell in cells]
+
+        # The cells stay dirty until the iteration is done, and read each other's latest values meanwhile. Cycle
+        # values move on every pass, so the ranges over them are read afresh rather than from the cache
+        member_cells = dict(zip(members, cells))
+        stale = self.coveringRanges(members)
+
+        def load_cell(address):
+            cell = member_cells.get(address)
+            return self.getvalue(address) if cell is None else cell.value
+
+        def load_range(ref):
+            return self.getrange(ref, load_cell) if ref in stale else self.getrange(ref)
+
+        iterations = 0
+        change = None
+        try:
+            while iterations < self.max_iterations:
+                iterations += 1
+                change = 0
+                for cell in cells:
+                    old = cell.value
+                    cell.value = execute(cell.program, load_cell, load_range)
+                    self.calc_count += 1
+                    if type(old) in (int, float) and type(cell.value) in (int, float):
+                        change = max(change, abs(cell.value - old))
+                    elif old != cell.value:
+                        change = float('inf')
+                if change <= self.max_change:
+                    break
+        except Exception:
+            # Back to where the iteration started, left dirty
+            for cell, value in zip(cells, previous):
+                cell.value = value
+                self.markFailed(cell.address)
+            raise
+
+        for cell in cells:
+            cell.needs_calc = False
+            self.dirty.discard(cell.address)
+            self.failed.discard(cell.address)
+            self.verified.pop(cell.address, None)
+
+        # Column sums may have read values of the cycle mid-iteration
+        if self.columnSums:
+            for address in members:
+                self.dropColumn(address)
+
+        for cell, value in zip(cells, previous):
+            if not same_value(value, cell.value):
+                self.valueChanged(cell.address, value, cell.value)
+
+        self.last_iterations = iterations
+        logging.info("Iterated cycle of {} cells {} times, last change {}".format(len(cells), iterations, change))
+        return iterations
+
+    def formulaPrecedents(self, address):
+        '''
+        Formula cells a formula refers to, with range precedents expanded to the formula cells they cover
+        @param address: address of the formula cell
+        @return: generator of addresses
+        '''
+        for prec in self.precMap.get(address, ()):
+            if isinstance(prec, RangeRef):
+                yield from self.rangeFormulas(prec)
+            else:
+                cell = self.cells.get(prec)
+                if cell is not None and cell.program is not None:
+                    yield prec
+
+    def rangeFormulas(self, ref):
+        '''
+        @param ref: RangeRef of a range
+        @return: list of addresses of the formula cells in the range
+        '''
+        columns = self.formulaColumns()
+        max_row, max_col = self.sheetExtent(ref.sheet)
+        min_row, min_col, last_row, last_col = ref.bounds(max_row, max_col)
+        found = []
+        for col in range(min_col, last_col + 1):
+            rows, addresses = columns.get((ref.sheet, col), ((), ()))
+            if rows:
+                found.extend(addresses[bisect_left(rows, min_row):bisect_right(rows, last_row)])
+        return found
+
+    def formulaColumns(self):
+        '''
+        Formula cells by column, sorted by row. Built on first use and again after formula cells come or go
+        @return: dictionary with format {(sheet, col): ([rows], [addresses])}
+        '''
+        if self.formulaIndex is None:
+            columns = {}
+            for address, cell in self.cells.items():
+                if cell.program is not None:
+                    sheet, row, col = split_address(address)
+                    columns.setdefault((sheet, col), []).append((row, address))
+            for key, entries in columns.items():
+                entries.sort()
+                columns[key] = ([row for row, address in entries], [address for row, address in entries])
+            self.formulaIndex = columns
+            self.cleanRows = {}
+        return self.formulaIndex
+
+    def formulaGroups(self):
+        '''
+        Formula cells grouped by R1C1 template over contiguous rows of a column. Built on first use and again after
+        formulas change
+        @return: dictionary with format {address: FormulaGroup} for the grouped cells
+        '''
+        if self.groupIndex is None:
+            self.groupIndex = find_groups(self.formulaColumns(), self.cells, self.cycles, self.VOLATILE)
+            logging.info("Grouped {} copied-down formulas".format(len(self.groupIndex)))
+        return self.groupIndex
+
+    def dirtyIndexes(self, group):
+        '''
+        @param group: FormulaGroup
+        @return: indexes of the dirty cells of the group, or None if too few of them are dirty for a vector run.
+        Cells that failed to calculate are not counted
+        '''
+        cells, failed, scope = self.cells, group.failed, self.scope
+        dirty = [index for index, address in enumerate(group.addresses)
+                 if cells[address].needs_calc and address not in failed and (scope is None or address in scope)]
+        return dirty if len(dirty) >= MIN_ROWS else None
+
+    def fold(self, cell):
+        '''
+        Turns a formula cell into a hardcode holding its current value. The formula text is kept for reference
+        @param cell: Cell to fold
+        '''
+        self.removeDeps(cell.address, cell.prec)
+        cell.program = None
+        cell.rpn = None
+        cell.tree = None
+        cell.prec = []
+        cell.needs_calc = False
+        self.precMap[cell.address] = cell.prec
+        self.dirty.discard(cell.address)
+
+    def foldConstants(self):
+        '''
+        Pre-evaluates formulas without precedents, e.g. =12*1000, and folds them into constants. Volatile
+        functions are left alone
+        @return: number of cells folded
+        '''
+        folded = 0
+        for address in list(self.dirty):
+            cell = self.cells[address]
+            if cell.prec or cell.program is None or any(name in str(cell.formula).upper() for name in self.VOLATILE):
+                continue
+            try:
+                self.calculate(cell)
+            except Exception as ex:
+                logging.info("Could not fold {}: {}".format(address, ex))
+                continue
+            self.fold(cell)
+            folded += 1
+
+        if folded:
+            self.formulaIndex = None
+            self.groupIndex = None
+        logging.info("Folded {} constant formulas".format(folded))
+        return folded
+
+    def shareExpressions(self):
+        '''
+        Finds sub-expressions repeated across formulas, e.g. SUM(Data!B2:B50000) or VLOOKUP($A$1,Rates!A:F,3,0),
+        and rewrites the programs so that each is evaluated once per recalculation, see vm.share_subexpressions.
+        Formulas set later with setformula are not shared
+        @return: number of distinct shared sub-expressions
+        '''
+        programs = {address: cell.program for address, cell in self.cells.items() if cell.program is not None}
+        rewritten, shared, uses = share_subexpressions(programs)
+        for address, program in rewritten.items():
+            self.cells[address].program = program
+
+        logging.info("Shared {} sub-expressions used in {} places, saving up to {} evaluations per full recalculation"
+                     .format(shared, uses, uses - shared))
+        return shared
+
+    def findCycles(self):
+        '''
+        Finds circular references with Tarjan's strongly connected components algorithm, run iteratively over
+        the formula cells so deep chains do not hit the recursion limit
+        @return: Updates self.cycles with format {address: tuple of the addresses of its cycle}
+        '''
+        index = {}
+        low = {}
         stack = []
+        on_stack = set()
+        cycles = {}
+
+        for root in self.cells:
+            if root in index or self.cells[root].program is None:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, self.formulaPrecedents(root))]
+            while work:
+                address, precs = work[-1]
+                for prec in precs:
+                    if prec not in index:
+                        index[prec] = low[prec] = len(index)
+                        stack.append(prec)
+                        on_stack.add(prec)
+                        work.append((prec, self.formulaPrecedents(prec)))
+                        break
+                    elif prec in on_stack:
+                        low[address] = min(low[address], index[prec])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[address])
+                    if low[address] == index[address]:
+                        # Popped precedents first, which is a good order to iterate in
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == address:
+                                break
+                        if len(component) > 1 or address in self.formulaPrecedents(address):
+                            component = tuple(component)
+                            for member in component:
+                                cycles[member] = component
+
+        self.cycles = cycles
+        self.groupIndex = None
+        logging.info("Found {} cells in circular references".format(len(cycles)))
+        return cycles
+
+    def closesCycle(self, address):
+        '''
+        Tests whether a formula cell is its own transitive precedent
+        @param address: address of the formula cell
+        @return: True if the cell is part of a circular reference
+        '''
+        seen = set()
+        stack = [address]
+        while stack:
+            for prec in self.formulaPrecedents(stack.pop()):
+                if prec == address:
+                    return True
+                if prec not in seen:
+                    seen.add(prec)
+                    stack.append(prec)
+        return False
+
+    def getrange(self, ref, load_cell=None):
+        '''
+        Gets values of all cells in a range. Addresses are only generated here, when the values are fetched
+        @param ref: RangeRef of the range
+        @param load_cell: function used to get each cell's value, getvalue by default. With getvalue, ranges that
+        several formulas refer to, or any range once the model is pruned, are cached until one of their cells changes
+        @return: 2-D numpy array of cell values, float64 if every cell holds a number, object otherwise
+        '''
+        shared = load_cell is None and (self.pruned or self.rangeIndex.users(ref) > 1)
+        if shared and ref in self.rangeCache:
+            return self.rangeCache[ref]
 
-        for node in tree:
-            # logging.info("Processing node: {} of type {} and subtype {} and value {}".format(node,node.token.type,node.token.subtype,node.token.value))
+        load_cell = load_cell or self.getvalue
+        max_row, max_col = self.sheetExtent(ref.sheet)
+        rows = [[load_cell(add) for add in adds] for adds in ref.rows(max_row, max_col)]
+        array = to_array(rows)
 
-            #Operator Node
-            if isinstance(node, OperatorNode):
-                if node.token.type == node.token.OP_IN:
-                    arg2 = stack.pop()
-                    arg1 = stack.pop()
-                    op = OP_MAP.get(node.token.value)
-                    eval_str = '''{}{}{}'''.format(arg1, op, arg2)
-                    result = eval(eval_str)
-                    stack.append(result)
-                    # logging.info("Found operator node with value {}".format(node.token.value))
+        if shared:
+            # Read only, so lookup functions can index it for as long as it lives
+            array.flags.writeable = False
+            self.rangeCache[ref] = array
+        return array
 
+    def coveringRanges(self, addresses):
+        '''
+        @param addresses: addresses of cells
+        @return: set of RangeRefs of the ranges formulas refer to that cover any of the cells
+        '''
+        return set(ref for address in addresses for ref, dep in self.rangeIndex.query(*split_address(address)))
+
+    def dropCached(self, addresses):
+        '''
+        Drops what was worked out from the values of cells that changed: shared sub-expression results, cached
+        values of the ranges covering the cells, and cumulative sums and clean rows of their columns
+        @param addresses: list of addresses of the cells
+        '''
+        self.memo.clear()
+        if len(addresses) > len(self.rangeCache):
+            # Cheaper than finding the ranges covering each cell
+            self.rangeCache.clear()
+        for address in addresses:
+            if self.rangeCache:
+                self.dropRanges(address)
+            if self.columnSums or self.cleanRows:
+                self.dropColumn(address)
+
+    def dropRanges(self, address):
+        '''
+        Drops cached values of the ranges covering a cell
+        @param address: address of the changed cell
+        '''
+        for ref, dep in self.rangeIndex.query(*split_address(address)):
+            self.rangeCache.pop(ref, None)
+
+    def getwindow(self, func, ref):
+        '''
+        SUM, AVERAGE or COUNT over a single column range, answered from cumulative sums of the column
+        @param func: xsum, average or count
+        @param ref: RangeRef of a single column with bounded rows
+        @return: value of func over the range
+        '''
+        key = (ref.sheet, ref.min_col)
+        sums = self.columnSums.get(key)
+        if sums is None:
+            sums = self.columnSums[key] = ColumnSums(ref.sheet, ref.min_col)
+
+        def ready(address):
+            cell = self.cells.get(address)
+            return cell is None or not cell.needs_calc
+
+        def load(address):
+            cell = self.cells.get(address)
+            return None if cell is None else self.getvalue(address)
+
+        if not sums.extend(ref.max_row, ref.min_row, load, ready):
+            # Rows above the window still need calculating, which this formula must not trigger
+            return func(as_tuples(self.getrange(ref)))
+        return sums.aggregate(func, ref.min_row, ref.max_row)
+
+    def dropColumn(self, address):
+        '''
+        Cuts cumulative sums and the clean row of a cell's column back to the row above it
+        @param address: address of the changed cell
+        '''
+        sheet, row, col = split_address(address)
+        key = (sheet, col)
+        sums = self.columnSums.get(key)
+        if sums is not None:
+            sums.truncate(row)
+        if self.cleanRows.get(key, 0) >= row:
+            self.cleanRows[key] = row - 1
+
+    def sheetExtent(self, sheet):
+        '''
+        Last used row and column of a sheet. Used to clip whole column and whole row ranges
+        @param sheet: sheet name
+        @return: (max_row, max_col)
+        '''
+        if sheet not in self.extents:
+            max_row = max_col = 0
+            for address in self.cells:
+                if address.startswith(sheet + '!'):
+                    _, row, col = split_address(address)
+                    max_row = max(max_row, row)
+                    max_col = max(max_col, col)
+            self.extents[sheet] = (max_row, max_col)
+        return self.extents[sheet]
+
+    def precedentCells(self, address):
+        '''
+        Existing cells a formula refers to, with range precedents expanded to the cells they cover
+        @param address: address of the formula cell
+        @return: generator of addresses
+        '''
+        for prec in self.precMap.get(address, ()):
+            if isinstance(prec, RangeRef):
+                max_row, max_col = self.sheetExtent(prec.sheet)
+                for add in prec.addresses(max_row, max_col):
+                    if add in self.cells:
+                        yield add
+            else:
+                yield prec
+
+    def dependentCone(self, addresses):
+        '''
+        All transitive dependents of a set of cells
+        @param addresses: addresses of the source cells
+        @return: set of dependent addresses, not including the sources unless they depend on each other
+        '''
+        cone = set()
+        stack = list(addresses)
+        while stack:
+            for dep in self.getDependents(stack.pop()):
+                if dep not in cone:
+                    cone.add(dep)
+                    stack.append(dep)
+        return cone
+
+    def topoOrder(self, roots, include):
+        '''
+        Orders cells so that every cell comes after its precedents, using an iterative depth first search
+        over precMap, so chain depth is not limited by the recursion limit
+        @param roots: addresses to start from
+        @param include: predicate telling whether an address takes part. The search does not go past
+        excluded cells
+        @return: list of addresses in evaluation order
+        '''
+        order = []
+        visited = set()
+        for root in roots:
+            if root in visited or not include(root):
+                continue
+            visited.add(root)
+            stack = [(root, self.precedentCells(root))]
+            while stack:
+                address, precs = stack[-1]
+                for prec in precs:
+                    if prec not in visited and include(prec):
+                        visited.add(prec)
+                        stack.append((prec, self.precedentCells(prec)))
+                        break
                 else:
-                    arg1 = stack.pop()
-                    op = OP_MAP.get(node.token.value)
-                    eval_str = '''{}{}'''.format(op, arg1)
-                    result = eval(eval_str)
-                    stack.append(result)
-
-            #Function Node
-            elif isinstance(node,FunctionNode):
-                if node.num_args:
-                    args = stack[-node.num_args:]
-                    del stack[-node.num_args:]
-                    func = FUNC_MAP.get(node.token.value.strip('('))
-
-                    temp_args=[]
-                    for i,a in enumerate(args):
-                        temp_args.append(a)
-                    arg_str = '{}'.format(tuple(temp_args))
-                    logging.info("Argument string is: {}".format(arg_str))
-                    eval_str = '{}{}'.format(func, arg_str)
-                    logging.info("Evaluate code is: {}".format(eval_str))
-                    result = eval(eval_str)
-                    stack.append(result)
-
-            #Operand Node - Number type
-            elif node.token.subtype == 'NUMBER':
-                 stack.append(node.token.value)
-                 # logging.info("Found number node with value {}".format(node.token.value))
-
-            # Operand Node - Logical type
-            elif node.token.subtype == 'LOGICAL':
-                 stack.append(node.token.value)
-                 # logging.info("Found logical node with value {}".format(node.token.value))
-
-            #Operand node - Range type
+                    stack.pop()
+                    order.append(address)
+        return order
+
+    def batchOrder(self, inputs, outputs):
+        '''
+        Cells that differ between scenarios, in evaluation order. Only cells downstream of the inputs and upstream
+        of the outputs qualify. Everything else keeps its current value
+        @param inputs: addresses of the varied cells
+        @param outputs: addresses of the requested cells
+        @return: list of addresses
+        '''
+        cone = self.dependentCone(inputs)
+        return self.topoOrder(outputs, lambda address: address in cone and address not in inputs)
+
+    def prune(self, inputs, outputs):
+        '''
+        Cuts the model down to the cells between declared inputs and outputs. Formulas on an input to output path
+        are kept. The cells they read and the outputs off any path are folded to their current values, and
+        every other cell is dropped, along with its entries in the dependency map. Only the inputs should be
+        changed afterwards
+        @param inputs: addresses of the cells that may change
+        @param outputs: addresses of the cells wanted
+        @return: number of cells dropped
+        '''
+        path = set(self.batchOrder(inputs, outputs))
+        keep = set(inputs) | set(outputs) | path
+        for address in path:
+            keep.update(self.precedentCells(address))
+
+        # Folded values must be current, and whole column ranges keep clipping to the original extents
+        self.getvalues([address for address in keep if address not in path])
+        for address in self.cells:
+            self.sheetExtent(address.split('!')[0])
+
+        dropped = 0
+        for address in list(self.cells):
+            if address in path:
+                continue
+            if address in keep:
+                if self.cells[address].program is not None:
+                    self.fold(self.cells[address])
             else:
-                range_tuple = None
+                del self.cells[address]
+                self.precMap.pop(address, None)
+                self.dirty.discard(address)
+                self.verified.pop(address, None)
+                dropped += 1
+
+        self.depMap = {}
+        self.rangeIndex = RangeIndex()
+        self.createDepMap()
+        self.rangeCache.clear()
+        self.columnSums.clear()
+        self.pruned = True
+        self.formulaIndex = None
+        self.groupIndex = None
+        self.findCycles()
 
-                if isinstance(node, RangeNode):
-                    range_val = []
-                    for adds in node.rangeadds:
-                        slice_= []
-                        for add in adds:
-                            slice_.append(self.getvalue(add))
-                        range_val.append(tuple(slice_))
-                        range_tuple = tuple(range_val)
-                        # logging.info("Found {} {} with value {}".format(node.__class__.__name__,node.token.value, range_tuple))
+        logging.info("Pruned model to {} cells, {} on input to output paths, {} dropped".format(
+            len(self.cells), len(path), dropped))
+        return dropped
 
-                # Operand node - Cell type
-                elif isinstance(node, CellNode):
-                    range_val = []
-                    adds = node.rangeadds
-                    range_val = self.getvalue(adds)
-                    range_tuple = range_val
-                    # logging.info("Found {} {} with value {}".format(node.__class__.__name__, node.token.value, range_tuple))
+    def evaluate_batch(self, inputs, outputs, order=None):
+        '''
+        Evaluates many scenarios at once. Each cell depending on the inputs carries a vector with one value per
+        scenario through its RPN program, so operators run once per cell with numpy broadcasting rather than
+        once per scenario. Excel functions with varying arguments are called per scenario.
+        The model itself is left untouched
+        @param inputs: dictionary with format {address: array of values, one per scenario}
+        @param outputs: list of addresses to return
+        @param order: result of batchOrder for the same inputs and outputs, to skip working it out again when
+        running several batches
+        @return: dictionary with format {address: numpy array of values, one per scenario}
+        '''
+        values = {address: scenarios(list(v)) for address, v in inputs.items()}
+        sizes = set(len(v) for v in values.values())
+        if len(sizes) != 1:
+            raise ValueError("All inputs need the same number of scenarios, got sizes {}".format(sorted(sizes)))
+        size = sizes.pop()
+
+        if order is None:
+            order = self.batchOrder(values, outputs)
+
+        def load(address):
+            value = values.get(address)
+            return self.getvalue(address) if value is None else value
+
+        def load_range(ref):
+            return self.getrange(ref, load)
+
+        evaluated = 0
+        for address in order:
+            cell = self.getCell(address)
+            if cell is None or cell.program is None:
+                continue
+            values[address] = execute(cell.program, load, load_range, call_batched)
+            evaluated += 1
+
+        result = {address: broadcast(load(address), size) for address in outputs}
+
+        # Set last, getvalue above resets it
+        self.last_recalc = evaluated
+        logging.info("Evaluated {} cells for {} scenarios".format(evaluated, size))
+
+        return result
+
+    def goal_seek(self, target_addr, target_value, changing_addr, tolerance=1e-9, max_iterations=100):
+        '''
+        Finds the value of a cell that makes a formula reach a goal, like Excel's Goal Seek. Each iteration only
+        recalculates the cells between the changing cell and the target. The changing cell is left at the value found
+        @param target_addr: address of the formula cell to reach the goal
+        @param target_value: goal
+        @param changing_addr: address of the hardcoded cell to change
+        @param tolerance: largest acceptable distance between the target and the goal
+        @param max_iterations: largest number of trial values
+        @return: GoalSeekResult
+        '''
+        changing = self.getCell(changing_addr)
+        if changing is None or changing.program is not None:
+            raise ValueError("{} must be a cell holding a value".format(changing_addr))
+
+        order = self.batchOrder([changing_addr], [target_addr])
+        if target_addr not in order:
+            raise ValueError("{} does not depend on {}".format(target_addr, changing_addr))
 
-                stack.append(range_tuple)
+        # Dirty everything downstream once. The iterations keep the cells in order up to date,
+        # the rest are recalculated lazily with the value found
+        self.setvalue(changing.value, changing_addr)
+        start = self.calc_count
+        last = None
 
+        # Values bypass setvalue here, so what is cached from the changing cells is dropped on every trial
+        written = [changing_addr] + order
 
+        def distance(x):
+            nonlocal last
+            last = x
+            changing.value = x
+            self.dropCached(written)
+            try:
+                for address in order:
+                    self.calculate(self.cells[address])
+            except Exception as ex:
+                logging.info(ex)
+                return float('nan')
+            value = self.cells[target_addr].value
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                return float('nan')
+            return value - target_value
 
-            # logging.info("Stack is: {}".format(stack))
+        x0 = changing.value if isinstance(changing.value, (int, float)) else 0
+        old = changing.value
+        x, fx, iterations, converged = find_root(distance, x0, tolerance, max_iterations)
+        if x != last:
+            distance(x)
 
-        #Get final result from remaining value in stack
-        assert len(stack) == 1, 'More than 1 remaining value in stack. Recheck the stack algorithm'
-        result = stack.pop()
+        # Stamped once found, for the dirty cells left outside the order
+        if not same_value(old, changing.value):
+            self.valueChanged(changing_addr, old, changing.value)
 
-        #Set cell value to new calculated value
-        self.setvalue(result,cell.address)
+        self.last_recalc = self.calc_count - start
+        logging.info("Goal seek of {} on {} {} after {} iterations".format(
+            target_addr, changing_addr, 'converged' if converged else 'failed', iterations))
+
+        return GoalSeekResult(x, self.cells[target_addr].value, converged, iterations, self.last_recalc)
+
+    def sensitivity(self, inputs, outputs, bump=0.1):
+        '''
+        One at a time sensitivities, e.g. for a tornado chart. Every input is bumped down and up by a fraction
+        of its value while the other inputs keep theirs. Bumps run as two scenario batches of evaluate_batch,
+        so only the cells between an input and the outputs are recalculated. Inputs whose cones do not overlap
+        share a batch, since none of their bumps can reach the cells recalculated for another
+        @param inputs: addresses of hardcoded input cells
+        @param outputs: addresses of output cells
+        @param bump: fraction to bump the inputs by, 0.1 for +/-10%
+        @return: dictionary with format {output: {input: Sensitivity}}
+        '''
+        baseline = {address: self.getvalue(address) for address in outputs}
+        bumps = {}
+        for address in inputs:
+            value = self.getvalue(address)
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError("Cannot bump {}, it holds {}".format(address, value))
+            bumps[address] = [value * (1 - bump), value * (1 + bump)]
+
+        # Greedily pack inputs into batches of disjoint cones
+        cones = {address: self.batchOrder([address], outputs) for address in inputs}
+        batches = []
+        for address in inputs:
+            cone = set(cones[address])
+            for batch, covered in batches:
+                if covered.isdisjoint(cone) and address not in covered and cone.isdisjoint(batch):
+                    batch.append(address)
+                    covered.update(cone)
+                    break
+            else:
+                batches.append(([address], cone))
+
+        result = {address: {} for address in outputs}
+        evaluated = 0
+        for batch, covered in batches:
+            order = [address for input_addr in batch for address in cones[input_addr]]
+            values = self.evaluate_batch({address: bumps[address] for address in batch}, outputs, order)
+            evaluated += self.last_recalc
+            for input_addr in batch:
+                cone = set(cones[input_addr])
+                low, high = bumps[input_addr]
+                for output in outputs:
+                    base = baseline[output]
+                    if output in cone or output == input_addr:
+                        out_low, out_high = (v.item() if isinstance(v, np.generic) else v for v in values[output])
+                    else:
+                        out_low = out_high = base
+                    result[output][input_addr] = Sensitivity(low, high, out_low, out_high, base)
+
+        self.last_recalc = evaluated
+        logging.info("Sensitivity of {} outputs to {} inputs in {} batches, {} cells evaluated".format(
+            len(outputs), len(inputs), len(batches), evaluated))
 
         return result
 
+    def compile_module(self, inputs, outputs, cache=True):
+        '''
+        Compiles the cells between inputs and outputs to a python module, with one function per output taking the
+        inputs it depends on as keyword arguments, see codegen. Cells not depending on the inputs are frozen at their current values
+        @param inputs: addresses of the cells that become keyword arguments
+        @param outputs: addresses of the cells returned
+        @param cache: True to keep the module alongside the workbook, a folder to keep it in, or False
+        @return: module
+        '''
+        return compile_model(self, inputs, outputs, cache)
 
+    def share_model(self, name=None):
+        '''
+        Publishes the model in a shared memory segment that other processes map instead of loading the workbook,
+        each keeping its own changes in a Session, see sharedmodel
+        @param name: name of the segment, chosen by the system if None
+        @return: SharedModel. Other processes attach to it by its name
+        '''
+        return SharedModel(self, name)
+
+    def save_flat(self, path):
+        '''
+        Writes the model to a file of flat arrays that flat.load_model maps in place of loading the workbook
+        @param path: file to write, by convention ending in flat.FLAT_SUFFIX
+        @return: size of the file in bytes
+        '''
+        return save_model(self, path)
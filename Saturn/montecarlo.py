@@ -0,0 +1,214 @@
+"""
+Monte Carlo simulation of a Saturn model.
+
+Input cells are given distributions, samples are drawn in blocks and each block is evaluated with
+Loader.evaluate_batch, so memory is bounded by the block size rather than the number of samples. The cells that
+vary are worked out once for the whole run. Output summaries are updated block by block: mean and variance are
+merged exactly, percentiles come from a fixed size sketch.
+
+    sim = MonteCarlo(loader, {'Inputs!B2': Normal(100, 15), 'Inputs!B3': Empirical('History!C2:C500')},
+                     ['Outputs!B10'], seed=1)
+    summary = sim.run(100000)['Outputs!B10']
+    summary.mean, summary.std, summary.percentile(95)
+"""
+import logging
+import numpy as np
+from ranges import RangeRef
+
+
+class Normal:
+    """Normal distribution with the given mean and standard deviation"""
+
+    def __init__(self, mean, sd):
+        self.mean = mean
+        self.sd = sd
+
+    def sample(self, rng, size, loader):
+        return rng.normal(self.mean, self.sd, size)
+
+
+class Uniform:
+    """Uniform distribution between low and high"""
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng, size, loader):
+        return rng.uniform(self.low, self.high, size)
+
+
+class Triangular:
+    """Triangular distribution between low and high, peaking at mode"""
+
+    def __init__(self, low, mode, high):
+        self.low = low
+        self.mode = mode
+        self.high = high
+
+    def sample(self, rng, size, loader):
+        return rng.triangular(self.low, self.mode, self.high, size)
+
+
+class Empirical:
+    """
+    Resamples observed values with replacement. The values are either given directly or read from a range of the
+    model, e.g. 'History!C2:C500', in which case blanks and text are ignored
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self._observed = None
+
+    def sample(self, rng, size, loader):
+        if self._observed is None:
+            values = self.values
+            if isinstance(values, str):
+                values = loader.getrange(RangeRef.from_address(values)).ravel()
+            observed = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+            if not observed:
+                raise ValueError("No numeric values to resample in {}".format(self.values))
+            self._observed = np.array(observed, dtype=np.float64)
+        return rng.choice(self._observed, size)
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch of a distribution for approximate percentiles. Keeps at most `size` weighted points: each
+    block is merged in and adjacent points are pooled back down to equal weight groups, so the error of a
+    percentile is about 1/size of the range of ranks
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.points = np.empty(0)
+        self.weights = np.empty(0)
+
+    def update(self, values):
+        points = np.concatenate([self.points, values])
+        weights = np.concatenate([self.weights, np.ones(len(values))])
+        order = np.argsort(points, kind='stable')
+        points, weights = points[order], weights[order]
+
+        if len(points) > self.size:
+            # Group by cumulative weight into `size` buckets of equal weight, each kept as its weighted mean
+            cumulative = np.cumsum(weights)
+            groups = np.minimum((cumulative - weights / 2) * self.size // cumulative[-1], self.size - 1).astype(int)
+            total = np.bincount(groups, weights)
+            keep = total > 0
+            points = (np.bincount(groups, weights * points) / np.where(keep, total, 1))[keep]
+            weights = total[keep]
+
+        self.points, self.weights = points, weights
+
+    def percentile(self, q):
+        '''
+        @param q: percentile between 0 and 100
+        @return: approximate value below which q percent of the samples fall, or nan if there are none
+        '''
+        if not len(self.points):
+            return float('nan')
+        cumulative = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q / 100 * self.weights.sum(), cumulative, self.points))
+
+
+class Summary:
+    """
+    Running statistics of one output. Blocks are merged with Chan's parallel update, so the mean and variance
+    are exact whatever the block size
+    """
+
+    def __init__(self, sketch_size=1000):
+        self.count = 0
+        self.errors = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.sketch = QuantileSketch(sketch_size)
+
+    def update(self, values):
+        '''
+        Adds a block of samples. Values that are not numbers, i.e. Excel errors, are counted separately
+        @param values: 1-D array of output values
+        '''
+        if values.dtype.kind not in 'biuf':
+            numeric = np.array([isinstance(v, (int, float)) and not isinstance(v, bool) for v in values], dtype=bool)
+            self.errors += int(len(values) - numeric.sum())
+            values = values[numeric].astype(np.float64)
+        values = values.astype(np.float64)
+        if not len(values):
+            return
+
+        count = len(values)
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sketch.update(values)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+    def percentile(self, q):
+        return self.sketch.percentile(q)
+
+    def __repr__(self):
+        return 'Summary(count={}, mean={:.6g}, std={:.6g}, p5={:.6g}, p50={:.6g}, p95={:.6g})'.format(
+            self.count, self.mean, self.std, self.percentile(5), self.percentile(50), self.percentile(95))
+
+
+class MonteCarlo:
+    """
+    Runs a model over random draws of its inputs
+    """
+
+    def __init__(self, loader, distributions, outputs, seed=None, block_size=1000, sketch_size=1000):
+        '''
+        @param loader: Loader of the model
+        @param distributions: dictionary with format {address: distribution}
+        @param outputs: addresses of the cells to summarise
+        @param seed: seed of the random generator, for reproducible runs
+        @param block_size: number of samples evaluated at once
+        @param sketch_size: number of points kept per output to estimate percentiles
+        '''
+        self.loader = loader
+        self.distributions = distributions
+        self.outputs = list(outputs)
+        self.rng = np.random.default_rng(seed)
+        self.block_size = block_size
+        self.sketch_size = sketch_size
+        self.order = None
+
+    def run(self, samples):
+        '''
+        Draws and evaluates samples block by block
+        @param samples: total number of samples
+        @return: dictionary with format {address: Summary}
+        '''
+        if self.order is None:
+            self.order = self.loader.batchOrder(self.distributions, self.outputs)
+        summaries = {address: Summary(self.sketch_size) for address in self.outputs}
+
+        done = 0
+        while done < samples:
+            size = min(self.block_size, samples - done)
+            inputs = {address: dist.sample(self.rng, size, self.loader)
+                      for address, dist in self.distributions.items()}
+            results = self.loader.evaluate_batch(inputs, self.outputs, self.order)
+            for address, values in results.items():
+                summaries[address].update(values)
+            done += size
+
+        logging.info("Ran {} samples over {} cells".format(samples, len(self.order)))
+        return summaries
@@ -0,0 +1,335 @@
+"""
+Recalculation of independent parts of a model across a pool of processes.
+
+The dirty cells needed for the requested outputs are split into weakly connected components, which are packed
+into one bin per worker and calculated in one round. When a single component holds most of the work, its cells
+are split by topological level instead: cells on a level only read earlier levels, so each level is shared out
+between the workers and the rounds run level by level. The dirty cells of a group of copied-down formulas make one
+node of the graph, as in Loader.recalculate, and a group cut between workers runs as one vector per worker.
+
+Workers are forked, so each starts from a copy-on-write image of the Loader as it was when the pool started and
+nothing is pickled on the way in. Results come back through a block of shared memory holding a float64 value and
+a state byte per cell, which later rounds read their precedents from. Values that are not numbers, such as text
+and errors, come back with the task result instead.
+"""
+import gc
+import os
+import heapq
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+# Fewest dirty cells worth starting worker processes for
+MIN_CELLS = 2000
+
+# Fewest cells per worker on an average level for level by level rounds
+MIN_CHUNK = 250
+
+# States of a cell in the exchange
+PENDING, FLOAT, INT, OBJECT, FAILED = range(5)
+
+# Largest magnitude of an int that survives the round trip through a float64
+MAX_EXACT_INT = 2 ** 53
+
+# Set by calculate_parallel before the pool starts and inherited by the forked workers:
+# (loader, {address: slot}, ValueExchange)
+_work = None
+
+
+class ValueExchange:
+    """
+    Shared memory block with one float64 value and one state byte per cell of the work
+    """
+
+    def __init__(self, size):
+        self.memory = shared_memory.SharedMemory(create=True, size=max(9 * size, 1))
+        self.values = np.ndarray(size, dtype=np.float64, buffer=self.memory.buf)
+        self.states = np.ndarray(size, dtype=np.uint8, buffer=self.memory.buf, offset=8 * size)
+        self.states[:] = PENDING
+
+    def put(self, slot, value):
+        '''
+        Stores a value if it is a number
+        @return: False if the value has to be passed some other way
+        '''
+        if type(value) is float:
+            self.values[slot] = value
+            self.states[slot] = FLOAT
+        elif type(value) is int and -MAX_EXACT_INT <= value <= MAX_EXACT_INT:
+            self.values[slot] = value
+            self.states[slot] = INT
+        else:
+            self.states[slot] = OBJECT
+            return False
+        return True
+
+    def get(self, slot):
+        '''
+        @return: number stored in a slot in FLOAT or INT state
+        '''
+        value = self.values[slot].item()
+        return int(value) if self.states[slot] == INT else value
+
+    def close(self):
+        # Views into the buffer have to go before it can be closed
+        del self.values, self.states
+        self.memory.close()
+        self.memory.unlink()
+
+
+def work_graph(loader, roots):
+    '''
+    Dirty cells needed for the roots, found with the same walk as Loader.recalculate but without calculating.
+    Dirty cells of a group of copied-down formulas make one node, so the graph stays small for long columns
+    @return: (list of the cells of each node, list of the sets of precedent nodes of each node, list of the nodes
+    with precedents first)
+    '''
+    groups = loader.formulaGroups()
+    owner = {}
+    members = []
+    precs = []
+    order = []
+    tried = set()
+
+    def visit(address):
+        node = len(members)
+        group = groups.get(address)
+        cells = None
+        if group is not None and group not in tried:
+            tried.add(group)
+            indexes = loader.dirtyIndexes(group)
+            if indexes is not None:
+                cells = [group.addresses[index] for index in indexes]
+                pending = loader.groupPrecedents(group, indexes)
+        if cells is None:
+            cells = [address]
+            pending = loader.dirtyPrecedents(address)
+        for cell in cells:
+            owner[cell] = node
+        members.append(cells)
+        precs.append(set())
+        return node, pending
+
+    for root in roots:
+        cell = loader.cells.get(root)
+        if root in owner or cell is None or not cell.needs_calc:
+            continue
+        stack = [visit(root)]
+        while stack:
+            node, pending = stack[-1]
+            for prec in pending:
+                if prec not in owner:
+                    stack.append(visit(prec))
+                    precs[node].add(owner[prec])
+                    break
+                precs[node].add(owner[prec])
+            else:
+                stack.pop()
+                order.append(node)
+    return members, precs, order
+
+
+def components(precs):
+    '''
+    Weakly connected components of the work graph, by union-find over its precedent links
+    @return: list of lists of node numbers
+    '''
+    parent = list(range(len(precs)))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for node, linked in enumerate(precs):
+        for prec in linked:
+            a, b = find(node), find(prec)
+            if a != b:
+                parent[a] = b
+
+    parts = {}
+    for node in range(len(precs)):
+        parts.setdefault(find(node), []).append(node)
+    return list(parts.values())
+
+
+def levels(precs, order):
+    '''
+    Topological levels of the work graph. Nodes of a level only read nodes of earlier levels
+    @param precs: precedent nodes of each node, with no circular references among them
+    @param order: nodes with precedents first
+    @return: list of lists of node numbers
+    '''
+    level = {}
+    found = []
+    for node in order:
+        depth = 1 + max((level[prec] for prec in precs[node]), default=-1)
+        level[node] = depth
+        if depth == len(found):
+            found.append([])
+        found[depth].append(node)
+    return found
+
+
+def pack(parts, sizes, bins):
+    '''
+    Packs components into bins of about equal numbers of cells, largest first
+    @param parts: lists of node numbers
+    @param sizes: number of cells of each part
+    @return: list of non empty lists of node numbers
+    '''
+    heap = [(0, index, []) for index in range(bins)]
+    for size, part in sorted(zip(sizes, parts), key=lambda item: item[0], reverse=True):
+        total, index, nodes = heapq.heappop(heap)
+        nodes.extend(part)
+        heapq.heappush(heap, (total + size, index, nodes))
+    return [nodes for total, index, nodes in heap if nodes]
+
+
+def split(items, chunks):
+    '''
+    @return: list of up to `chunks` contiguous slices of about equal size
+    '''
+    size = -(-len(items) // chunks)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def schedule(loader, members, precs, order, workers):
+    '''
+    Splits the work graph into tasks
+    @return: list of rounds, each a list of (addresses to calculate, addresses calculated in earlier rounds that
+    they read) tasks that can run at the same time, or None if the work does not split well
+    '''
+    total = sum(map(len, members))
+    parts = components(precs)
+    sizes = [sum(len(members[node]) for node in part) for part in parts]
+    if len(parts) > 1 and max(sizes) <= total / 2:
+        logging.info("Packing {} independent parts of the model into {} tasks".format(len(parts), workers))
+        return [[([address for node in nodes for address in members[node]], [])
+                 for nodes in pack(parts, sizes, workers)]]
+
+    if any(address in loader.cycles for cells in members for address in cells):
+        return None
+    found = levels(precs, order)
+    if total / len(found) < workers * MIN_CHUNK:
+        return None
+
+    logging.info("Splitting {} cells on {} levels between {} workers".format(total, len(found), workers))
+    rounds = []
+    for level in found:
+        # Long groups are cut between the workers, so each cell is paired with its node to find what it reads
+        pairs = [(address, node) for node in level for address in members[node]]
+        tasks = []
+        for chunk in split(pairs, workers):
+            reads = set(prec for node in set(node for address, node in chunk) for prec in precs[node])
+            tasks.append(([address for address, node in chunk],
+                          [address for prec in sorted(reads) for address in members[prec]]))
+        rounds.append(tasks)
+    return rounds
+
+
+def _calculate(addresses, reads, objects):
+    '''
+    Task run in a worker. Values of precedents calculated in earlier rounds are copied in from the exchange,
+    then the cells are calculated and their values copied out
+    @param addresses: cells to calculate
+    @param reads: cells calculated in earlier rounds that they read
+    @param objects: values that are not numbers of those cells, by address
+    @return: (number of cells calculated, {address: value} for values that are not numbers)
+    '''
+    loader, slots, exchange = _work
+    cells = loader.cells
+    states = exchange.states
+    written = []
+    for address in reads:
+        state = states[slots[address]]
+        if state == PENDING or state == FAILED:
+            continue
+        loader.storeValue(cells[address], objects[address] if state == OBJECT else exchange.get(slots[address]))
+        written.append(address)
+    loader.dropCached(written)
+
+    # Groups of copied-down formulas only run over the cells of this task, not those left to other workers
+    loader.scope = set(addresses)
+    start = loader.calc_count
+    loader.recalculate(addresses)
+
+    results = {}
+    for address in addresses:
+        cell = cells[address]
+        if cell.needs_calc:
+            states[slots[address]] = FAILED
+        elif not exchange.put(slots[address], cell.value):
+            results[address] = cell.value
+    return loader.calc_count - start, results
+
+
+def calculate_parallel(loader, roots, workers=None):
+    '''
+    Calculates the dirty cells needed for the roots across a pool of worker processes. Falls back to
+    Loader.recalculate when the work is too small or does not split well, or where processes cannot be forked
+    @param loader: Loader
+    @param roots: addresses of the cells wanted
+    @param workers: number of worker processes, os.cpu_count() if None
+    @return: number of cells calculated
+    '''
+    global _work
+    workers = workers or os.cpu_count() or 1
+    rounds = None
+    if workers > 1 and len(loader.dirty) >= MIN_CELLS:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            members, precs, order = work_graph(loader, roots)
+            if sum(map(len, members)) >= MIN_CELLS:
+                rounds = schedule(loader, members, precs, order, workers)
+        else:
+            logging.info("Worker processes cannot be forked here, calculating in this process")
+    if rounds is None:
+        return loader.recalculate(roots)
+
+    work = [address for tasks in rounds for addresses, reads in tasks for address in addresses]
+    slots = {address: slot for slot, address in enumerate(work)}
+    exchange = ValueExchange(len(work))
+    _work = (loader, slots, exchange)
+    calculated = 0
+    objects = {}
+    # Objects made so far are left out of garbage collection in the workers, which would otherwise touch, and so
+    # copy, every page of the model
+    gc.freeze()
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, max(map(len, rounds))),
+                                 mp_context=multiprocessing.get_context('fork')) as pool:
+            for tasks in rounds:
+                futures = [pool.submit(_calculate, addresses, reads,
+                                       {address: objects[address] for address in reads if address in objects})
+                           for addresses, reads in tasks]
+                for future in futures:
+                    count, results = future.result()
+                    calculated += count
+                    objects.update(results)
+
+        cells = loader.cells
+        values = exchange.values.tolist()
+        states = exchange.states.tolist()
+        written = []
+        for address, value, state in zip(work, values, states):
+            if state == FAILED:
+                loader.markFailed(address)
+            if state == PENDING or state == FAILED:
+                continue
+            value = objects[address] if state == OBJECT else int(value) if state == INT else value
+            loader.storeValue(cells[address], value)
+            written.append(address)
+        # Values calculated elsewhere, so nothing worked out in this process from the old ones can stand
+        loader.dropCached(written)
+    finally:
+        gc.unfreeze()
+        _work = None
+        exchange.close()
+
+    loader.calc_count += calculated
+    logging.info("Calculated {} cells in {} rounds on {} workers".format(calculated, len(rounds), workers))
+    return calculated
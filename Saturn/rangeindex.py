@@ -0,0 +1,181 @@
+"""
+Interval index answering "which ranges cover this cell?".
+
+Ranges are indexed in centered interval trees over their rows, per sheet and column. Each tree node keeps the
+ranges that span its center row twice, sorted by first row and by last row, so a stabbing query only visits
+ranges whose rows contain the queried row and then checks their columns. Memory grows with the number of ranges, not with
+the number of cells they cover.
+"""
+from ranges import split_address
+
+MAX_ROW = 1048576
+MAX_COL = 16384
+
+
+class _Node:
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, entries):
+        # Median of the midpoints keeps the tree balanced
+        mids = sorted((e[0] + e[1]) // 2 for e in entries)
+        self.center = center = mids[len(mids) // 2]
+
+        here, left, right = [], [], []
+        for entry in entries:
+            if entry[1] < center:
+                left.append(entry)
+            elif entry[0] > center:
+                right.append(entry)
+            else:
+                here.append(entry)
+
+        self.by_start = sorted(here, key=lambda e: e[0])
+        self.by_end = sorted(here, key=lambda e: e[1], reverse=True)
+        self.left = _Node(left) if left else None
+        self.right = _Node(right) if right else None
+
+    def stab(self, row, col, found):
+        node = self
+        while node is not None:
+            if row < node.center:
+                for entry in node.by_start:
+                    if entry[0] > row:
+                        break
+                    if entry[2] <= col <= entry[3]:
+                        found.append(entry[4])
+                node = node.left
+            elif row > node.center:
+                for entry in node.by_end:
+                    if entry[1] < row:
+                        break
+                    if entry[2] <= col <= entry[3]:
+                        found.append(entry[4])
+                node = node.right
+            else:
+                found.extend(entry[4] for entry in node.by_start if entry[2] <= col <= entry[3])
+                return found
+        return found
+
+
+class _SheetIndex:
+    """Interval tree for one group of ranges, rebuilt lazily after enough changes"""
+
+    def __init__(self):
+        self.entries = {}
+        self.root = None
+        self.pending = []
+        self.removed = set()
+
+    def add(self, key, entry):
+        if key in self.removed:
+            # Stale copy still sits in the tree
+            self.root = None
+        self.entries[key] = entry
+        self.pending.append(entry)
+        self._maybe_rebuild()
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.removed.add(key)
+            self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        # Small edits are answered by scanning the pending list. Rebuild once they are a sizeable share
+        if len(self.pending) + len(self.removed) > max(64, len(self.entries) // 4):
+            self.root = None
+
+    def stab(self, row, col):
+        if self.root is None and self.entries:
+            self.root = _Node(list(self.entries.values()))
+            self.pending = []
+            self.removed = set()
+
+        found = []
+        if self.root is not None:
+            self.root.stab(row, col, found)
+        for entry in self.pending:
+            if entry[0] <= row <= entry[1] and entry[2] <= col <= entry[3]:
+                found.append(entry[4])
+        if self.removed:
+            found = [item for item in found if item not in self.removed]
+        return found
+
+
+class RangeIndex:
+    """
+    Maps range precedents to their dependents. Supports stabbing queries by cell.
+
+    Ranges spanning a few columns are indexed in one interval tree per column they cover, so a query only
+    meets ranges of its own column. Wider ranges go to one shared tree per sheet and are filtered by column
+    """
+
+    # Ranges up to this many columns wide are indexed per column
+    NARROW_COLS = 8
+
+    def __init__(self):
+        self.entries = {}
+        self.trees = {}
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _tree_keys(self, ref, entry):
+        if entry[3] - entry[2] < self.NARROW_COLS:
+            return [(ref.sheet, col) for col in range(entry[2], entry[3] + 1)]
+        return [(ref.sheet, None)]
+
+    def add(self, ref, dependent):
+        '''
+        Registers a dependent of a range
+        @param ref: RangeRef of the range
+        @param dependent: address of the formula cell referring to the range
+        '''
+        key = (ref, dependent)
+        if key in self.entries:
+            return
+        max_row = MAX_ROW if ref.max_row is None else ref.max_row
+        max_col = MAX_COL if ref.max_col is None else ref.max_col
+        entry = (ref.min_row, max_row, ref.min_col, max_col, key)
+        self.entries[key] = entry
+        self.counts[ref] = self.counts.get(ref, 0) + 1
+        for tree_key in self._tree_keys(ref, entry):
+            self.trees.setdefault(tree_key, _SheetIndex()).add(key, entry)
+
+    def remove(self, ref, dependent):
+        key = (ref, dependent)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.counts[ref] -= 1
+            if not self.counts[ref]:
+                del self.counts[ref]
+            for tree_key in self._tree_keys(ref, entry):
+                self.trees[tree_key].remove(key)
+
+    def users(self, ref):
+        '''
+        @return: number of formulas referring to the range
+        '''
+        return self.counts.get(ref, 0)
+
+    def query(self, sheet, row, col):
+        '''
+        Stabbing query
+        @return: list of (RangeRef, dependent) for every indexed range covering the cell
+        '''
+        found = []
+        for tree_key in ((sheet, col), (sheet, None)):
+            tree = self.trees.get(tree_key)
+            if tree is not None:
+                found.extend(tree.stab(row, col))
+        return found
+
+    def dependents(self, address):
+        '''
+        @param address: address in the format 'Sheet!A1'
+        @return: list of addresses of formulas depending on the cell through a range
+        '''
+        return [dep for ref, dep in self.query(*split_address(address))]
+
+    def items(self):
+        return iter(self.entries)
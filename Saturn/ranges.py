@@ -0,0 +1,97 @@
+import numpy as np
+from collections import namedtuple
+from openpyxl.utils import range_boundaries, get_column_letter
+from openpyxl.utils.cell import coordinate_to_tuple
+
+
+def to_array(rows):
+    '''
+    Packs range values into a 2-D numpy array
+    @param rows: list of rows, each a list of cell values
+    @return: float64 array if all values are numbers (not bools or blanks), object array otherwise
+    '''
+    if all(type(v) in (int, float) for row in rows for v in row):
+        return np.array(rows, dtype=np.float64).reshape(len(rows), len(rows[0]) if rows else 0)
+
+    # Filled element by element so that values which are arrays themselves are stored as they are
+    array = np.empty((len(rows), len(rows[0]) if rows else 0), dtype=object)
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            array[i, j] = value
+    return array
+
+
+def split_address(address):
+    '''
+    Splits a cell address into its parts
+    @param address: address in the format 'Sheet!A1'
+    @return: (sheet, row, col)
+    '''
+    sheet, coordinate = address.rsplit('!', 1)
+    row, col = coordinate_to_tuple(coordinate)
+    return sheet, row, col
+
+
+class RangeRef(namedtuple('RangeRef', 'sheet min_row min_col max_row max_col')):
+    """
+    Compact descriptor of a rectangular range of cells. Addresses of the cells in the range are only generated
+    when they are iterated. A max_row or max_col of None means the range is unbounded in that direction,
+    as in whole column (A:A) or whole row (1:1) references
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_address(cls, address):
+        '''
+        @param address: range address in the format 'Sheet!A1:B2', 'Sheet!A:B' or 'Sheet!1:2'
+        @return: RangeRef
+        '''
+        sheet, ref = address.rsplit('!', 1)
+        min_col, min_row, max_col, max_row = range_boundaries(ref)
+        return cls(sheet, min_row or 1, min_col or 1, max_row, max_col)
+
+    def __str__(self):
+        if self.max_row is None:
+            return '{}!{}:{}'.format(self.sheet, get_column_letter(self.min_col), get_column_letter(self.max_col))
+        if self.max_col is None:
+            return '{}!{}:{}'.format(self.sheet, self.min_row, self.max_row)
+        return '{}!{}{}:{}{}'.format(self.sheet, get_column_letter(self.min_col), self.min_row,
+                                     get_column_letter(self.max_col), self.max_row)
+
+    def contains(self, sheet, row, col):
+        '''
+        Tests whether a cell lies inside the range
+        @return: True if the cell at (sheet, row, col) is part of the range
+        '''
+        return (sheet == self.sheet and
+                self.min_row <= row and (self.max_row is None or row <= self.max_row) and
+                self.min_col <= col and (self.max_col is None or col <= self.max_col))
+
+    def bounds(self, max_row=None, max_col=None):
+        '''
+        Bounds of the range, with unbounded sides clipped to the given limits
+        @param max_row: last used row of the sheet, used when the range has no max_row
+        @param max_col: last used column of the sheet, used when the range has no max_col
+        @return: (min_row, min_col, max_row, max_col)
+        '''
+        last_row = self.max_row if self.max_row is not None else max(max_row or 0, self.min_row - 1)
+        last_col = self.max_col if self.max_col is not None else max(max_col or 0, self.min_col - 1)
+        return self.min_row, self.min_col, last_row, last_col
+
+    def rows(self, max_row=None, max_col=None):
+        '''
+        Generates the addresses of the cells in the range, one list per row
+        @return: generator of lists of 'Sheet!A1' addresses
+        '''
+        min_row, min_col, last_row, last_col = self.bounds(max_row, max_col)
+        prefixes = ['{}!{}'.format(self.sheet, get_column_letter(col)) for col in range(min_col, last_col + 1)]
+        for row in range(min_row, last_row + 1):
+            yield ['{}{}'.format(prefix, row) for prefix in prefixes]
+
+    def addresses(self, max_row=None, max_col=None):
+        '''
+        Generates the addresses of the cells in the range, row by row
+        @return: generator of 'Sheet!A1' addresses
+        '''
+        for row in self.rows(max_row, max_col):
+            yield from row
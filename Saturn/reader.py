@@ -0,0 +1,238 @@
+import re
+import logging
+import posixpath
+from zipfile import ZipFile
+from xml.etree.ElementTree import iterparse, fromstring
+from openpyxl.formula.translate import Translator
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.xml.constants import (
+    SHEET_MAIN_NS,
+    REL_NS,
+    PKG_REL_NS,
+    ARC_ROOT_RELS,
+    ARC_WORKBOOK,
+)
+
+FLOAT_REGEX = re.compile(r"\.|[E-e]")
+COORD_REGEX = re.compile(r"^([A-Z]+)(\d+)$")
+
+TAG_ROW = '{%s}row' % SHEET_MAIN_NS
+TAG_CELL = '{%s}c' % SHEET_MAIN_NS
+TAG_FORMULA = '{%s}f' % SHEET_MAIN_NS
+TAG_VALUE = '{%s}v' % SHEET_MAIN_NS
+TAG_INLINE = '{%s}is' % SHEET_MAIN_NS
+TAG_TEXT = '{%s}t' % SHEET_MAIN_NS
+TAG_SI = '{%s}si' % SHEET_MAIN_NS
+TAG_SHEET = '{%s}sheet' % SHEET_MAIN_NS
+TAG_CALC_PR = '{%s}calcPr' % SHEET_MAIN_NS
+TAG_RELATIONSHIP = '{%s}Relationship' % PKG_REL_NS
+
+WORKSHEET_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet'
+OFFICE_DOCUMENT_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+SHARED_STRINGS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings'
+
+
+def _cast_number(value):
+    '''
+    Converts a number stored as a string to an int or float, same as openpyxl does
+    @param value: string read from a <v> element
+    @return: int or float
+    '''
+    if FLOAT_REGEX.search(value) is not None:
+        return float(value)
+    return int(value)
+
+
+def _text_content(node):
+    '''
+    Joins all <t> runs below a node. Used for shared strings and inline strings, which may be rich text
+    @param node: <si> or <is> element
+    @return: plain string
+    '''
+    return ''.join(t.text or '' for t in node.iter(TAG_TEXT))
+
+
+def _resolve(base, target):
+    '''
+    Resolves a relationship target relative to the part that owns the relationship
+    @param base: path of the owning part inside the archive, e.g. xl/workbook.xml
+    @param target: Target attribute of the relationship
+    @return: path inside the archive
+    '''
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), target))
+
+
+def _rels_path(part):
+    folder, name = posixpath.split(part)
+    return posixpath.join(folder, '_rels', name + '.rels')
+
+
+def _read_rels(archive, part):
+    '''
+    Reads the relationships of a part
+    @return: dictionary with format {rId: (type, resolved path)}
+    '''
+    rels = {}
+    path = _rels_path(part)
+    if path not in archive.namelist():
+        return rels
+    for rel in fromstring(archive.read(path)).iter(TAG_RELATIONSHIP):
+        if rel.get('TargetMode') == 'External':
+            continue
+        rels[rel.get('Id')] = (rel.get('Type'), _resolve(part, rel.get('Target')))
+    return rels
+
+
+def _workbook_path(archive):
+    if ARC_ROOT_RELS in archive.namelist():
+        for rel in fromstring(archive.read(ARC_ROOT_RELS)).iter(TAG_RELATIONSHIP):
+            if rel.get('Type') == OFFICE_DOCUMENT_REL:
+                return _resolve('', rel.get('Target'))
+    return ARC_WORKBOOK
+
+
+def read_shared_strings(archive, path):
+    '''
+    Streams the shared string table
+    @return: list of strings indexed by their position in the table
+    '''
+    strings = []
+    with archive.open(path) as src:
+        for _, node in iterparse(src):
+            if node.tag == TAG_SI:
+                strings.append(_text_content(node))
+                node.clear()
+    return strings
+
+
+def read_sheets(archive):
+    '''
+    Lists the worksheets of a workbook in tab order
+    @return: list of (sheet name, path of the sheet xml inside the archive) and the workbook relationships
+    '''
+    workbook = _workbook_path(archive)
+    rels = _read_rels(archive, workbook)
+    sheets = []
+    for sheet in fromstring(archive.read(workbook)).iter(TAG_SHEET):
+        rel_type, path = rels.get(sheet.get('{%s}id' % REL_NS), (None, None))
+        # Chartsheets and dialog sheets have no cells
+        if rel_type == WORKSHEET_REL:
+            sheets.append((sheet.get('name'), path))
+    return sheets, rels
+
+
+def read_calc_settings(file):
+    '''
+    Iterative calculation settings of a workbook, from the calcPr element of the workbook part
+    @param file: path or binary file object of an xlsx file
+    @return: dictionary with keys iterate, max_iterations and max_change. Excel's defaults where not set
+    '''
+    settings = {'iterate': False, 'max_iterations': 100, 'max_change': 0.001}
+    with ZipFile(file) as archive:
+        calc = fromstring(archive.read(_workbook_path(archive))).find(TAG_CALC_PR)
+    if calc is not None:
+        settings['iterate'] = calc.get('iterate') in ('1', 'true')
+        settings['max_iterations'] = int(calc.get('iterateCount', settings['max_iterations']))
+        settings['max_change'] = float(calc.get('iterateDelta', settings['max_change']))
+    return settings
+
+
+def read_sheet(archive, path, shared_strings):
+    '''
+    Streams one worksheet, reading the formula and the cached value of each cell in the same pass
+    @param archive: open ZipFile of the workbook
+    @param path: path of the sheet xml inside the archive
+    @param shared_strings: shared string table
+    @return: generator of (coordinate, value, formula). Formula is None for hardcoded cells
+    '''
+    shared_formulas = {}
+    row_idx = 0
+    col_idx = 0
+
+    with archive.open(path) as src:
+        for _, node in iterparse(src):
+            if node.tag == TAG_ROW:
+                # Cells have been consumed as they were closed. Drop the row to keep memory flat
+                node.clear()
+                row_idx += 1
+                col_idx = 0
+                continue
+
+            if node.tag != TAG_CELL:
+                continue
+
+            coordinate = node.get('r')
+            if coordinate is None:
+                # Some writers omit the reference. Cells then follow each other from column A
+                col_idx += 1
+                coordinate = '{}{}'.format(get_column_letter(col_idx), row_idx + 1)
+            else:
+                col, row = COORD_REGEX.match(coordinate).groups()
+                col_idx = column_index_from_string(col)
+                row_idx = int(row) - 1
+
+            data_type = node.get('t', 'n')
+            value = None
+            formula = None
+
+            for child in node:
+                if child.tag == TAG_VALUE:
+                    text = child.text
+                    if text is None:
+                        continue
+                    if data_type == 's':
+                        value = shared_strings[int(text)]
+                    elif data_type == 'b':
+                        value = bool(int(text))
+                    elif data_type == 'n':
+                        value = _cast_number(text)
+                    else:
+                        # str, e (error code) and d (ISO date) are kept as text
+                        value = text
+
+                elif child.tag == TAG_INLINE:
+                    value = _text_content(child)
+
+                elif child.tag == TAG_FORMULA:
+                    kind = child.get('t')
+                    if kind == 'shared':
+                        si = child.get('si')
+                        if child.text:
+                            # First cell of a shared formula holds the text. Others are translated from it
+                            shared_formulas[si] = Translator('=' + child.text, coordinate)
+                            formula = '=' + child.text
+                        elif si in shared_formulas:
+                            formula = shared_formulas[si].translate_formula(coordinate)
+                    elif kind == 'dataTable':
+                        # Data tables are computed by Excel's what-if engine. Keep the cached values
+                        continue
+                    elif child.text:
+                        formula = '=' + child.text
+
+            node.clear()
+
+            if value is not None or formula is not None:
+                yield coordinate, value, formula
+
+
+def read_cells(file):
+    '''
+    Streams every non empty cell of a workbook, one sheet after the other
+    @param file: path or binary file object of an xlsx file
+    @return: generator of ('Sheet!A1', value, formula). Formula is the value itself for hardcoded cells,
+    matching what openpyxl returns with data_only=False
+    '''
+    with ZipFile(file) as archive:
+        sheets, rels = read_sheets(archive)
+
+        strings_path = next((p for t, p in rels.values() if t == SHARED_STRINGS_REL), None)
+        shared_strings = read_shared_strings(archive, strings_path) if strings_path else []
+        logging.info("Read {} shared strings".format(len(shared_strings)))
+
+        for sheet, path in sheets:
+            logging.info("Streaming sheet {} from {}".format(sheet, path))
+            for coordinate, value, formula in read_sheet(archive, path, shared_strings):
+                address = "{}!{}".format(sheet, coordinate)
+                yield address, value, value if formula is None else formula
@@ -1,7 +1,7 @@
 import logging
 from fastnumbers import fast_real
 from tokenizer import Token
-from openpyxl.utils import range_boundaries, get_column_letter
+from ranges import RangeRef
 
 class RPNNode:
 
@@ -14,14 +14,18 @@ class RPNNode:
     @classmethod
     def create(self, token, sheet=None):
         if token.type == Token.OPERAND:
-            #First lets check if token is a range and have has no sheet, in which case add sheet name to token value
-            if token.subtype == Token.RANGE and '!' not in token.value and ':' in token.value:
-                token.value = '{}!{}'.format(sheet, token.value)
-                return RangeNode(token)
-
-            elif token.subtype == Token.RANGE and '!' not in token.value and ':' not in token.value:
-                token.value = '{}!{}'.format(sheet, token.value)
-                return CellNode(token)
+            #First lets check if token is a range. If it has no sheet, add sheet name to token value
+            if token.subtype == Token.RANGE:
+                if '!' in token.value:
+                    ref_sheet, ref = token.value.rsplit('!', 1)
+                    token.value = '{}!{}'.format(ref_sheet.strip("'"), ref)
+                else:
+                    token.value = '{}!{}'.format(sheet, token.value)
+
+                if ':' in token.value:
+                    return RangeNode(token)
+                else:
+                    return CellNode(token)
 
             # Then lets check if token is a number, in which case update assign float or int to token value
             elif token.subtype == Token.NUMBER:
@@ -32,6 +36,11 @@ class RPNNode:
                 token.value = token.value == 'TRUE'
                 return OperandNode(token)
 
+            # Strip the quotes around string literals
+            elif token.subtype == Token.TEXT and token.value.startswith('"'):
+                token.value = token.value[1:-1].replace('""', '"')
+                return OperandNode(token)
+
             # Token must be subtype Text, Logical or Error - in which case do nothing
             else:
                 return OperandNode(token)
@@ -64,41 +73,13 @@ class CellNode(OperandNode):
 class RangeNode(OperandNode):
     def __init__(self, token):
         super().__init__(token)
-        self.prec_in_range = None
-        self.rangeadds = self.rangecells()
-
-
-
-    def rangecells(self):
-        if self.token.subtype == Token.RANGE:
-            split_addrs = self.token.value.split('!')
-            sheet = split_addrs[0]
-            addresses = split_addrs[1]
-            return self.computeRangeCells(addresses,sheet)
-
-
-    def computeRangeCells(self,rn, sheet):
-        x = range_boundaries(rn)
-
-        cols = list(range(min(x[0], x[2]), max(x[0], x[2])))
-        cols.append(max(x[0], x[2]))
-        cols = list(map(get_column_letter, cols))
-
-        rows = list(range(min(x[1], x[3]), max(x[1], x[3])))
-        rows.append(max(x[1], x[3]))
-
-        final = []
-        flat_final = []
-        for row in rows:
-            slice=[]
-            for col in cols:
-                add_str = '{}!{}{}'.format(sheet, col, row)
-                slice.append(add_str)
-                flat_final.append(add_str)
-            final.append(slice)
+        # Compact (sheet, min_row, min_col, max_row, max_col) descriptor. Addresses are generated on demand
+        self.ref = RangeRef.from_address(token.value)
+        self.prec_in_range = self.ref
 
-        self.prec_in_range = flat_final
-        return final
+    @property
+    def rangeadds(self):
+        return list(self.ref.rows())
 
 
 class FunctionNode(RPNNode):
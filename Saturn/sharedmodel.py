@@ -0,0 +1,81 @@
+"""
+One flat model in shared memory, served by many processes.
+
+The owner, typically the master process of a pool of web workers, loads the workbook once and publishes it:
+
+    shared = loader.share_model('budget')
+
+Each worker then maps the same pages instead of holding its own Loader, and keeps only what a request changes in
+a Session of its own:
+
+    model = attach('budget')
+    session = model.session()
+    session.setvalue(0.05, 'Inputs!B3')
+    session.getvalues(['Summary!C10'])
+
+The segment holds the arrays of flat.flatten: addresses, programs, precedents and dependents, and the baseline
+values. It is read only once written, so workers never need to lock it.
+"""
+import os
+import logging
+from multiprocessing import shared_memory, resource_tracker
+from flat import flatten, layout_size, write_layout, FlatModel
+
+
+class SharedModel:
+    """
+    Owner of a shared memory segment holding a flat model. The segment lives until close is called
+    """
+
+    def __init__(self, loader, name=None):
+        '''
+        @param loader: Loader of the model. Its formulas are calculated first, see flat.flatten
+        @param name: name of the segment, chosen by the system if None
+        '''
+        arrays, settings = flatten(loader)
+        self.memory = shared_memory.SharedMemory(name=name, create=True, size=layout_size(arrays, settings))
+        write_layout(self.memory.buf, arrays, settings)
+        self.name = self.memory.name
+        self.size = self.memory.size
+        logging.info("Shared model {} in {} bytes".format(self.name, self.size))
+
+    def model(self):
+        '''
+        @return: FlatModel over the segment, for use in this process
+        '''
+        return FlatModel(self.memory.buf)
+
+    def close(self):
+        '''
+        Removes the segment. Models attached to it must be dropped first in this process, while other processes
+        keep their mappings until they exit
+        '''
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach(name):
+    '''
+    Maps a model shared by another process
+    @param name: name of the segment, SharedModel.name
+    @return: FlatModel over the segment
+    '''
+    try:
+        # Only the owner removes the segment
+        memory = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before python 3.13 attaching registers the segment with the resource tracker of this process, which
+        # removes it when the process exits. Processes started by the owner share its tracker, and leave it be
+        inherited = getattr(resource_tracker._resource_tracker, '_fd', None) is not None
+        memory = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix' and not inherited:
+            resource_tracker.unregister(memory._name, 'shared_memory')
+    model = FlatModel(memory.buf)
+    model.memory = memory
+    return model
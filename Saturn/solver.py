@@ -0,0 +1,115 @@
+"""
+One-dimensional root finding for goal seek.
+
+Starts with secant steps from the current value of the changing cell. As soon as two trials bracket the root,
+it switches to Brent's method, which keeps the root bracketed and falls back to bisection when interpolation
+steps go astray.
+"""
+import math
+from collections import namedtuple
+
+EPSILON = 2.220446049250313e-16
+
+GoalSeekResult = namedtuple('GoalSeekResult', 'value target converged iterations evaluated')
+GoalSeekResult.__doc__ = '''
+Outcome of Loader.goal_seek
+@value: value of the changing cell
+@target: value of the target cell it leads to
+@converged: True if the target is within tolerance of the goal
+@iterations: number of trial values, each a recalculation of the cells between changing cell and target
+@evaluated: number of cells calculated over all iterations
+'''
+
+
+def find_root(f, x0, tolerance=1e-9, max_iterations=100):
+    '''
+    Finds x such that f(x) is 0
+    @param f: function of one number. Returns nan where it is undefined
+    @param x0: starting point
+    @param tolerance: largest acceptable abs(f(x))
+    @param max_iterations: largest number of calls to f
+    @return: (x, f(x), number of calls to f, converged)
+    '''
+    calls = 0
+
+    def call(x):
+        nonlocal calls
+        calls += 1
+        return f(x)
+
+    x0 = float(x0)
+    f0 = call(x0)
+    if math.isnan(f0) or abs(f0) <= tolerance:
+        return x0, f0, calls, not math.isnan(f0)
+
+    x1 = x0 + (abs(x0) * 0.01 or 0.01)
+    f1 = call(x1)
+
+    # Secant steps until the root is bracketed
+    while calls < max_iterations:
+        if math.isnan(f1):
+            return x0, f0, calls, False
+        if abs(f1) <= tolerance:
+            return x1, f1, calls, True
+        if (f0 < 0) != (f1 < 0):
+            return _brent(call, x0, x1, f0, f1, tolerance, max_iterations - calls, lambda: calls)
+        if f1 == f0:
+            # Flat, the secant has nowhere to go
+            return x1, f1, calls, False
+        x0, f0, x1 = x1, f1, x1 - f1 * (x1 - x0) / (f1 - f0)
+        f1 = call(x1)
+
+    best = (x1, f1) if abs(f1) < abs(f0) else (x0, f0)
+    return best[0], best[1], calls, False
+
+
+def _brent(f, a, b, fa, fb, tolerance, max_calls, calls):
+    '''
+    Brent's method on a bracket [a, b] where fa and fb have opposite signs
+    '''
+    c, fc = a, fa
+    d = e = b - a
+    for _ in range(max_calls):
+        if (fb > 0) == (fc > 0):
+            c, fc = a, fa
+            d = e = b - a
+        if abs(fc) < abs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+
+        tol = 2 * EPSILON * abs(b)
+        middle = 0.5 * (c - b)
+        if abs(fb) <= tolerance:
+            return b, fb, calls(), True
+        if abs(middle) <= tol:
+            # Bracket cannot shrink further, e.g. at a discontinuity
+            return b, fb, calls(), False
+
+        if abs(e) >= tol and abs(fa) > abs(fb):
+            # Inverse quadratic interpolation, or secant when only two points are distinct
+            s = fb / fa
+            if a == c:
+                p = 2 * middle * s
+                q = 1 - s
+            else:
+                q = fa / fc
+                r = fb / fc
+                p = s * (2 * middle * q * (q - r) - (b - a) * (r - 1))
+                q = (q - 1) * (r - 1) * (s - 1)
+            if p > 0:
+                q = -q
+            p = abs(p)
+            if 2 * p < min(3 * middle * q - abs(tol * q), abs(e * q)):
+                e, d = d, p / q
+            else:
+                d = e = middle
+        else:
+            d = e = middle
+
+        a, fa = b, fb
+        b += d if abs(d) > tol else math.copysign(tol, middle)
+        fb = f(b)
+        if math.isnan(fb):
+            return a, fa, calls(), False
+
+    return b, fb, calls(), abs(fb) <= tolerance
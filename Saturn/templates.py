@@ -0,0 +1,403 @@
+"""
+Formula templates and column-wise evaluation of copied-down formulas.
+
+Each formula is normalised at load to an R1C1 style template, in which references not fixed with $ are offsets
+from the cell holding the formula. =C5*D5-E5 in F5 and =C6*D6-E6 in F6 then share the template
+=RC[-3]*RC[-2]-RC[-1]. Contiguous rows of a column holding the same template form a FormulaGroup, which is
+evaluated as one program run over column vectors, one value per row, with the batch helpers, instead of one run
+per cell.
+
+A group is only formed when no cell of it reads another cell of it, e.g. =F4*1.1 in F5, and when every range it
+reads keeps its shape from row to row. Running totals such as =SUM($B$2:B5) are left to windows.
+"""
+import re
+import math
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
+from openpyxl.utils import column_index_from_string, get_column_letter
+from rpnnode import CellNode, RangeNode, FunctionNode
+from ranges import RangeRef, split_address
+from batch import Scenarios, call_batched
+from excellib import INFIX_OPERATORS, PREFIX_OPERATORS, POSTFIX_OPERATORS
+from vm import compile_rpn, execute, CONST, CELL, RANGE, CALL, BINARY, UNARY, WINDOW
+
+
+# Fewest rows worth a vector run, both for forming a group and for the dirty cells of a group at recalculation
+MIN_ROWS = 16
+
+# Operators that act element by element on vectors of numbers. & makes text, and is left to cells one by one
+VECTOR_OPERATORS = set(func for symbol, func in INFIX_OPERATORS.items() if symbol != '&')
+VECTOR_OPERATORS.update(PREFIX_OPERATORS.values(), POSTFIX_OPERATORS.values())
+
+# Largest magnitude of an int kept exactly in a float64. Ints beyond it are left to cells one by one
+MAX_EXACT_INT = 2 ** 53
+
+CORNER = re.compile(r'^(\$?)([A-Za-z]{1,3})?(\$?)(\d+)?$')
+
+
+Reference = namedtuple('Reference', 'sheet corners')
+Reference.__doc__ = '''
+A reference in R1C1 form
+@sheet: sheet name
+@corners: one (row, row_relative, col, col_relative) tuple per corner, with rows and columns relative to the
+formula cell where not fixed with $. Row or col is None in whole column and whole row references
+'''
+
+
+def reference(text, address):
+    '''
+    Normalises a reference as written in a formula to R1C1 form
+    @param text: reference with its $ signs, e.g. 'Data!$B$2:B5'
+    @param address: address of the cell holding the formula
+    @return: Reference, or the text as it is if it is not a plain cell or range reference, e.g. a defined name
+    '''
+    sheet, row, col = origin(address)
+    coordinate = text
+    if '!' in text:
+        sheet, coordinate = text.rsplit('!', 1)
+        sheet = sheet.strip("'")
+
+    corners = []
+    for part in coordinate.split(':'):
+        match = CORNER.match(part)
+        if match is None or not (match.group(2) or match.group(4)):
+            return text
+        col_fixed, letters, row_fixed, digits = match.groups()
+        ref_row = ref_col = None
+        if digits:
+            ref_row = int(digits) if row_fixed else int(digits) - row
+        if letters:
+            ref_col = column_index_from_string(letters.upper())
+            ref_col = ref_col if col_fixed else ref_col - col
+        corners.append((ref_row, bool(digits and not row_fixed), ref_col, bool(letters and not col_fixed)))
+    return Reference(sheet, tuple(corners))
+
+
+@lru_cache(maxsize=64)
+def origin(address):
+    '''
+    split_address, cached for the few references of each formula
+    '''
+    return split_address(address)
+
+
+def template(rpn):
+    '''
+    @param rpn: list of RPN nodes of a formula, made by Cell.make_node
+    @return: hashable R1C1 template of the formula
+    '''
+    entries = []
+    for node in rpn:
+        if isinstance(node, (CellNode, RangeNode)):
+            entries.append(getattr(node, 'r1c1', node.token.value))
+        else:
+            value = node.token.value
+            entries.append((type(node).__name__, type(value).__name__, value, getattr(node, 'num_args', None)))
+    return tuple(entries)
+
+
+def row_span(entry, first_row, last_row):
+    '''
+    Rows read by a reference of a template over a run of rows
+    @return: (top, bottom), with None for unbounded sides
+    '''
+    tops, bottoms = [], []
+    for ref_row, relative, ref_col, col_relative in entry.corners:
+        if ref_row is None:
+            return None, None
+        tops.append(ref_row + first_row if relative else ref_row)
+        bottoms.append(ref_row + last_row if relative else ref_row)
+    return min(tops), max(bottoms)
+
+
+def reads_itself(entries, sheet, col, first_row, last_row):
+    '''
+    Tests whether any reference of a template falls on its own rows of the column
+    @return: True if a cell of the run reads another cell of the run, or itself
+    '''
+    for entry in entries:
+        if entry.sheet != sheet:
+            continue
+        cols = [ref_col + col if relative else ref_col
+                for ref_row, row_relative, ref_col, relative in entry.corners if ref_col is not None]
+        if len(cols) == len(entry.corners) and not min(cols) <= col <= max(cols):
+            continue
+        top, bottom = row_span(entry, first_row, last_row)
+        if (top is None or top <= last_row) and (bottom is None or bottom >= first_row):
+            return True
+    return False
+
+
+def vectorisable(entries, volatile):
+    '''
+    Tests whether a template can be evaluated over column vectors
+    @param entries: template entries
+    @param volatile: names of functions whose result changes from call to call
+    @return: True if every reference is R1C1 and keeps its shape from row to row, and no function is volatile
+    '''
+    for entry in entries:
+        if isinstance(entry, Reference):
+            if len(set(relative for ref_row, relative, ref_col, col_relative in entry.corners)) > 1:
+                # One side moves with the row and the other does not, e.g. a running total
+                return False
+        elif isinstance(entry, str):
+            return False
+        elif entry[0] == FunctionNode.__name__ and entry[2].upper() in volatile:
+            return False
+    return True
+
+
+class FormulaGroup:
+    """
+    Formula cells on contiguous rows of a column sharing a template
+    """
+
+    def __init__(self, sheet, col, rows, addresses, rpn):
+        '''
+        @param rows: rows of the cells, contiguous and ascending
+        @param addresses: addresses of the cells
+        @param rpn: RPN nodes of the first cell's formula
+        '''
+        self.sheet = sheet
+        self.col = col
+        self.rows = rows
+        self.addresses = addresses
+        self.program = compile_rpn(rpn)
+
+        # Addresses of cells that failed to calculate, see Loader.calculateGroup
+        self.failed = set()
+        self.moving = [entry.corners[0][1] for entry in template(rpn) if isinstance(entry, Reference)]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __repr__(self):
+        return 'FormulaGroup<{}!{}{}:{}{}>'.format(self.sheet, get_column_letter(self.col), self.rows[0],
+                                                   get_column_letter(self.col), self.rows[-1])
+
+    def precedents(self, indexes):
+        '''
+        What some cells of the group read, with each moving reference widened to the rows it covers over them
+        @param indexes: ascending indexes of the cells in the group
+        @return: generator of addresses and RangeRefs
+        '''
+        first, last = indexes[0], indexes[-1]
+        moving = iter(self.moving)
+        for opcode, arg in self.program:
+            if opcode not in (CELL, RANGE, WINDOW):
+                continue
+            ref = arg[1] if opcode == WINDOW else arg
+            if not next(moving):
+                yield ref
+            elif opcode == CELL:
+                sheet, row, col = split_address(ref)
+                yield RangeRef(sheet, row + first, col, row + last, col)
+            else:
+                yield ref._replace(min_row=ref.min_row + first, max_row=ref.max_row + last)
+
+    def row_program(self, index):
+        '''
+        @param index: index of a cell in the group
+        @return: program of the cell, with the references that move with the row moved to it
+        '''
+        program = []
+        moving = iter(self.moving)
+        for opcode, arg in self.program:
+            if opcode in (CELL, RANGE, WINDOW) and next(moving):
+                if opcode == CELL:
+                    sheet, row, col = split_address(arg)
+                    arg = '{}!{}{}'.format(sheet, get_column_letter(col), row + index)
+                elif opcode == RANGE:
+                    arg = arg._replace(min_row=arg.min_row + index, max_row=arg.max_row + index)
+                else:
+                    func, ref = arg
+                    arg = (func, ref._replace(min_row=ref.min_row + index, max_row=ref.max_row + index))
+            program.append((opcode, arg))
+        return tuple(program)
+
+    def evaluate(self, indexes, load_cells, load_range, load_window):
+        '''
+        Evaluates some cells of the group in one run of its program over column vectors. References that move
+        with the row load one float64 value per cell, others load once. Cells where a moving reference holds
+        anything but a number, e.g. a blank, text or an error, are left to be calculated one by one, as are cells
+        whose result is not finite, e.g. where numpy divides by zero. Values come back with the types the cells
+        would get one by one, see match_types
+        @param indexes: indexes of the cells in the group. Rows are contiguous, so an index is also the row offset
+        from the first cell
+        @param load_cells: function returning the values of cells given a list of their addresses. Cells read must
+        be clean
+        @param load_range: function returning the values of a range given its RangeRef
+        @param load_window: function answering WINDOW instructions over ranges that do not move
+        @return: list of values, one per index, with None for those that need calculating cell by cell
+        '''
+        inexact = np.zeros(len(indexes), dtype=bool)
+        ints = []
+        vectors = []
+        program = []
+        moving = iter(self.moving)
+        for opcode, arg in self.program:
+            if opcode in (CELL, RANGE, WINDOW) and next(moving):
+                ref = arg[1] if opcode == WINDOW else arg
+                if opcode == CELL:
+                    sheet, row, col = split_address(ref)
+                    vector = column_vector(sheet, [row + index for index in indexes], col, load_cells, inexact,
+                                           ints)
+                else:
+                    vector = range_vectors(ref, indexes, load_cells, inexact, ints)
+                program.append((CELL, len(vectors)))
+                vectors.append(vector)
+                if opcode == WINDOW:
+                    program.append((CALL, (arg[0], 1, False)))
+            elif opcode in (BINARY, UNARY) and arg not in VECTOR_OPERATORS:
+                raise ValueError("{} does not act element by element".format(arg.__name__))
+            elif opcode == CONST and not exact(arg):
+                raise ValueError("{} is too large for float64".format(arg))
+            else:
+                program.append((opcode, arg))
+
+        def load(key):
+            if isinstance(key, int):
+                return vectors[key]
+            value = load_cells([key])[0]
+            if not exact(value):
+                raise ValueError("{} holds {}, too large for float64".format(key, value))
+            return value
+
+        with np.errstate(all='ignore'):
+            result = execute(tuple(program), load, load_range, call_batched, load_window=load_window)
+
+        if isinstance(result, Scenarios):
+            values = result.tolist()
+        elif isinstance(result, np.ndarray):
+            raise ValueError("Formula returns a range")
+        else:
+            values = [result] * len(indexes)
+
+        for i, value in enumerate(values):
+            if isinstance(value, np.generic):
+                value = values[i] = value.item()
+            if inexact[i] or (isinstance(value, float) and not math.isfinite(value)):
+                values[i] = None
+        if isinstance(result, Scenarios):
+            self.match_types(indexes, values, result, ints, load_cells, load_range, load_window)
+        return values
+
+    def match_types(self, indexes, values, result, ints, load_cells, load_range, load_window):
+        '''
+        Vectors hold float64, but one by one int operands often give int, e.g. 3 rather than 3.0. Cells whose moving
+        references read ints in the same places get the same type one by one, so one cell of each such set is
+        calculated on its own and the others follow its type. Values that cannot take it, or that are past
+        MAX_EXACT_INT where float64 no longer holds every int, are left to be calculated one by one
+        @param values: values of the vector run, changed in place
+        @param result: Scenarios vector the values come from
+        @param ints: list of boolean arrays, one per moving reference, True where it read an int
+        '''
+        if len(ints) < 63:
+            codes = np.zeros(len(indexes), dtype=np.int64)
+            for bit, read in enumerate(ints):
+                codes |= read.astype(np.int64) << bit
+        else:
+            codes = np.unique(np.column_stack(ints), axis=0, return_inverse=True)[1].ravel()
+        numeric = result.dtype == np.float64
+        single = codes.min() == codes.max()
+        for code in [codes[0]] if single else np.unique(codes).tolist():
+            rows = np.arange(len(codes)) if single else np.flatnonzero(codes == code)
+            first = next((i for i in rows.tolist() if values[i] is not None), None)
+            if first is None:
+                continue
+            try:
+                sample = execute(self.row_program(indexes[first]), lambda address: load_cells([address])[0],
+                                 load_range, load_window=load_window)
+            except Exception:
+                sample = None
+            kind = type(sample)
+            if kind is float and numeric:
+                continue
+            if kind is int and numeric:
+                # Whole numbers become ints, others are left to be calculated one by one
+                numbers = result.view(np.ndarray)[rows]
+                whole = ((numbers == np.floor(numbers)) & (np.abs(numbers) <= MAX_EXACT_INT)).tolist()
+                numbers = np.where(whole, numbers, 0).astype(np.int64).tolist()
+                for i, is_whole, number in zip(rows.tolist(), whole, numbers):
+                    if values[i] is not None:
+                        values[i] = number if is_whole else None
+                continue
+            for i in rows.tolist():
+                value = values[i]
+                if value is None or type(value) is kind:
+                    continue
+                values[i] = int(value) if kind is int and type(value) is float and value.is_integer() else None
+
+
+def exact(value):
+    '''
+    @return: False for an int that float64 cannot hold exactly, True for anything else
+    '''
+    return type(value) is not int or -MAX_EXACT_INT <= value <= MAX_EXACT_INT
+
+
+def column_vector(sheet, rows, col, load_cells, inexact, ints):
+    '''
+    @param rows: rows of the cells of the column to load
+    @param inexact: boolean array, set where a value is not a number, or an int float64 cannot hold
+    @param ints: list to append a boolean array to, True where a value is an int
+    @return: float64 Scenarios vector of the values of the cells, nan where a value is not a number
+    '''
+    prefix = '{}!{}'.format(sheet, get_column_letter(col))
+    values = load_cells(['{}{}'.format(prefix, row) for row in rows])
+    types = set(map(type, values))
+    if types <= {int, float} and (int not in types or all(map(exact, values))):
+        ints.append(np.full(len(values), float not in types) if len(types) < 2
+                    else np.array([type(value) is int for value in values], dtype=bool))
+        return np.array(values, dtype=np.float64).view(Scenarios)
+    ints.append(np.array([type(value) is int for value in values], dtype=bool))
+    numbers = [type(value) is float or type(value) is int and exact(value) for value in values]
+    if not all(numbers):
+        values = [value if number else math.nan for value, number in zip(values, numbers)]
+        inexact |= ~np.array(numbers)
+    return np.array(values, dtype=np.float64).view(Scenarios)
+
+
+def range_vectors(ref, indexes, load_cells, inexact, ints):
+    '''
+    Values of a range that moves with the row, as a 2-D array holding one column vector per cell of the range
+    '''
+    if ref.max_row is None or ref.max_col is None:
+        raise ValueError("Range {} is unbounded".format(ref))
+    array = np.empty((ref.max_row - ref.min_row + 1, ref.max_col - ref.min_col + 1), dtype=object)
+    for i in range(array.shape[0]):
+        rows = [ref.min_row + i + index for index in indexes]
+        for j in range(array.shape[1]):
+            array[i, j] = column_vector(ref.sheet, rows, ref.min_col + j, load_cells, inexact, ints)
+    return array
+
+
+def find_groups(columns, cells, cycles, volatile):
+    '''
+    Groups formula cells by template over contiguous rows
+    @param columns: formula cells by column, see Loader.formulaColumns
+    @param cells: dictionary with format {address: Cell}
+    @param cycles: addresses of cells in circular references, never grouped
+    @param volatile: names of volatile functions, never grouped
+    @return: dictionary with format {address: FormulaGroup} for the grouped cells
+    '''
+    groups = {}
+    for (sheet, col), (rows, addresses) in columns.items():
+        start = 0
+        while start < len(rows):
+            key = cells[addresses[start]].template
+            stop = start + 1
+            while (stop < len(rows) and rows[stop] == rows[stop - 1] + 1 and
+                   cells[addresses[stop]].template == key):
+                stop += 1
+            run = addresses[start:stop]
+            if (key is not None and stop - start >= MIN_ROWS and vectorisable(key, volatile) and
+                    not reads_itself([e for e in key if isinstance(e, Reference)], sheet, col,
+                                     rows[start], rows[stop - 1]) and
+                    not any(address in cycles for address in run)):
+                group = FormulaGroup(sheet, col, rows[start:stop], run, cells[run[0]].rpn)
+                for address in run:
+                    groups[address] = group
+            start = stop
+    return groups
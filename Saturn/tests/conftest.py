@@ -0,0 +1,99 @@
+"""
+Shared helpers for the Saturn tests. Modules of Saturn import each other by name, as when run from the Saturn
+folder, so that folder is put on the path first.
+
+Results are checked against reference_values: every formula evaluated on its own by the stack machine, reading its
+precedents the same way, with no dirty tracking, shared sub-expressions, cumulative sums, grouping or caching.
+"""
+import os
+import sys
+import logging
+import pytest
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+from ranges import to_array
+from vm import execute
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    '''
+    Writes a workbook of one sheet, Sheet1
+    @return: function of ({address: value or formula}, name, calculation) returning the path of the xlsx file,
+    where calculation is a dictionary of calcPr attributes such as iterate and iterateCount
+    '''
+    def make(cells, name='book.xlsx', calculation=None):
+        wb = Workbook()
+        for key, value in (calculation or {}).items():
+            setattr(wb.calculation, key, value)
+        ws = wb.active
+        ws.title = 'Sheet1'
+        for address, value in cells.items():
+            ws[address] = value
+        path = str(tmp_path / name)
+        wb.save(path)
+        return path
+    return make
+
+
+def column(letter, formula, rows, first=1):
+    '''
+    A formula copied down a column of Sheet1, with {0} standing for the row
+    @return: dictionary with format {address: formula}
+    '''
+    return {'{}{}'.format(letter, row): formula.format(row) for row in range(first, first + rows)}
+
+
+def reference_values(loader):
+    '''
+    Values of all formula cells of a model without circular references, each formula evaluated on its own
+    @return: dictionary with format {address: value}
+    '''
+    values = {}
+
+    def load_cell(address):
+        cell = loader.cells.get(address)
+        if cell is None:
+            return None
+        if cell.program is None:
+            return cell.value
+        if address not in values:
+            values[address] = execute(cell.program, load_cell, load_range)
+        return values[address]
+
+    def load_range(ref):
+        max_row, max_col = loader.sheetExtent(ref.sheet)
+        return to_array([[load_cell(address) for address in adds] for adds in ref.rows(max_row, max_col)])
+
+    for address, cell in loader.cells.items():
+        if cell.program is not None:
+            load_cell(address)
+    return values
+
+
+def assert_same(values, expected):
+    '''
+    Values are equal, and of the same type, cell by cell
+    '''
+    for address, value in expected.items():
+        assert values[address] == value, address
+        assert type(values[address]) is type(value), address
+
+
+def assert_round_trip(model, loader, changes):
+    '''
+    A model stored and loaded again gives the values of the Loader it was stored from, before and after the
+    same changes are made to both
+    @param model: Loader or Session of the loaded model
+    @param changes: list of (address, value)
+    '''
+    expected = reference_values(loader)
+    assert_same(model.getvalues(list(expected)), expected)
+    for address, value in changes:
+        loader.setvalue(value, address)
+        model.setvalue(value, address)
+    expected = reference_values(loader)
+    assert_same(model.getvalues(list(expected)), expected)
@@ -0,0 +1,125 @@
+"""
+Analyses over inputs and outputs, against the model recalculated scenario by scenario.
+"""
+import os
+import math
+import numpy as np
+import pytest
+from conftest import column, reference_values, assert_same
+from loader import Loader
+from montecarlo import MonteCarlo, Empirical
+
+ROWS = 12
+
+INPUTS = ['Sheet1!Z1', 'Sheet1!Z2']
+
+OUTPUTS = ['Sheet1!E1', 'Sheet1!F1', 'Sheet1!B5']
+
+
+def model_book(workbook):
+    cells = {'A{}'.format(row): row for row in range(1, ROWS + 1)}
+    cells.update({'Z1': 2, 'Z2': 0.5, 'Z3': 10})
+    cells.update(column('B', '=A{0}*$Z$1', ROWS))
+    cells.update(column('C', '=B{0}^2*$Z$2+$Z$3', ROWS))
+    cells.update(column('D', '=A{0}+$Z$3', ROWS))
+    cells.update(column('G', '=C{0}-D{0}', ROWS))
+    cells['E1'] = '=SUM(C1:C12)/COUNT(C1:C12)'
+    cells['F1'] = '=MAX(B1:B12)-MIN(C1:C12)+SUM(D1:D12)'
+    return workbook(cells)
+
+
+def scalar_values(loader, scenario):
+    '''
+    Outputs of one scenario, set cell by cell and recalculated
+    @return: dictionary with format {address: value}
+    '''
+    for address, value in scenario.items():
+        loader.setvalue(value, address)
+    return loader.getvalues(OUTPUTS)
+
+
+def test_prune_matches_reference(workbook):
+    path = model_book(workbook)
+    full = Loader(path)
+    pruned = Loader(path)
+    assert pruned.prune(INPUTS, OUTPUTS) >= ROWS
+    assert 'Sheet1!G1' not in pruned.cells
+    assert pruned.cells['Sheet1!D1'].program is None
+    for scenario in ({'Sheet1!Z1': 3}, {'Sheet1!Z2': -1.25}, {'Sheet1!Z1': 0, 'Sheet1!Z2': 4}):
+        assert_same(scalar_values(pruned, scenario), scalar_values(full, scenario))
+        expected = reference_values(full)
+        assert_same(pruned.getvalues(OUTPUTS), {address: expected[address] for address in OUTPUTS})
+
+
+def test_compiled_module_matches_loader(workbook):
+    loader = Loader(model_book(workbook))
+    module = loader.compile_module(INPUTS, OUTPUTS, cache=False)
+    assert_same(module.calculate(), loader.getvalues(OUTPUTS))
+    for z1, z2 in ((3, 0.5), (2.5, -1), (0, 0)):
+        outputs = module.calculate(Sheet1_Z1=z1, Sheet1_Z2=z2)
+        assert_same(outputs, scalar_values(loader, {'Sheet1!Z1': z1, 'Sheet1!Z2': z2}))
+        assert outputs['Sheet1!E1'] == module.Sheet1_E1(Sheet1_Z1=z1, Sheet1_Z2=z2)
+
+
+def test_compiled_module_cache(workbook, tmp_path, monkeypatch):
+    folder = str(tmp_path / 'modules')
+    loader = Loader(model_book(workbook))
+    first = Loader(model_book(workbook)).compile_module(INPUTS, OUTPUTS, cache=folder)
+    assert len(os.listdir(folder)) == 1
+    monkeypatch.setattr('codegen.generate', lambda *args: pytest.fail('Module generated despite the cache'))
+    cached = loader.compile_module(INPUTS, OUTPUTS, cache=folder)
+    assert_same(cached.calculate(Sheet1_Z1=4), first.calculate(Sheet1_Z1=4))
+
+    # Functions of outputs only take the inputs they depend on
+    with pytest.raises(TypeError):
+        cached.Sheet1_B5(Sheet1_Z2=1)
+    assert cached.Sheet1_B5(Sheet1_Z1=3) == 15
+
+
+def test_sensitivity_matches_loader(workbook):
+    loader = Loader(model_book(workbook))
+    result = loader.sensitivity(INPUTS, OUTPUTS, bump=0.2)
+    reference = Loader(model_book(workbook))
+    baseline = reference.getvalues(OUTPUTS)
+    for input_addr, value in (('Sheet1!Z1', 2), ('Sheet1!Z2', 0.5)):
+        low = scalar_values(reference, {input_addr: value * 0.8})
+        high = scalar_values(reference, {input_addr: value * 1.2})
+        scalar_values(reference, {input_addr: value})
+        for output in OUTPUTS:
+            sensitivity = result[output][input_addr]
+            assert math.isclose(sensitivity.output_low, low[output], rel_tol=1e-12)
+            assert math.isclose(sensitivity.output_high, high[output], rel_tol=1e-12)
+            assert sensitivity.baseline == baseline[output]
+    assert loader.getvalues(OUTPUTS) == baseline
+
+
+def test_sensitivity_needs_numbers(workbook):
+    loader = Loader(model_book(workbook))
+    loader.setvalue('text', 'Sheet1!Z2')
+    with pytest.raises(ValueError):
+        loader.sensitivity(INPUTS, OUTPUTS)
+
+
+def test_montecarlo_matches_loader(workbook):
+    loader = Loader(model_book(workbook))
+    draws = [1, 2.5, 4, -3]
+    summary = MonteCarlo(loader, {'Sheet1!Z1': Empirical(draws)}, OUTPUTS, seed=1, block_size=64).run(200)
+    reference = Loader(model_book(workbook))
+    outputs = {value: scalar_values(reference, {'Sheet1!Z1': value}) for value in draws}
+    for output in OUTPUTS:
+        values = [outputs[value][output] for value in draws]
+        assert summary[output].count == 200
+        assert summary[output].min == min(values)
+        assert summary[output].max == max(values)
+        assert min(values) <= summary[output].mean <= max(values)
+
+    # The same seed draws the same samples
+    again = MonteCarlo(loader, {'Sheet1!Z1': Empirical(draws)}, OUTPUTS, seed=1, block_size=50).run(200)
+    assert np.isclose(again['Sheet1!E1'].mean, summary['Sheet1!E1'].mean)
+
+
+def test_empirical_needs_numbers(workbook):
+    loader = Loader(model_book(workbook))
+    sim = MonteCarlo(loader, {'Sheet1!Z1': Empirical(['a', None, True])}, OUTPUTS, seed=1)
+    with pytest.raises(ValueError):
+        sim.run(10)
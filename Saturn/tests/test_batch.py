@@ -0,0 +1,28 @@
+from loader import Loader, same_value
+
+INPUTS = [0, 1, 3, 2.5, -4]
+OUTPUTS = ['Sheet1!B1', 'Sheet1!C1', 'Sheet1!D1', 'Sheet1!E1', 'Sheet1!F1', 'Sheet1!G1']
+
+
+def batch_book(workbook):
+    return workbook({'A1': 1, 'A2': 2, 'B1': '=A1&"x"', 'C1': '=1/A1', 'D1': '=A1*2+A2', 'E1': '=SUM(A1:A2)/A1',
+                     'F1': '="v"&A1/2', 'G1': '=A2/(A1-A1)'})
+
+
+def test_batch_matches_scalar(workbook):
+    path = batch_book(workbook)
+    result = Loader(path).evaluate_batch({'Sheet1!A1': INPUTS}, OUTPUTS)
+
+    for index, value in enumerate(INPUTS):
+        loader = Loader(path)
+        loader.setvalue(value, 'Sheet1!A1')
+        # Scenarios holding both ints and floats are float64, so numbers compare by value, anything else exactly
+        for address, value in loader.getvalues(OUTPUTS).items():
+            assert same_value(result[address].tolist()[index], value), (address, index)
+
+
+def test_batch_concat_and_div0(workbook):
+    result = Loader(batch_book(workbook)).evaluate_batch({'Sheet1!A1': [0, 1, 3]}, OUTPUTS)
+    assert result['Sheet1!B1'].tolist() == ['0x', '1x', '3x']
+    assert result['Sheet1!C1'].tolist() == ['#DIV/0!', 1.0, 1 / 3]
+    assert result['Sheet1!G1'].tolist() == ['#DIV/0!'] * 3
@@ -0,0 +1,69 @@
+"""
+Loading models from the compiled model cache.
+"""
+import os
+import math
+import pytest
+from conftest import column, assert_round_trip
+from loader import Loader
+from cache import CACHE_SUFFIX
+
+ROWS = 20
+
+CHANGES = [('Sheet1!A3', 7.5), ('Sheet1!A12', -4), ('Sheet1!Z1', 'other')]
+
+
+def model_book(workbook, name='book.xlsx'):
+    cells = {'A{}'.format(row): row if row % 2 else row / 4 for row in range(1, ROWS + 1)}
+    cells['Z1'] = 'text'
+    cells.update(column('B', '=A{0}*3-1', ROWS))
+    cells.update(column('C', '=SUM(B$1:B{0})', ROWS))
+    cells.update(column('D', '=MAX(A{0},B{0})+MAX(A{0},B{0})/2', ROWS))
+    cells.update(column('E', '=$Z$1&A{0}', ROWS))
+    cells['F1'] = '=VLOOKUP(A3,A1:B20,2,FALSE)+SUMIF(A1:A20,">5")'
+    return workbook(cells, name)
+
+
+def load_twice(path, cache, monkeypatch):
+    '''
+    Loads a workbook with a cache, then again from the cache without reading the workbook
+    @return: both loaders
+    '''
+    first = Loader(path, cache=cache)
+    with monkeypatch.context() as patch:
+        patch.setattr(Loader, 'streamCells', lambda self: pytest.fail('Workbook read despite the cache'))
+        cached = Loader(path, cache=cache)
+    assert set(cached.cells) == set(first.cells)
+    return first, cached
+
+
+def test_cache_round_trip(workbook, tmp_path, monkeypatch):
+    folder = str(tmp_path / 'cache')
+    first, cached = load_twice(model_book(workbook), folder, monkeypatch)
+    assert [name for name in os.listdir(folder) if name.endswith(CACHE_SUFFIX)]
+    assert_round_trip(cached, first, CHANGES)
+
+
+def test_cache_alongside_workbook(workbook, monkeypatch):
+    path = model_book(workbook)
+    first, cached = load_twice(path, True, monkeypatch)
+    assert os.path.exists(path + CACHE_SUFFIX)
+    assert_round_trip(cached, first, CHANGES)
+
+
+def test_cache_keeps_cycles(workbook, tmp_path, monkeypatch):
+    path = workbook({'A1': '=B1/2+C1', 'B1': '=A1/2', 'C1': 1}, calculation={'iterate': True})
+    first, cached = load_twice(path, str(tmp_path / 'cache'), monkeypatch)
+    assert cached.iterate
+    assert cached.cycles.keys() == first.cycles.keys() == {'Sheet1!A1', 'Sheet1!B1'}
+    cached.setvalue(3, 'Sheet1!C1')
+    assert math.isclose(cached.getvalue('Sheet1!A1'), 4, abs_tol=1e-3)
+
+
+def test_changed_workbook_is_parsed_again(workbook, tmp_path):
+    folder = str(tmp_path / 'cache')
+    path = workbook({'A1': 2, 'B1': '=A1*3'})
+    assert Loader(path, cache=folder).getvalue('Sheet1!B1') == 6
+    workbook({'A1': 2, 'B1': '=A1*4'})
+    assert Loader(path, cache=folder).getvalue('Sheet1!B1') == 8
+    assert len(os.listdir(folder)) == 2
@@ -0,0 +1,64 @@
+import numpy as np
+from loader import Loader, same_value
+from templates import MIN_ROWS
+from conftest import column, reference_values
+
+ROWS = 2 * MIN_ROWS + 8
+
+
+def test_same_value():
+    assert same_value(3, 3.0)
+    assert same_value(2.5, 2.5)
+    assert not same_value(3, 3.5)
+    assert not same_value(True, 1)
+    assert not same_value(1.0, True)
+    assert not same_value('3', 3)
+    assert not same_value(None, 0)
+    assert same_value(np.array([[1.0, 2.0]]), np.array([[1.0, 2.0]]))
+    assert not same_value(np.array([[1.0, 2.0]]), np.array([[1.0, 3.0]]))
+
+
+def scaled_book(workbook):
+    cells = {'Z1': 1}
+    for row in range(1, ROWS + 1):
+        cells['A{}'.format(row)] = row
+    cells.update(column('B', '=A{0}*$Z$1', ROWS))
+    cells.update(column('C', '=MIN(B{0},10)', ROWS))
+    cells.update(column('D', '=C{0}+1', ROWS))
+    return workbook(cells)
+
+
+def test_getchanges_round_trip(workbook):
+    loader = Loader(scaled_book(workbook))
+    formulas = [address for address, cell in loader.cells.items() if cell.program is not None]
+    before = loader.getvalues(formulas)
+
+    loader.setvalue(2, 'Sheet1!Z1')
+    changes = loader.getchanges(formulas)
+    after = reference_values(loader)
+    assert changes == {address: (before[address], after[address]) for address in formulas
+                       if not same_value(before[address], after[address])}
+    assert 'Sheet1!B1' in changes and 'Sheet1!D1' in changes
+    # MIN caps the rows past 5, so nothing past C changes there
+    assert 'Sheet1!B20' in changes and 'Sheet1!C20' not in changes and 'Sheet1!D20' not in changes
+
+    loader.setvalue(1, 'Sheet1!Z1')
+    back = loader.getchanges(formulas)
+    assert back == {address: (new, old) for address, (old, new) in changes.items()}
+    assert loader.getvalues(formulas) == before
+
+
+def test_getchanges_cut_off(workbook):
+    loader = Loader(scaled_book(workbook))
+    formulas = [address for address, cell in loader.cells.items() if cell.program is not None]
+    loader.getvalues(formulas)
+
+    loader.setvalue(1, 'Sheet1!Z1')
+    assert loader.getchanges(formulas) == {}
+    assert loader.last_recalc == 0
+
+    # Only the rows below the cap are calculated past C
+    loader.setvalue(50, 'Sheet1!A30')
+    assert loader.getchanges(formulas) == {'Sheet1!B30': (30, 50)}
+    assert loader.last_recalc == 2
+    assert loader.getvalues(formulas) == reference_values(loader)
@@ -0,0 +1,79 @@
+"""
+Compiled criteria of SUMIF, COUNTIF, AVERAGEIF and the *IFS functions, against pycel's criteria_parser applied
+cell by cell.
+"""
+import numpy as np
+from pycel.excelutil import criteria_parser
+from conftest import column, reference_values, assert_same
+from loader import Loader
+from criteria import RangeView, compile_criteria
+
+VALUES = [1, 2.5, 7, -3, 0, 'north', 'North-east', 'south', '12', '', None, True, False, '#N/A', 'a?c', 'abc']
+
+CRITERIA = [7, 2.5, '7', '>5', '>=2.5', '<0', '<>0', '=', '<>', 'north', 'NORTH*', '*th', '?bc', '<m', '>=s',
+            '=abc', '<>south', '12', True, '#N/A']
+
+ROWS = 24
+
+
+def matches(check, value):
+    '''
+    pycel's check of one cell. Wildcards only match text, where pycel's check takes every cell to be text
+    '''
+    try:
+        return bool(check(value))
+    except AttributeError:
+        return False
+
+
+def test_compiled_criteria_match_pycel():
+    array = np.array(VALUES, dtype=object).reshape(4, 4)
+    view = RangeView(array)
+    for criteria in CRITERIA:
+        mask = compile_criteria(criteria)(view)
+        check = criteria_parser(criteria)
+        assert mask.ravel().tolist() == [matches(check, value) for value in VALUES], criteria
+
+
+def test_compiled_criteria_over_numbers():
+    array = np.arange(-5, 11, dtype=np.float64).reshape(4, 4)
+    view = RangeView(array)
+    for criteria in (3, '>2', '<=-1', '<>4', 'text', '=', '<>'):
+        mask = compile_criteria(criteria)(view)
+        check = criteria_parser(criteria)
+        assert mask.ravel().tolist() == [matches(check, value) for value in array.ravel().tolist()], criteria
+
+
+def criteria_book(workbook):
+    regions = ['north', 'south', 'east', 'west']
+    cells = {'A{}'.format(row): regions[row % 4] for row in range(1, ROWS + 1)}
+    cells.update({'B{}'.format(row): row * 1.5 if row % 3 else row for row in range(1, ROWS + 1)})
+    cells.update({'C{}'.format(row): 'x' if row % 5 == 0 else row % 7 for row in range(1, ROWS + 1)})
+    cells.update(column('D', '=SUMIF(B$1:B$24,">"&B{0})', ROWS))
+    cells.update(column('E', '=COUNTIF(A$1:A$24,A{0})', ROWS))
+    cells.update(column('F', '=AVERAGEIF(A$1:A$24,A{0},B$1:B$24)', ROWS))
+    cells.update(column('G', '=SUMIFS(B$1:B$24,A$1:A$24,A{0},C$1:C$24,"<"&C{0})', ROWS))
+    cells.update(column('H', '=COUNTIFS(A$1:A$24,"<>"&A{0},B$1:B$24,"<="&B{0})', ROWS))
+    cells.update(column('I', '=SUMIF(A$1:A$24,"*th",C$1:C$24)', ROWS))
+    return workbook(cells)
+
+
+def test_criteria_formulas(workbook):
+    loader = Loader(criteria_book(workbook))
+    a = [loader.getvalue('Sheet1!A{}'.format(row)) for row in range(1, ROWS + 1)]
+    b = [loader.getvalue('Sheet1!B{}'.format(row)) for row in range(1, ROWS + 1)]
+    assert loader.getvalue('Sheet1!D3') == sum(v for v in b if v > b[2])
+    assert loader.getvalue('Sheet1!E1') == a.count(a[0])
+    assert loader.getvalue('Sheet1!F2') == np.mean([v for r, v in zip(a, b) if r == a[1]])
+    expected = reference_values(loader)
+    assert_same(loader.getvalues(list(expected)), expected)
+
+
+def test_criteria_formulas_follow_changes(workbook):
+    loader = Loader(criteria_book(workbook))
+    loader.getvalues(list(reference_values(loader)))
+    for address, value in (('Sheet1!A3', 'North'), ('Sheet1!B7', 100), ('Sheet1!C2', 'x'), ('Sheet1!A5', 12),
+                           ('Sheet1!B7', 'n/a')):
+        loader.setvalue(value, address)
+        expected = reference_values(loader)
+        assert_same(loader.getvalues(list(expected)), expected)
@@ -0,0 +1,59 @@
+"""
+Circular references, calculated by iteration as in Excel's iterative calculation.
+"""
+import math
+from loader import Loader
+
+ITERATE = {'iterate': True}
+
+
+def test_cycle_converges(workbook):
+    loader = Loader(workbook({'A1': '=B1/2+C1', 'B1': '=A1/2', 'C1': 1, 'D1': '=A1+B1'}, calculation=ITERATE))
+    assert set(loader.cycles['Sheet1!A1']) == {'Sheet1!A1', 'Sheet1!B1'}
+    assert math.isclose(loader.getvalue('Sheet1!A1'), 4 / 3, abs_tol=1e-3)
+    assert math.isclose(loader.getvalue('Sheet1!D1'), 2, abs_tol=1e-3)
+    loader.setvalue(3, 'Sheet1!C1')
+    assert math.isclose(loader.getvalue('Sheet1!A1'), 4, abs_tol=1e-3)
+    assert math.isclose(loader.getvalue('Sheet1!B1'), 2, abs_tol=1e-3)
+    assert math.isclose(loader.getvalue('Sheet1!D1'), 6, abs_tol=1e-3)
+
+
+def test_cycle_through_range(workbook):
+    cells = {'A1': 10, 'A2': '=A4*0.1', 'A3': '=A4*0.2', 'A4': '=SUM(A1:A3)', 'B1': '=A4*2'}
+    loader = Loader(workbook(cells, calculation=ITERATE))
+    assert set(loader.cycles['Sheet1!A4']) == {'Sheet1!A2', 'Sheet1!A3', 'Sheet1!A4'}
+    assert math.isclose(loader.getvalue('Sheet1!A4'), 10 / 0.7, abs_tol=1e-2)
+    loader.setvalue(7, 'Sheet1!A1')
+    assert math.isclose(loader.getvalue('Sheet1!B1'), 20, abs_tol=1e-2)
+
+
+def test_iteration_settings(workbook):
+    calculation = {'iterate': True, 'iterateCount': 7, 'iterateDelta': 0.5}
+    loader = Loader(workbook({'A1': '=A1+1'}, calculation=calculation))
+    assert (loader.max_iterations, loader.max_change) == (7, 0.5)
+    assert loader.getvalue('Sheet1!A1') == 7
+    assert loader.last_iterations == 7
+
+
+def test_cycles_fail_without_iteration(workbook):
+    loader = Loader(workbook({'A1': '=B1/2+C1', 'B1': '=A1/2', 'C1': 1, 'D1': '=C1*2'}))
+    assert not loader.iterate
+    values = loader.getvalues(['Sheet1!A1', 'Sheet1!B1', 'Sheet1!D1'])
+    assert values == {'Sheet1!A1': None, 'Sheet1!B1': None, 'Sheet1!D1': 2}
+    assert loader.failed == {'Sheet1!A1', 'Sheet1!B1'}
+
+
+def test_failed_iteration_leaves_cycle_dirty(workbook):
+    cells = {'A1': '=B1/2+ABS(C1)', 'B1': '=A1/2', 'C1': 1, 'D1': '=A1+B1'}
+    loader = Loader(workbook(cells, calculation=ITERATE))
+    start = loader.getvalues(['Sheet1!A1', 'Sheet1!B1'])
+    assert math.isclose(start['Sheet1!A1'], 4 / 3, abs_tol=1e-3)
+
+    # Values are those from before the iteration, and the cells wait for a change that lets them calculate
+    loader.setvalue('x', 'Sheet1!C1')
+    assert loader.getvalues(['Sheet1!A1', 'Sheet1!B1']) == {'Sheet1!A1': None, 'Sheet1!B1': None}
+    assert [loader.cells[address].value for address in start] == list(start.values())
+    assert loader.failed == {'Sheet1!A1', 'Sheet1!B1'}
+    loader.setvalue(3, 'Sheet1!C1')
+    assert math.isclose(loader.getvalue('Sheet1!D1'), 6, abs_tol=1e-3)
+    assert not loader.failed and not loader.dirty
@@ -0,0 +1,115 @@
+"""
+Flat models, in shared memory or in a file, and the sessions that keep changes to them.
+"""
+import os
+import gc
+import math
+from conftest import column, assert_round_trip
+from loader import Loader
+from flat import FLAT_SUFFIX, load_model
+from sharedmodel import attach
+
+ROWS = 20
+
+CHANGES = [('Sheet1!A3', 7.5), ('Sheet1!A12', -4), ('Sheet1!Z1', 'other')]
+
+
+def model_book(workbook):
+    cells = {'A{}'.format(row): row if row % 2 else row / 4 for row in range(1, ROWS + 1)}
+    cells['Z1'] = 'text'
+    cells.update(column('B', '=A{0}*3-1', ROWS))
+    cells.update(column('C', '=SUM(B$1:B{0})', ROWS))
+    cells.update(column('D', '=MAX(A{0},B{0})+MAX(A{0},B{0})/2', ROWS))
+    cells.update(column('E', '=$Z$1&A{0}', ROWS))
+    cells['F1'] = '=VLOOKUP(A3,A1:B20,2,FALSE)+SUMIF(A1:A20,">5")'
+    return workbook(cells)
+
+
+def test_shared_round_trip(workbook):
+    loader = Loader(model_book(workbook))
+    with loader.share_model() as shared:
+        model = attach(shared.name)
+        session = model.session()
+        assert_round_trip(session, loader, CHANGES)
+
+        # Sessions keep their changes to themselves
+        other = shared.model().session()
+        assert other.getvalue('Sheet1!B3') == 8
+        assert session.getvalue('Sheet1!B3') == 21.5
+        assert session.getvalue('Sheet1!A3') == 7.5
+
+        # and drop them on reset
+        session.reset()
+        assert session.getvalue('Sheet1!B3') == 8
+        assert session.getvalue('Sheet1!E3') == 'text3'
+
+        # Models hold views of the segment, which can only be closed once they are gone
+        memory = model.memory
+        del session, other, model
+        gc.collect()
+        memory.close()
+
+
+def test_file_round_trip(workbook, tmp_path):
+    loader = Loader(model_book(workbook))
+    path = str(tmp_path / ('book' + FLAT_SUFFIX))
+    assert loader.save_flat(path) == os.path.getsize(path)
+    model = load_model(path)
+    assert len(model) == len(loader.cells)
+    assert_round_trip(model.session(), loader, CHANGES)
+
+    # Changes of sessions never reach the file
+    assert load_model(path).session().getvalue('Sheet1!B3') == 8
+
+
+def test_file_keeps_cycles(workbook, tmp_path):
+    calculation = {'iterate': True, 'iterateCount': 50, 'iterateDelta': 1e-6}
+    loader = Loader(workbook({'A1': '=B1/2+C1', 'B1': '=A1/2', 'C1': 1}, calculation=calculation))
+    path = str(tmp_path / ('book' + FLAT_SUFFIX))
+    loader.save_flat(path)
+    model = load_model(path)
+    assert (model.max_iterations, model.max_change) == (50, 1e-6)
+    session = model.session()
+    session.setvalue(3, 'Sheet1!C1')
+    assert math.isclose(session.getvalue('Sheet1!A1'), 4, abs_tol=1e-5)
+    assert math.isclose(session.getvalue('Sheet1!B1'), 2, abs_tol=1e-5)
+
+
+def test_failed_cell_dependents_recalculate(workbook, tmp_path):
+    loader = Loader(workbook({'A1': 'x', 'B1': '=ABS(A1)+1', 'C1': '=B1*2', 'D1': '=SUM(B1:B3)'}))
+    path = str(tmp_path / ('book' + FLAT_SUFFIX))
+    loader.save_flat(path)
+    session = load_model(path).session()
+    addresses = ['Sheet1!B1', 'Sheet1!C1', 'Sheet1!D1']
+    assert session.getvalues(addresses) == {'Sheet1!B1': None, 'Sheet1!C1': 0, 'Sheet1!D1': 0}
+    session.setvalue('y', 'Sheet1!A1')
+    assert session.getvalues(addresses) == {'Sheet1!B1': None, 'Sheet1!C1': 0, 'Sheet1!D1': 0}
+    session.setvalue(5, 'Sheet1!A1')
+    assert session.getvalues(addresses) == {'Sheet1!B1': 6, 'Sheet1!C1': 12, 'Sheet1!D1': 6}
+    assert not session.failed and not session.dirty
+
+
+def test_failed_iteration_leaves_cycle_dirty(workbook, tmp_path):
+    cells = {'A1': '=B1/2+ABS(C1)', 'B1': '=A1/2', 'C1': 1}
+    loader = Loader(workbook(cells, calculation={'iterate': True, 'iterateCount': 50, 'iterateDelta': 1e-6}))
+    path = str(tmp_path / ('book' + FLAT_SUFFIX))
+    loader.save_flat(path)
+    session = load_model(path).session()
+    session.setvalue('x', 'Sheet1!C1')
+    assert session.getvalues(['Sheet1!A1', 'Sheet1!B1']) == {'Sheet1!A1': None, 'Sheet1!B1': None}
+    assert len(session.failed) == 2 and not session.overlay.keys() & session.failed
+    session.setvalue(3, 'Sheet1!C1')
+    assert math.isclose(session.getvalue('Sheet1!A1'), 4, abs_tol=1e-5)
+    assert not session.failed and not session.dirty
+
+
+def test_empty_cells_in_ranges(workbook, tmp_path):
+    cells = {'A1': 1, 'A3': 2, 'B1': '=SUM(A1:A3)', 'E20': 0}
+    cells.update(column('C', '=SUM(D$1:D{0})', ROWS))
+    loader = Loader(workbook(cells))
+    path = str(tmp_path / ('book' + FLAT_SUFFIX))
+    loader.save_flat(path)
+    session = load_model(path).session()
+    assert_round_trip(session, loader, [('Sheet1!A2', 10), ('Sheet1!D5', 4), ('Sheet1!D12', 'x')])
+    assert session.getvalue('Sheet1!B1') == 13
+    assert session.getvalue('Sheet1!C20') == 4
@@ -0,0 +1,61 @@
+import pytest
+from loader import Loader
+from conftest import reference_values, assert_same
+
+
+def test_goal_seek_shared_subexpressions(workbook):
+    loader = Loader(workbook({'A1': 1, 'A2': 1, 'B1': '=MAX(A1,A2)*2', 'B2': '=MAX(A1,A2)+1'}))
+    loader.getvalues(['Sheet1!B1', 'Sheet1!B2'])
+
+    result = loader.goal_seek('Sheet1!B1', 10, 'Sheet1!A1')
+    assert result.converged
+    assert abs(result.value - 5) < 1e-6
+    assert abs(result.target - 10) < 1e-6
+
+    values = loader.getvalues(['Sheet1!B1', 'Sheet1!B2'])
+    expected = reference_values(loader)
+    assert abs(values['Sheet1!B1'] - expected['Sheet1!B1']) < 1e-9
+    assert abs(values['Sheet1!B2'] - expected['Sheet1!B2']) < 1e-9
+
+
+def test_goal_seek_window(workbook):
+    loader = Loader(workbook({'A1': 1, 'A2': 1, 'A3': 1, 'B1': '=SUM(A1:A3)*2'}))
+    assert loader.getvalue('Sheet1!B1') == 6
+
+    result = loader.goal_seek('Sheet1!B1', 10, 'Sheet1!A1')
+    assert result.converged
+    assert abs(result.value - 3) < 1e-6
+    assert abs(loader.getvalue('Sheet1!B1') - 10) < 1e-6
+
+
+def test_goal_seek_shared_window(workbook):
+    loader = Loader(workbook({'A1': 1, 'A2': 1, 'B1': '=SUM(A1:A2)*2', 'B2': '=SUM(A1:A2)+1'}))
+    loader.getvalues(['Sheet1!B1', 'Sheet1!B2'])
+
+    result = loader.goal_seek('Sheet1!B1', 10, 'Sheet1!A1')
+    assert result.converged
+    assert abs(result.value - 4) < 1e-6
+
+    values = loader.getvalues(['Sheet1!B1', 'Sheet1!B2'])
+    assert abs(values['Sheet1!B1'] - 10) < 1e-6
+    assert abs(values['Sheet1!B2'] - 6) < 1e-6
+
+
+def test_goal_seek_needs_a_value_upstream(workbook):
+    loader = Loader(workbook({'A1': 1, 'A2': 2, 'B1': '=A1*2', 'B2': '=A2+1'}))
+    with pytest.raises(ValueError):
+        loader.goal_seek('Sheet1!B1', 10, 'Sheet1!B2')
+    with pytest.raises(ValueError):
+        loader.goal_seek('Sheet1!B1', 10, 'Sheet1!A2')
+
+
+def test_goal_seek_unreachable(workbook):
+    loader = Loader(workbook({'A1': 3, 'B1': '=A1^2+1', 'C1': '=B1*2'}))
+    result = loader.goal_seek('Sheet1!B1', 0, 'Sheet1!A1', max_iterations=30)
+    assert not result.converged
+    assert result.iterations <= 30
+    assert loader.getvalue('Sheet1!A1') == result.value
+
+    # The model is left consistent with the value found
+    expected = reference_values(loader)
+    assert_same(loader.getvalues(list(expected)), expected)
@@ -0,0 +1,135 @@
+"""
+Loading and recalculation of a model by the Loader.
+"""
+import os
+from conftest import column, reference_values, assert_same
+from loader import Loader
+from templates import MIN_ROWS
+
+# Saved by Excel, so with the cached values that loading with openpyxl needs
+MODEL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TestModel_v1.xlsx')
+
+ROWS = 30
+
+
+def mixed_book(workbook):
+    cells = {'A{}'.format(row): row * 1.5 if row % 3 else row for row in range(1, ROWS + 1)}
+    cells['Z1'] = 'text'
+    cells.update(column('B', '=A{0}*2', ROWS))
+    cells.update(column('C', '=SUM(A$1:A{0})', ROWS))
+    cells.update(column('D', '=$Z$1&(B{0}-C{0})', ROWS))
+    cells.update(column('E', '=VLOOKUP(A{0},A$1:B$30,2,FALSE)', ROWS))
+    cells.update(column('F', '=SUMIF(A$1:A$30,">"&A{0})', ROWS))
+    cells.update(column('G', '=MATCH(B{0},B$1:B$30,0)', ROWS))
+    cells.update(column('I', '=COUNTIFS(A$1:A$30,"<"&A{0},B$1:B$30,">5")', ROWS))
+    cells['H1'] = '=SUM(B1:B30)/COUNT(A:A)'
+    return workbook(cells)
+
+
+def test_streaming_matches_openpyxl():
+    streamed = Loader(MODEL)
+    loaded = Loader(MODEL, streaming=False)
+    assert set(streamed.cells) == set(loaded.cells)
+    for address, cell in loaded.cells.items():
+        assert streamed.cells[address].formula == cell.formula, address
+        assert streamed.cells[address].value == cell.value, address
+    expected = reference_values(loaded)
+    assert_same(streamed.getvalues(list(expected)), expected)
+
+
+def test_streaming_reads_types(workbook):
+    loader = Loader(workbook({'A1': 1, 'A2': 2.5, 'A3': 'text', 'A4': True, 'A5': '=A1+A2'}))
+    expected = {'Sheet1!A1': 1, 'Sheet1!A2': 2.5, 'Sheet1!A3': 'text', 'Sheet1!A4': True}
+    assert_same({address: loader.cells[address].value for address in expected}, expected)
+    assert loader.cells['Sheet1!A5'].formula == '=A1+A2'
+    assert loader.getvalue('Sheet1!A5') == 3.5
+
+
+def test_setvalue_matches_reference(workbook):
+    loader = Loader(mixed_book(workbook))
+    loader.getvalues(list(reference_values(loader)))
+    for address, value in (('Sheet1!A4', 100), ('Sheet1!A10', 2.25), ('Sheet1!A4', 4), ('Sheet1!Z1', 'other')):
+        loader.setvalue(value, address)
+        expected = reference_values(loader)
+        assert_same(loader.getvalues(list(expected)), expected)
+
+
+def test_setvalue_recalculates_dependents_only(workbook):
+    cells = {'A{}'.format(row): row for row in range(1, ROWS + 1)}
+    cells.update(column('B', '=A{0}*2', ROWS))
+    cells['C1'] = '=SUM(B1:B30)'
+    loader = Loader(workbook(cells))
+    assert loader.getvalue('Sheet1!C1') == ROWS * (ROWS + 1)
+    loader.setvalue(105, 'Sheet1!A5')
+    assert loader.getvalue('Sheet1!C1') == ROWS * (ROWS + 1) + 200
+    assert loader.last_recalc == 2
+    assert not loader.dirty
+
+
+def test_deep_chain(workbook):
+    rows = 5000
+    cells = {'A{}'.format(row): '=A{}+1'.format(row - 1) for row in range(2, rows + 1)}
+    cells['A1'] = 1
+    cells.update({'B{}'.format(row): '=SUM(B{}:C{})'.format(row - 1, row - 1) for row in range(2, rows + 1)})
+    cells['B1'] = 1
+    loader = Loader(workbook(cells))
+    assert loader.getvalue('Sheet1!A{}'.format(rows)) == rows
+    assert loader.getvalue('Sheet1!B{}'.format(rows)) == 1
+    loader.setvalue(10, 'Sheet1!A1')
+    loader.setvalue(3, 'Sheet1!B1')
+    assert loader.getvalue('Sheet1!A{}'.format(rows)) == rows + 9
+    assert loader.getvalue('Sheet1!B{}'.format(rows)) == 3
+
+
+def test_getvalues_shares_precedents(workbook):
+    cells = {'A1': 1, 'B1': '=A1*2', 'D1': '=A1*3'}
+    cells.update(column('C', '=B$1+{0}', 5))
+    loader = Loader(workbook(cells))
+    outputs = ['Sheet1!C{}'.format(row) for row in range(1, 6)]
+    loader.getvalues(outputs + ['Sheet1!D1'])
+    loader.setvalue(5, 'Sheet1!A1')
+    assert loader.getvalues(outputs) == {address: 10 + row for row, address in enumerate(outputs, 1)}
+    assert loader.last_recalc == 6
+
+    # Cells the outputs do not read are left for later
+    assert loader.dirty == {'Sheet1!D1'}
+    assert loader.getvalue('Sheet1!D1') == 15
+
+
+def test_failed_cell_dependents_recalculate(workbook):
+    loader = Loader(workbook({'A1': 'x', 'B1': '=ABS(A1)+1', 'C1': '=B1*2', 'D1': '=SUM(B1:B3)'}))
+    addresses = ['Sheet1!B1', 'Sheet1!C1', 'Sheet1!D1']
+    assert loader.getvalues(addresses) == {'Sheet1!B1': None, 'Sheet1!C1': 0, 'Sheet1!D1': 0}
+    assert loader.failed == {'Sheet1!B1'}
+
+    # Failing again changes nothing
+    assert loader.getvalue('Sheet1!B1') is None
+    loader.setvalue(5, 'Sheet1!A1')
+    assert loader.getvalues(addresses) == {'Sheet1!B1': 6, 'Sheet1!C1': 12, 'Sheet1!D1': 6}
+    assert not loader.failed and not loader.dirty
+
+
+def test_failed_cell_in_chain(workbook):
+    rows = 3000
+    cells = {'A{}'.format(row): '=A{}+1'.format(row - 1) for row in range(3, rows + 1)}
+    cells.update({'A1': 'x', 'A2': '=ABS(A1)'})
+    loader = Loader(workbook(cells))
+    assert loader.getvalue('Sheet1!A{}'.format(rows)) == rows - 2
+    loader.setvalue(-10, 'Sheet1!A1')
+    assert loader.getvalue('Sheet1!A{}'.format(rows)) == rows + 8
+
+
+def test_failed_cells_of_copied_formulas(workbook):
+    rows = 2 * MIN_ROWS
+    cells = {'A{}'.format(row): 'x' if row % 7 == 0 else row for row in range(1, rows + 1)}
+    cells.update(column('B', '=ABS(A{0})+1', rows))
+    cells.update(column('C', '=B{0}*2', rows))
+    cells['D1'] = '=SUM(B1:B{})'.format(rows)
+    loader = Loader(workbook(cells))
+    loader.getvalues(['Sheet1!C{}'.format(row) for row in range(1, rows + 1)] + ['Sheet1!D1'])
+    assert loader.failed == {'Sheet1!B{}'.format(row) for row in range(7, rows + 1, 7)}
+    for row in range(7, rows + 1, 7):
+        loader.setvalue(-row, 'Sheet1!A{}'.format(row))
+    expected = reference_values(loader)
+    assert_same(loader.getvalues(list(expected)), expected)
+    assert not loader.failed
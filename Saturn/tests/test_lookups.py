@@ -0,0 +1,66 @@
+"""
+MATCH, VLOOKUP, HLOOKUP and LOOKUP over cached ranges, which are searched through a sorted index.
+"""
+import numpy as np
+from pycel.excelutil import VALUE_ERROR, REF_ERROR
+from conftest import column, reference_values, assert_same
+from loader import Loader
+import excellib
+
+ROWS = 30
+
+
+def lookup_book(workbook):
+    cells = {'A{}'.format(row): row * 2 for row in range(1, ROWS + 1)}
+    cells.update(column('B', '=A{0}/4', ROWS))
+    cells.update(column('C', '=MATCH(B{0}*3,A$1:A$30,1)', ROWS))
+    cells.update(column('D', '=VLOOKUP(B{0}*5,A$1:B$30,2,TRUE)', ROWS))
+    cells.update(column('E', '=MATCH(B{0}*8,A$1:A$30,-1)', ROWS))
+    cells.update(column('F', '=MATCH(A{0}+1,A$1:A$30,0)', ROWS))
+    cells.update(column('G', '=LOOKUP(B{0}*6,A$1:A$30,B$1:B$30)', ROWS))
+    cells.update({'{}40'.format(letter): row for row, letter in enumerate('ABCDEFGHIJ', 1)})
+    cells.update({'{}41'.format(letter): row * row for row, letter in enumerate('ABCDEFGHIJ', 1)})
+    cells.update(column('H', '=HLOOKUP(B{0},A$40:J$41,2,TRUE)', ROWS))
+    return workbook(cells)
+
+
+def test_sorted_lookups_follow_changes(workbook, monkeypatch):
+    indexed = []
+    lookup_index = excellib._lookup_index
+
+    def counted(*args):
+        index = lookup_index(*args)
+        indexed.append(index is not None)
+        return index
+    monkeypatch.setattr(excellib, '_lookup_index', counted)
+
+    loader = Loader(lookup_book(workbook))
+    expected = reference_values(loader)
+    assert_same(loader.getvalues(list(expected)), expected)
+    assert any(indexed)
+    for address, value in (('Sheet1!A5', 11), ('Sheet1!A20', 3), ('Sheet1!A1', 70.5), ('Sheet1!A20', 40),
+                           ('Sheet1!C40', 2.5)):
+        loader.setvalue(value, address)
+        expected = reference_values(loader)
+        assert_same(loader.getvalues(list(expected)), expected)
+
+
+def test_lookups_not_found(workbook):
+    loader = Loader(lookup_book(workbook))
+    assert loader.getvalue('Sheet1!F1') == '#N/A'
+    assert loader.getvalue('Sheet1!C1') == '#N/A'
+    assert loader.getvalue('Sheet1!H1') == '#N/A'
+    assert loader.getvalue('Sheet1!D2') == 1.0
+    assert loader.getvalue('Sheet1!H13') == 36
+    assert loader.getvalue('Sheet1!H30') == 100
+
+
+def test_vlookup_column_out_of_table(workbook):
+    cells = {'A1': 1, 'B1': 2, 'C1': '=VLOOKUP(1,A1:B1,0,FALSE)', 'D1': '=VLOOKUP(1,A1:B1,3,FALSE)'}
+    loader = Loader(workbook(cells))
+    assert loader.getvalues(['Sheet1!C1', 'Sheet1!D1']) == {'Sheet1!C1': VALUE_ERROR, 'Sheet1!D1': REF_ERROR}
+    for table in (np.array([[1, 2]], dtype=object), ((1, 2),)):
+        assert excellib.vlookup(1, table, 0, False) == VALUE_ERROR
+        assert excellib.vlookup(1, table, -1, False) == VALUE_ERROR
+        assert excellib.vlookup(1, table, 3, False) == REF_ERROR
+        assert excellib.vlookup(1, table, 2, False) == 2
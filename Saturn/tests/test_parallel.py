@@ -0,0 +1,71 @@
+import pytest
+import parallel
+from loader import Loader
+from conftest import column, reference_values, assert_same
+
+ROWS = 40
+
+
+@pytest.fixture
+def scheduled(monkeypatch):
+    '''
+    Lets small models go to the pool, and records each schedule made
+    @return: list of the schedules
+    '''
+    monkeypatch.setattr(parallel, 'MIN_CELLS', 10)
+    monkeypatch.setattr(parallel, 'MIN_CHUNK', 1)
+    schedules = []
+    schedule = parallel.schedule
+
+    def record(*args):
+        rounds = schedule(*args)
+        schedules.append(rounds)
+        return rounds
+    monkeypatch.setattr(parallel, 'schedule', record)
+    return schedules
+
+
+def blocks_book(workbook):
+    '''
+    Independent blocks of columns, each ending in a total
+    '''
+    cells = {}
+    for block, (inp, first, second, total) in enumerate(('ABCD', 'EFGH', 'IJKL', 'MNOP')):
+        for row in range(1, ROWS + 1):
+            cells['{}{}'.format(inp, row)] = row * (block + 1) if row % 4 else row / 8
+        cells.update(column(first, '={}{{0}}*2+1'.format(inp), ROWS))
+        cells.update(column(second, '={0}{{0}}-{1}{{0}}^2'.format(first, inp), ROWS))
+        cells['{}1'.format(total)] = '=SUM({0}1:{0}{1})'.format(second, ROWS)
+    return workbook(cells)
+
+
+def levels_book(workbook):
+    '''
+    One column feeding one total, which only splits by level
+    '''
+    cells = {'A{}'.format(row): row for row in range(1, ROWS + 1)}
+    cells.update(column('B', '=A{0}*3-1', ROWS))
+    cells['C1'] = '=SUM(B1:B{})+B1'.format(ROWS)
+    return workbook(cells)
+
+
+@pytest.mark.parametrize('book', [blocks_book, levels_book])
+def test_parallel_matches_serial(workbook, scheduled, book):
+    path = book(workbook)
+    loader = Loader(path)
+    serial = Loader(path)
+    formulas = [address for address, cell in loader.cells.items() if cell.program is not None]
+
+    values = loader.getvalues(formulas, workers=2)
+    assert scheduled and scheduled[-1] is not None
+    assert_same(values, reference_values(loader))
+    assert_same(values, serial.getvalues(formulas))
+
+    # Values written back from the workers are read by formulas calculated here, through column sums
+    for row in range(1, ROWS + 1, 3):
+        loader.setvalue(row * 10, 'Sheet1!A{}'.format(row))
+        serial.setvalue(row * 10, 'Sheet1!A{}'.format(row))
+    values = loader.getvalues(formulas, workers=2)
+    assert len(scheduled) == 2 and scheduled[-1] is not None
+    assert_same(values, serial.getvalues(formulas))
+    assert_same(values, reference_values(loader))
@@ -0,0 +1,97 @@
+"""
+Range descriptors, the index from cells to the ranges covering them, and range values as arrays.
+"""
+import random
+import numpy as np
+from conftest import reference_values, assert_same
+from loader import Loader
+from ranges import RangeRef, to_array
+from excellib import xsum, xmax, xmin, average, count
+from rangeindex import RangeIndex
+
+
+def test_range_ref():
+    ref = RangeRef.from_address('Sheet1!B2:C4')
+    assert ref == RangeRef('Sheet1', 2, 2, 4, 3)
+    assert str(ref) == 'Sheet1!B2:C4'
+    assert list(ref.rows()) == [['Sheet1!B{}'.format(row), 'Sheet1!C{}'.format(row)] for row in (2, 3, 4)]
+    assert ref.contains('Sheet1', 4, 3) and not ref.contains('Sheet1', 5, 3) and not ref.contains('Sheet2', 2, 2)
+
+    # Whole columns and rows are unbounded until clipped to the used part of the sheet
+    column = RangeRef.from_address('Sheet1!A:B')
+    assert (column.max_row, str(column)) == (None, 'Sheet1!A:B')
+    assert column.contains('Sheet1', 10 ** 6, 2)
+    assert column.bounds(3, 10) == (1, 1, 3, 2)
+    assert list(column.addresses(2)) == ['Sheet1!A1', 'Sheet1!B1', 'Sheet1!A2', 'Sheet1!B2']
+    row = RangeRef.from_address('Sheet1!2:2')
+    assert (row.min_col, row.max_col, str(row)) == (1, None, 'Sheet1!2:2')
+    assert list(row.addresses(5, 2)) == ['Sheet1!A2', 'Sheet1!B2']
+
+    # Ranges over an empty sheet have no cells
+    assert list(column.addresses()) == []
+
+
+def test_whole_column_ranges(workbook):
+    cells = {'A{}'.format(row): row for row in range(1, 11)}
+    cells.update({'B1': '=SUM(A:A)', 'B2': '=COUNT(A:A)', 'B3': '=SUM(2:2)'})
+    loader = Loader(workbook(cells))
+    assert loader.getvalues(['Sheet1!B1', 'Sheet1!B2', 'Sheet1!B3']) == \
+        {'Sheet1!B1': 55, 'Sheet1!B2': 10, 'Sheet1!B3': 12}
+    loader.setvalue(100, 'Sheet1!A2')
+    expected = reference_values(loader)
+    assert_same(loader.getvalues(list(expected)), expected)
+    assert expected['Sheet1!B3'] == 110
+
+
+def test_range_index_matches_scan():
+    rng = random.Random(1)
+    index = RangeIndex()
+    refs = {}
+    for n in range(400):
+        min_row, min_col = rng.randint(1, 60), rng.randint(1, 30)
+        shape = rng.random()
+        if shape < 0.1:
+            ref = RangeRef('Sheet1', min_row, min_col, None, min_col + rng.randint(0, 2))
+        elif shape < 0.2:
+            ref = RangeRef('Sheet1', min_row, min_col, min_row + rng.randint(0, 2), None)
+        else:
+            ref = RangeRef(rng.choice(['Sheet1', 'Sheet2']), min_row, min_col,
+                           min_row + rng.randint(0, 40), min_col + rng.choice([0, 1, 5, 20]))
+        dependent = 'Sheet3!A{}'.format(n)
+        index.add(ref, dependent)
+        refs[(ref, dependent)] = ref
+
+    # Half removed again, some twice
+    for key in rng.sample(list(refs), 200):
+        index.remove(*key)
+        index.remove(*key)
+        del refs[key]
+    assert len(index) == len(refs)
+
+    for _ in range(500):
+        sheet, row, col = rng.choice(['Sheet1', 'Sheet2']), rng.randint(1, 120), rng.randint(1, 70)
+        expected = {key for key, ref in refs.items() if ref.contains(sheet, row, col)}
+        assert set(index.query(sheet, row, col)) == expected
+    assert sum(index.users(ref) for ref in set(refs.values())) == len(refs)
+
+
+def test_to_array():
+    numbers = to_array([[1, 2.5], [3, 4]])
+    assert numbers.dtype == np.float64 and numbers.shape == (2, 2)
+    for rows in ([[1, None]], [[1, 'a']], [[1, True]]):
+        assert to_array(rows).dtype == object
+    assert to_array([[1, None]])[0, 1] is None
+
+
+def test_aggregates_over_arrays():
+    values = [[3, None, 'text'], [True, -2.5, '4'], [7, 0, None]]
+    numbers = [3, -2.5, 7, 0]
+    array = to_array(values)
+    floats = to_array([[3, -2.5], [7, 0]])
+    for func, expected in ((xsum, 7.5), (xmax, 7), (xmin, -2.5), (average, 1.875), (count, 4)):
+        assert func(floats) == expected, func.__name__
+        assert func(array) == func(values), func.__name__
+        # COUNT of lists counts bools and numeric text, and arrays do as lists do
+        if func is not count:
+            assert func(array) == expected, func.__name__
+    assert xsum(array, 1, floats) == xsum(numbers) * 2 + 1
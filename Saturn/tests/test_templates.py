@@ -0,0 +1,60 @@
+from loader import Loader
+from templates import MIN_ROWS
+from conftest import column, reference_values, assert_same
+
+ROWS = 2 * MIN_ROWS + 8
+
+
+def grouped_book(workbook):
+    cells = {'Z1': 1, 'Z2': 2.5}
+    for row in range(1, ROWS + 1):
+        cells['A{}'.format(row)] = row
+        cells['B{}'.format(row)] = row / 4
+        cells['C{}'.format(row)] = row if row % 3 else row + 0.5
+    for letter, formula in (('D', '=A{0}*2+1'), ('E', '=A{0}/2'), ('F', '=A{0}*B{0}'), ('G', '=C{0}*$Z$1-A{0}'),
+                            ('H', '=A{0}*$Z$2'), ('I', '=MAX(A{0},C{0})+$Z$1'), ('J', '=-A{0}+C{0}^2'),
+                            ('K', '=A{0}>C{0}')):
+        cells.update(column(letter, formula, ROWS))
+    return workbook(cells)
+
+
+def test_grouped_matches_per_cell(workbook):
+    loader = Loader(grouped_book(workbook))
+    formulas = [address for address, cell in loader.cells.items() if cell.program is not None]
+    assert len(loader.formulaGroups()) == len(formulas)
+
+    assert_same(loader.getvalues(formulas), reference_values(loader))
+
+
+def test_grouped_matches_per_cell_after_change(workbook):
+    loader = Loader(grouped_book(workbook))
+    formulas = [address for address, cell in loader.cells.items() if cell.program is not None]
+    loader.getvalues(formulas)
+
+    loader.setvalue(2, 'Sheet1!Z1')
+    for row in range(1, ROWS + 1, 2):
+        loader.setvalue(row * 1.5, 'Sheet1!A{}'.format(row))
+    assert_same(loader.getvalues(formulas), reference_values(loader))
+
+
+def test_ints_past_float64(workbook):
+    # Workbooks hold float64, so ints past 2 ** 53 come from int arithmetic, constants of formulas and changes
+    big = 2 ** 53
+    cells = {'A{}'.format(row): big // 2 + row for row in range(1, ROWS + 1)}
+    cells.update({'Z1': 1, 'Y{}'.format(ROWS): 1})
+    for letter, formula in (('B', '=A{0}*3'), ('C', '=A{0}-$Z$1'), ('D', '=Y{0}+9007199254740993'),
+                            ('E', '=A{0}*4-B{0}')):
+        cells.update(column(letter, formula, ROWS))
+    loader = Loader(workbook(cells))
+    formulas = [address for address, cell in loader.cells.items() if cell.program is not None]
+    assert len(loader.formulaGroups()) == len(formulas)
+    expected = reference_values(loader)
+    assert expected['Sheet1!B1'] == 3 * big // 2 + 3 and expected['Sheet1!D1'] == big + 1
+    assert_same(loader.getvalues(formulas), expected)
+
+    loader.setvalue(big + 1, 'Sheet1!Z1')
+    for row in range(1, ROWS + 1, 2):
+        loader.setvalue(big + row, 'Sheet1!A{}'.format(row))
+    expected = reference_values(loader)
+    assert expected['Sheet1!C3'] == 2
+    assert_same(loader.getvalues(formulas), expected)
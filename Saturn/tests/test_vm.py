@@ -0,0 +1,95 @@
+"""
+The stack machine against the string eval evaluation it replaced, kept in benchmark as the baseline.
+"""
+import math
+import pytest
+from conftest import column, reference_values, assert_same
+from loader import Loader
+from benchmark import formula_cells, run_legacy, run_vm
+
+ROWS = 20
+
+# Inputs of the operator cases: text, numeric text, a number, an error and a blank (Z1 is left empty)
+OPERANDS = {'A1': 'ab', 'A2': '3', 'A3': 5, 'A4': '=1/0'}
+
+# Formula and the value Excel gives
+OPERATORS = [
+    ('="ab"*2', '#VALUE!'),
+    ('="3"*2', 6),
+    ('="3"+2', 5),
+    ('="5"-1', 4),
+    ('="8"/"2"', 4.0),
+    ('="2"^3', 8),
+    ('=-"ab"', '#VALUE!'),
+    ('=-A2', -3),
+    ('=A2%', 0.03),
+    ('=TRUE+1', 2),
+    ('=Z1+1', 1),
+    ('=A4+1', '#DIV/0!'),
+    ('=A1*A4', '#VALUE!'),
+    ('=A4*A1', '#DIV/0!'),
+    ('=-A4', '#DIV/0!'),
+    ('=A4&"x"', '#DIV/0!'),
+    ('=A3&A2', '53'),
+    ('=0^-1', '#DIV/0!'),
+    ('=(-8)^(1/3)', '#NUM!'),
+    ('=A3>"a"', False),
+    ('=A3<"a"', True),
+    ('="a"="A"', True),
+    ('="b"<"A"', False),
+    ('="1"=1', False),
+    ('=TRUE>5', True),
+    ('=TRUE>"z"', True),
+    ('=3=3.0', True),
+    ('=Z1=""', True),
+    ('=Z1=0', True),
+    ('=Z1<"a"', True),
+    ('=Z1=FALSE', True),
+    ('=A1<A4', '#DIV/0!'),
+]
+
+
+def arithmetic_book(workbook):
+    cells = {'A{}'.format(row): row for row in range(1, ROWS + 1)}
+    cells.update(column('B', '=A{0}*2+1', ROWS))
+    cells.update(column('C', '=B{0}/(A{0}+1)-B{0}^2', ROWS))
+    cells.update(column('D', '=SUM(A{0}:C{0})', ROWS))
+    cells.update(column('E', '=MAX(B{0},C{0},D{0})-MIN(A{0},1)', ROWS))
+    cells.update(column('F', '=-A{0}+ABS(C{0})*2', ROWS))
+    cells.update(column('G', '=ROUND(C{0}/3,2)+COUNT(A{0}:F{0})', ROWS))
+    return workbook(cells)
+
+
+def test_vm_matches_eval(workbook):
+    loader = Loader(arithmetic_book(workbook))
+    cells = formula_cells(loader)
+    legacy = run_legacy(loader, cells)
+    vm = run_vm(loader, cells)
+    assert len(vm) == 7 * ROWS - ROWS
+    for cell, old, new in zip(cells, legacy, vm):
+        assert math.isclose(old, new, rel_tol=1e-12), cell.address
+
+
+def test_vm_matches_reference(workbook):
+    loader = Loader(arithmetic_book(workbook))
+    expected = reference_values(loader)
+    assert_same(loader.getvalues(list(expected)), expected)
+
+
+@pytest.mark.parametrize('formula, expected', OPERATORS)
+def test_operators_follow_excel(workbook, formula, expected):
+    loader = Loader(workbook(dict(OPERANDS, B1=formula)))
+    value = loader.getvalue('Sheet1!B1')
+    assert value == expected and type(value) is type(expected)
+
+
+def test_compiled_operators(workbook):
+    cells = dict(OPERANDS)
+    cells.update({'B{}'.format(row): formula for row, (formula, expected) in enumerate(OPERATORS, 1)})
+    loader = Loader(workbook(cells))
+    outputs = ['Sheet1!B{}'.format(row) for row in range(1, len(OPERATORS) + 1)]
+    module = loader.compile_module(['Sheet1!A1', 'Sheet1!A2', 'Sheet1!A3'], outputs, cache=False)
+    assert module.calculate() == {address: expected for address, (formula, expected) in zip(outputs, OPERATORS)}
+    assert module.Sheet1_B8(Sheet1_A2='4') == -4
+    assert module.Sheet1_B8(Sheet1_A2='x') == '#VALUE!'
+    assert module.Sheet1_B20(Sheet1_A3='B') is True
@@ -0,0 +1,260 @@
+"""
+Stack machine for evaluating cell formulas.
+
+Each Cell.rpn list is lowered once into a program, a tuple of (opcode, argument) pairs in which operators are
+already bound to python functions and excel functions to their excellib equivalents. Running a program is then
+a single loop over the pairs, with no eval and no formatting of intermediate values into strings.
+"""
+from collections import Counter
+from rpnnode import OperatorNode, RangeNode, CellNode, FunctionNode
+from excellib import INFIX_OPERATORS, PREFIX_OPERATORS, POSTFIX_OPERATORS, get_function, as_tuples
+from windows import AGGREGATES, windowable
+
+
+# Opcodes
+CONST = 0       # argument: value to push
+CELL = 1        # argument: address of the cell to load
+RANGE = 2       # argument: RangeRef of the range to load
+BINARY = 3      # argument: function of two operands
+UNARY = 4       # argument: function of one operand
+CALL = 5        # argument: (function, number of arguments, whether function takes numpy ranges)
+SHARED = 6      # argument: (id, program) of a sub-expression repeated across formulas, see share_subexpressions
+WINDOW = 7      # argument: (function, RangeRef) of SUM, AVERAGE or COUNT over a single column, see windows
+
+OPCODE_NAMES = ('CONST', 'CELL', 'RANGE', 'BINARY', 'UNARY', 'CALL', 'SHARED', 'WINDOW')
+
+
+class CompileError(Exception):
+    pass
+
+
+class Memo(dict):
+    """
+    Values of shared sub-expressions by id, valid until a cell of the model changes. hits counts the evaluations
+    saved by reusing them
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hits = 0
+
+
+def compile_rpn(rpn):
+    '''
+    Lowers a list of RPN nodes into a program
+    @param rpn: list of RPNNode in reverse polish order
+    @return: tuple of (opcode, argument)
+    '''
+    program = []
+    for node in rpn:
+        token = node.token
+
+        if isinstance(node, OperatorNode):
+            if token.type == token.OP_IN:
+                func = INFIX_OPERATORS.get(token.value)
+                opcode = BINARY
+            elif token.type == token.OP_PRE:
+                func = PREFIX_OPERATORS.get(token.value)
+                opcode = UNARY
+            else:
+                func = POSTFIX_OPERATORS.get(token.value)
+                opcode = UNARY
+            if func is None:
+                raise CompileError("Unsupported operator {}".format(token.value))
+            program.append((opcode, func))
+
+        elif isinstance(node, FunctionNode):
+            func = get_function(token.value.strip('('))
+            if (func in AGGREGATES and node.num_args == 1 and program and program[-1][0] == RANGE and
+                    windowable(program[-1][1])):
+                program[-1] = (WINDOW, (func, program[-1][1]))
+            else:
+                program.append((CALL, (func, node.num_args, getattr(func, 'array_args', False))))
+
+        elif isinstance(node, RangeNode):
+            program.append((RANGE, node.ref))
+
+        elif isinstance(node, CellNode):
+            program.append((CELL, node.rangeadds))
+
+        else:
+            program.append((CONST, token.value))
+
+    return tuple(program)
+
+
+def execute(program, load_cell, load_range, call=None, memo=None, load_window=None):
+    '''
+    Runs a program
+    @param program: program returned by compile_rpn
+    @param load_cell: function returning the value of a cell given its address
+    @param load_range: function returning the values of a range given its RangeRef
+    @param call: optional hook called as call(function, args, array_args) in place of the plain function call
+    @param memo: Memo of shared sub-expressions. Without one they are evaluated in place
+    @param load_window: function returning func(range) given (func, RangeRef) for WINDOW instructions. Without
+    one the range is loaded and the function called
+    @return: value left on the stack
+    '''
+    stack = []
+    push = stack.append
+    pop = stack.pop
+
+    for opcode, arg in program:
+        if opcode == CELL:
+            push(load_cell(arg))
+        elif opcode == CONST:
+            push(arg)
+        elif opcode == BINARY:
+            right = pop()
+            stack[-1] = arg(stack[-1], right)
+        elif opcode == CALL:
+            func, num_args, array_args = arg
+            if num_args:
+                args = stack[-num_args:]
+                del stack[-num_args:]
+            else:
+                args = []
+            if call is not None:
+                push(call(func, args, array_args))
+            else:
+                if not array_args:
+                    args = [as_tuples(a) for a in args]
+                push(func(*args))
+        elif opcode == UNARY:
+            stack[-1] = arg(stack[-1])
+        elif opcode == RANGE:
+            push(load_range(arg))
+        elif opcode == WINDOW:
+            func, ref = arg
+            if load_window is not None:
+                push(load_window(func, ref))
+            elif call is not None:
+                push(call(func, [load_range(ref)], False))
+            else:
+                push(func(as_tuples(load_range(ref))))
+        else:
+            key, shared = arg
+            if memo is None:
+                push(execute(shared, load_cell, load_range, call, None, load_window))
+            elif key in memo:
+                memo.hits += 1
+                push(memo[key])
+            else:
+                memo[key] = value = execute(shared, load_cell, load_range, call, memo, load_window)
+                push(value)
+
+    assert len(stack) == 1, 'More than 1 remaining value in stack. Recheck the stack algorithm'
+    return stack[0]
+
+
+def subexpressions(program):
+    '''
+    Sub-expressions of a program worth sharing, i.e. those calling a function
+    @return: generator of (start, end) slices of the program, inner sub-expressions first
+    '''
+    spans = []
+    for index, (opcode, arg) in enumerate(program):
+        if opcode in (CONST, CELL, RANGE):
+            spans.append((index, False))
+            continue
+        if opcode == SHARED:
+            spans.append((index, True))
+            continue
+        if opcode == WINDOW:
+            start, calls = index, True
+        elif opcode == BINARY:
+            (_, right), (start, left) = spans.pop(), spans.pop()
+            calls = left or right
+        elif opcode == UNARY:
+            start, calls = spans.pop()
+        else:
+            num_args = arg[1]
+            start, calls = (spans[-num_args][0], True) if num_args else (index, True)
+            del spans[len(spans) - num_args:]
+        spans.append((start, calls))
+        if calls:
+            yield start, index + 1
+
+
+def share_subexpressions(programs):
+    '''
+    Common sub-expression elimination across formulas. Sub-expressions are compared as program slices, in which
+    references are already absolute addresses and RangeRefs, so SUM(Data!$B$2:$B$500) in one cell and
+    SUM(Data!B2:B500) in another are the same. Each one found more than once is replaced by a SHARED instruction
+    @param programs: dictionary with format {address: program}
+    @return: ({address: rewritten program} for the programs that changed, number of distinct shared
+    sub-expressions, number of places they are used)
+    '''
+    counts = Counter()
+    for program in programs.values():
+        for start, end in subexpressions(program):
+            try:
+                counts[program[start:end]] += 1
+            except TypeError:
+                # Unhashable constant, e.g. an array
+                pass
+
+    ids = {}
+    for key, count in counts.items():
+        if count > 1:
+            ids[key] = len(ids)
+    if not ids:
+        return {}, 0, 0
+
+    rewritten = {}
+    uses = 0
+    for address, program in programs.items():
+        # Spans are tracked in both the original and the rewritten program, as rewriting shortens it
+        new = []
+        spans = []
+        changed = False
+        for index, (opcode, arg) in enumerate(program):
+            new.append((opcode, arg))
+            if opcode in (CONST, CELL, RANGE, SHARED):
+                spans.append((index, len(new) - 1))
+                continue
+            if opcode == WINDOW:
+                start, new_start = index, len(new) - 1
+            elif opcode == BINARY:
+                spans.pop()
+                start, new_start = spans.pop()
+            elif opcode == UNARY:
+                start, new_start = spans.pop()
+            else:
+                num_args = arg[1]
+                start, new_start = spans[-num_args] if num_args else (index, len(new) - 1)
+                del spans[len(spans) - num_args:]
+            spans.append((start, new_start))
+
+            try:
+                key = ids.get(program[start:index + 1])
+            except TypeError:
+                key = None
+            if key is not None:
+                new[new_start:] = [(SHARED, (key, tuple(new[new_start:])))]
+                changed = True
+                uses += 1
+
+        if changed:
+            rewritten[address] = tuple(new)
+
+    return rewritten, len(ids), uses
+
+
+def disassemble(program):
+    '''
+    Human readable listing of a program, for debugging
+    @return: list of strings, one per instruction
+    '''
+    lines = []
+    for opcode, arg in program:
+        if opcode == CALL:
+            arg = '{}/{}'.format(arg[0].__name__, arg[1])
+        elif opcode in (BINARY, UNARY):
+            arg = arg.__name__
+        elif opcode == SHARED:
+            arg = '#{} {}'.format(arg[0], ' '.join(disassemble(arg[1])))
+        elif opcode == WINDOW:
+            arg = '{}({})'.format(arg[0].__name__, arg[1])
+        lines.append('{:<7}{}'.format(OPCODE_NAMES[opcode], arg))
+    return lines
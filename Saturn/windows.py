@@ -0,0 +1,127 @@
+"""
+Cumulative sums of a column for SUM, AVERAGE and COUNT over single column windows.
+
+Running totals such as =SUM($B$2:B100) and rolling windows such as =AVERAGE(B89:B100) read a range per cell, so a
+column of them re-reads O(n^2) cells. Keeping per column cumulative sums from the first row down, each window is
+the difference of two entries. Sums of integers are kept exactly, sums of floats with Neumaier's compensation so
+a short window deep down a long column is not swamped by rounding of the total above it.
+
+Entries only ever grow downwards. When a cell changes, the sums of its column are cut back to the row above it.
+"""
+from bisect import bisect_left
+import numpy as np
+from openpyxl.utils import get_column_letter
+from pycel.excelutil import is_number
+from excellib import xsum, average, count, DIV0, ERROR_CODES
+
+# Functions answered from cumulative sums
+AGGREGATES = {xsum, average, count}
+
+
+def windowable(ref):
+    '''
+    @return: True if the range is a single column with bounded rows
+    '''
+    return ref.min_col is not None and ref.min_col == ref.max_col and ref.max_row is not None
+
+
+class ColumnSums:
+    """
+    Cumulative statistics of rows 1 to `end` of a column. Entry i covers rows 1 to i, entry 0 is the empty sum
+    """
+
+    def __init__(self, sheet, col):
+        self.prefix = '{}!{}'.format(sheet, get_column_letter(col))
+        self.ints = [0]
+        self.floats = [0.0]
+        self.compensation = [0.0]
+        self.float_counts = [0]
+        self.numbers = [0]
+        self.counted = [0]
+        self.errors = []
+
+    @property
+    def end(self):
+        return len(self.ints) - 1
+
+    def extend(self, last_row, first_row, load, ready):
+        '''
+        Loads rows down to last_row. Rows above the window being answered may be loaded too, but only if they
+        need no calculation, since they are not precedents of the formula asking
+        @param last_row: last row needed
+        @param first_row: first row of the window
+        @param load: function returning the value of a cell given its address
+        @param ready: function telling whether a cell can be loaded without calculating it
+        @return: False if a row above the window is not ready
+        '''
+        start = self.end + 1
+        if start > last_row:
+            return True
+        if any(not ready('{}{}'.format(self.prefix, row)) for row in range(start, min(first_row, last_row + 1))):
+            return False
+
+        ints, floats, compensation = self.ints[-1], self.floats[-1], self.compensation[-1]
+        float_counts, numbers, counted = self.float_counts[-1], self.numbers[-1], self.counted[-1]
+        for row in range(start, last_row + 1):
+            value = load('{}{}'.format(self.prefix, row))
+            if isinstance(value, np.generic):
+                value = value.item()
+            if isinstance(value, bool) or value is None:
+                pass
+            elif isinstance(value, int):
+                ints += value
+                numbers += 1
+            elif isinstance(value, float):
+                total = floats + value
+                if abs(floats) >= abs(value):
+                    compensation += (floats - total) + value
+                else:
+                    compensation += (value - total) + floats
+                floats = total
+                float_counts += 1
+                numbers += 1
+            elif isinstance(value, str) and value in ERROR_CODES:
+                self.errors.append((row, value))
+            if is_number(value):
+                # As count does for cells of a range, bools and numeric text included
+                counted += 1
+
+            self.ints.append(ints)
+            self.floats.append(floats)
+            self.compensation.append(compensation)
+            self.float_counts.append(float_counts)
+            self.numbers.append(numbers)
+            self.counted.append(counted)
+        return True
+
+    def truncate(self, row):
+        '''
+        Forgets rows from `row` down, after a change in that row
+        '''
+        if row <= self.end:
+            for entries in (self.ints, self.floats, self.compensation, self.float_counts, self.numbers, self.counted):
+                del entries[row:]
+            del self.errors[bisect_left(self.errors, (row, )):]
+
+    def aggregate(self, func, first_row, last_row):
+        '''
+        @param func: xsum, average or count
+        @return: value of func over rows first_row to last_row, which must be loaded
+        '''
+        a, b = first_row - 1, last_row
+        if func is count:
+            return self.counted[b] - self.counted[a]
+
+        index = bisect_left(self.errors, (first_row, ))
+        if index < len(self.errors) and self.errors[index][0] <= last_row:
+            return self.errors[index][1]
+
+        total = self.ints[b] - self.ints[a]
+        if self.float_counts[b] != self.float_counts[a]:
+            total += (self.floats[b] - self.floats[a]) + (self.compensation[b] - self.compensation[a])
+        numbers = self.numbers[b] - self.numbers[a]
+        if func is xsum:
+            # xsum of a range of numbers only sums a float array
+            return float(total) if numbers == b - a else total
+
+        return total / numbers if numbers else DIV0